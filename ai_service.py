@@ -1,23 +1,37 @@
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from requests import exceptions as requests_exceptions
 import os
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, send_file, g, has_request_context
 from flask_cors import CORS
 import logging
+import click
 import time
 import traceback
 import json
+import threading
+import queue
+import atexit
+from contextlib import contextmanager
+import bisect
+import heapq
+import itertools
+import uuid
+import hashlib
+import hmac
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 import numpy as np
 import pickle
 from datetime import datetime, timedelta
 import sqlite3
-from transformers import AutoTokenizer, AutoModel, pipeline
-import torch
 import re
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import LogisticRegression
-from sklearn.preprocessing import StandardScaler
-import pandas as pd
+import unicodedata
+import zlib
+import sys
+from array import array
 
 # Cấu hình logging
 logging.basicConfig(
@@ -41,108 +55,1793 @@ GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 if not GOOGLE_API_KEY:
     raise ValueError("Không tìm thấy GOOGLE_API_KEY. Hãy chắc chắn bạn đã tạo file .env")
 
+def running_under_gevent():
+    """Kiểm tra tiến trình có đang chạy với gevent (đã monkey-patch socket) hay không"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+# Trong chế độ gevent, dùng REST (gRPC chặn event loop); có thể ép bằng GEMINI_TRANSPORT
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT') or ('rest' if running_under_gevent() else None)
+# Trỏ tới server giả lập cục bộ khi test/benchmark (vd: localhost:8089, dùng với GEMINI_TRANSPORT=rest)
+GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT')
+
+def configure_genai():
+    genai.configure(
+        api_key=GOOGLE_API_KEY,
+        transport=GEMINI_TRANSPORT,
+        client_options={'api_endpoint': GEMINI_API_ENDPOINT} if GEMINI_API_ENDPOINT else None
+    )
+
 try:
-    genai.configure(api_key=GOOGLE_API_KEY)
+    configure_genai()
     logger.info("Đã cấu hình Google AI thành công")
 except Exception as e:
     logger.error(f"Lỗi cấu hình Google AI: {e}")
     raise
 
+# Số thread cho các tác vụ chặn (NLP, SQLite) khi chạy với gevent
+BLOCKING_POOL_SIZE = int(os.getenv('BLOCKING_POOL_SIZE', '10'))
+_blocking_pool = None
+
+def run_blocking(fn, *args, **kwargs):
+    """Chạy tác vụ chặn trong thread pool thật khi dùng gevent, gọi trực tiếp ở chế độ sync"""
+    global _blocking_pool
+    if not running_under_gevent():
+        return fn(*args, **kwargs)
+    if _blocking_pool is None:
+        from gevent.threadpool import ThreadPool
+        _blocking_pool = ThreadPool(BLOCKING_POOL_SIZE)
+    return _blocking_pool.apply(fn, args, kwargs)
+
+# Cấu hình lưu trữ SQLite (DB_WRITE_MODE=sync để ghi đồng bộ, dùng khi test)
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'depression_support.db')
+DB_WRITE_MODE = os.getenv('DB_WRITE_MODE', 'async')
+DB_WRITE_QUEUE_SIZE = int(os.getenv('DB_WRITE_QUEUE_SIZE', '10000'))
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '200'))
+DB_ENQUEUE_TIMEOUT = float(os.getenv('DB_ENQUEUE_TIMEOUT', '2'))
+
+# Lớp lưu trữ: một kết nối SQLite (WAL) cho mỗi tiến trình + thread ghi nền gom nhiều lệnh vào một commit
+class Database:
+    def __init__(self, path, write_mode='async', queue_size=10000, batch_size=200):
+        self.path = path
+        self.write_mode = write_mode
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self._lock = threading.RLock()
+        self._conn = None
+        self._conn_pid = None
+        self._queue = None
+        self._thread = None
+        self._writer_pid = None
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.sync_fallbacks = 0
+
+    def _connection(self):
+        # Không dùng lại kết nối được kế thừa qua fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            # Phải đặt trước journal_mode=WAL (lệnh này tạo trang đầu của file mới); database cũ thì không đổi,
+            # được chuyển khi chạy archive-history lần đầu (xem compact)
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    @contextmanager
+    def cursor(self):
+        """Cursor trên kết nối dùng chung; commit khi thoát, rollback nếu lỗi"""
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def reader(self):
+        """Kết nối chỉ đọc riêng cho truy vấn dài (export), không giữ khoá của kết nối dùng chung"""
+        from urllib.parse import quote
+        conn = sqlite3.connect(f'file:{quote(os.path.abspath(self.path))}?mode=ro', uri=True,
+                               check_same_thread=False, timeout=30)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _ensure_writer(self):
+        if self._thread is not None and self._writer_pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._writer_pid == os.getpid() and self._thread.is_alive():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._writer_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, operation, *args):
+        """Đưa một thao tác ghi operation(cursor, *args) vào hàng đợi"""
+        if self.write_mode == 'sync':
+            self._write_batch([(operation, args)])
+            return
+
+        self._ensure_writer()
+        try:
+            self._queue.put((operation, args), timeout=DB_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            # Hàng đợi đầy quá lâu: ghi trực tiếp thay vì làm mất dữ liệu
+            self.sync_fallbacks += 1
+            logger.warning("Hàng đợi ghi database đầy, chuyển sang ghi đồng bộ")
+            self._write_batch([(operation, args)])
+
+    def _write_batch(self, batch):
+        with self.cursor() as cursor:
+            cursor.execute('BEGIN')
+            for operation, args in batch:
+                # Mỗi thao tác trong savepoint riêng: thao tác lỗi chỉ huỷ phần của nó, các thao tác khác vẫn được commit
+                cursor.execute('SAVEPOINT write_op')
+                try:
+                    operation(cursor, *args)
+                    cursor.execute('RELEASE write_op')
+                    self.written += 1
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write_op')
+                    cursor.execute('RELEASE write_op')
+                    self.errors += 1
+                    logger.error(f"Lỗi ghi database ({operation.__name__}): {e}")
+        self.batches += 1
+
+    def _run(self):
+        write_queue = self._queue
+        while True:
+            batch = [write_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                run_blocking(self._write_batch, batch)
+            except Exception as e:
+                self.errors += len(batch)
+                logger.error(f"Lỗi ghi batch database: {e}")
+            finally:
+                for _ in batch:
+                    write_queue.task_done()
+
+    def flush(self):
+        """Chờ tới khi mọi thao tác ghi trong hàng đợi đã được commit"""
+        if self._queue is not None and self._writer_pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """Ghi nốt hàng đợi rồi đóng kết nối (gọi khi tắt tiến trình)"""
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                if self._conn is not None and self._conn_pid == os.getpid():
+                    self._conn.close()
+                self._conn = None
+
+    def compact(self):
+        """Thu hồi trang trống sau khi xoá nhiều dòng rồi cắt WAL; trả về số trang đã thu hồi"""
+        self.flush()
+        with self._lock:
+            conn = self._connection()
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # Database tạo trước khi bật auto_vacuum: cần một lần VACUUM đầy đủ để chuyển chế độ
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+            else:
+                # incremental_vacuum thu hồi từng trang mỗi bước, phải đọc hết kết quả
+                conn.execute('PRAGMA incremental_vacuum').fetchall()
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return free_pages
+
+    def stats(self):
+        return {
+            'write_mode': self.write_mode,
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'queue_size': self.queue_size,
+            'written': self.written,
+            'batches': self.batches,
+            'errors': self.errors,
+            'sync_fallbacks': self.sync_fallbacks
+        }
+
+database = Database(DATABASE_PATH, DB_WRITE_MODE, DB_WRITE_QUEUE_SIZE, DB_WRITE_BATCH_SIZE)
+atexit.register(database.close)
+
 # Khởi tạo database để lưu lịch sử và tracking
 def init_database():
-    conn = sqlite3.connect('depression_support.db')
-    cursor = conn.cursor()
+    with database.cursor() as cursor:
+        # Bảng lưu lịch sử chat
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                message TEXT,
+                response TEXT,
+                sentiment_score REAL,
+                depression_indicators TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+    
+        # Bảng lưu thông tin theo dõi người dùng
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_tracking (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                mood_score REAL,
+                depression_level TEXT,
+                recommended_actions TEXT,
+                last_check DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
     
-    # Bảng lưu lịch sử chat
+        # Bảng lưu resources hỗ trợ
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS support_resources (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                category TEXT,
+                title TEXT,
+                description TEXT,
+                contact_info TEXT,
+                emergency BOOLEAN DEFAULT 0
+            )
+        ''')
+
+    run_migrations()
+
+# Các migration schema theo phiên bản, chạy tuần tự từ init_database
+def _migrate_chat_history_user_time_index(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_user_time ON chat_history (user_id, timestamp)')
+
+def _migrate_user_tracking_one_row_per_user(cursor):
+    # Giữ bản ghi mới nhất của mỗi user rồi thêm ràng buộc duy nhất để upsert
+    cursor.execute('''
+        DELETE FROM user_tracking
+        WHERE id NOT IN (SELECT MAX(id) FROM user_tracking GROUP BY user_id)
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_user_tracking_user ON user_tracking (user_id)')
+
+def _migrate_daily_stats_tables(cursor):
+    # Tổng hợp theo ngày cho từng user, cập nhật mỗi khi lưu một cuộc trò chuyện
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_daily_stats (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            chat_count INTEGER NOT NULL DEFAULT 0,
+            sentiment_sum REAL NOT NULL DEFAULT 0,
+            sentiment_sq_sum REAL NOT NULL DEFAULT 0,
+            sentiment_min REAL,
+            sentiment_max REAL,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_daily_indicators (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            indicator TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, indicator)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_daily_stats(cursor)
+
+def _migrate_session_tables(cursor):
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chat_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            message TEXT,
-            response TEXT,
-            sentiment_score REAL,
-            depression_indicators TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            last_activity REAL NOT NULL
         )
     ''')
-    
-    # Bảng lưu thông tin theo dõi người dùng
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_last_activity ON chat_sessions (last_activity)')
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_tracking (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            mood_score REAL,
-            depression_level TEXT,
-            recommended_actions TEXT,
-            last_check DATETIME DEFAULT CURRENT_TIMESTAMP
+        CREATE TABLE IF NOT EXISTS session_resets (
+            user_id TEXT PRIMARY KEY,
+            reset_at TEXT NOT NULL
         )
     ''')
-    
-    # Bảng lưu resources hỗ trợ
+
+def _migrate_job_checkpoints(cursor):
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS support_resources (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            category TEXT,
-            title TEXT,
-            description TEXT,
-            contact_info TEXT,
-            emergency BOOLEAN DEFAULT 0
+        CREATE TABLE IF NOT EXISTS job_checkpoints (
+            job TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            version TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
-    conn.commit()
-    conn.close()
+
+def _migrate_mood_series(cursor):
+    # Mỗi user một dòng: các mảng epoch/điểm/bitmask dạng BLOB, giới hạn MOOD_SERIES_CAPACITY điểm
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mood_series (
+            user_id TEXT PRIMARY KEY,
+            times BLOB NOT NULL,
+            scores BLOB NOT NULL,
+            masks BLOB NOT NULL
+        )
+    ''')
+    rebuild_mood_series(cursor)
+
+def _migrate_chat_archive_manifest(cursor):
+    # Manifest của các file lưu trữ theo tháng; mỗi user trong một tháng là một gzip member riêng (byte_offset/byte_length)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_archives (
+            month TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            rows INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_archive_segments (
+            user_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            byte_offset INTEGER NOT NULL,
+            byte_length INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            first_timestamp TEXT,
+            last_timestamp TEXT,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    ''')
+
+def _migrate_pending_replies(cursor):
+    # Phản hồi khủng hoảng tạo sau: dùng chung giữa các worker để /chat/reply trả được ở bất kỳ tiến trình nào
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_replies (
+            reply_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            result TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_replies_created_at ON pending_replies (created_at)')
+
+def _migrate_session_versions(cursor):
+    # Version của phiên: ghi có điều kiện để hai worker xử lý cùng user không ghi đè lượt của nhau
+    cursor.execute('ALTER TABLE chat_sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+MIGRATIONS = [
+    (1, 'Index chat_history (user_id, timestamp)', _migrate_chat_history_user_time_index),
+    (2, 'Deduplicate user_tracking, unique user_id', _migrate_user_tracking_one_row_per_user),
+    (3, 'Per-user daily aggregate tables', _migrate_daily_stats_tables),
+    (4, 'Shared chat session store', _migrate_session_tables),
+    (5, 'Checkpoints for resumable batch jobs', _migrate_job_checkpoints),
+    (6, 'Compact per-user mood time series', _migrate_mood_series),
+    (7, 'Manifest for archived chat_history partitions', _migrate_chat_archive_manifest),
+    (8, 'Shared store for deferred crisis replies', _migrate_pending_replies),
+    (9, 'Version column for optimistic session updates', _migrate_session_versions),
+]
+
+def run_migrations():
+    """Áp dụng các migration chưa chạy, mỗi migration trong một transaction riêng"""
+    with database.cursor() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        current_version = cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations').fetchone()[0]
+
+    for version, description, migrate in MIGRATIONS:
+        if version <= current_version:
+            continue
+        with database.cursor() as cursor:
+            cursor.execute('BEGIN')
+            migrate(cursor)
+            cursor.execute('INSERT INTO schema_migrations (version, description) VALUES (?, ?)', (version, description))
+        logger.info(f"Đã áp dụng migration {version}: {description}")
+
+def accumulate_daily_stats(cursor, user_id, day, sentiment_score, depression_indicators):
+    """Cộng một cuộc trò chuyện vào bucket ngày của user"""
+    cursor.execute('''
+        INSERT INTO user_daily_stats (user_id, day, chat_count, sentiment_sum, sentiment_sq_sum, sentiment_min, sentiment_max)
+        VALUES (?, ?, 1, ?, ?, ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            chat_count = chat_count + 1,
+            sentiment_sum = sentiment_sum + excluded.sentiment_sum,
+            sentiment_sq_sum = sentiment_sq_sum + excluded.sentiment_sq_sum,
+            sentiment_min = MIN(COALESCE(sentiment_min, excluded.sentiment_min), excluded.sentiment_min),
+            sentiment_max = MAX(COALESCE(sentiment_max, excluded.sentiment_max), excluded.sentiment_max)
+    ''', (user_id, day, sentiment_score, sentiment_score * sentiment_score, sentiment_score, sentiment_score))
+    cursor.executemany('''
+        INSERT INTO user_daily_indicators (user_id, day, indicator, count)
+        VALUES (?, ?, ?, 1)
+        ON CONFLICT (user_id, day, indicator) DO UPDATE SET count = count + 1
+    ''', [(user_id, day, indicator) for indicator in depression_indicators])
+
+def rebuild_daily_stats(cursor, user_id=None):
+    """Tính lại bảng tổng hợp theo ngày từ chat_history và các file lưu trữ (toàn bộ hoặc một user)"""
+    user_filter = 'WHERE user_id = ?' if user_id is not None else ''
+    params = (user_id,) if user_id is not None else ()
+
+    cursor.execute(f'DELETE FROM user_daily_stats {user_filter}', params)
+    cursor.execute(f'DELETE FROM user_daily_indicators {user_filter}', params)
+    with _chat_history_source(cursor, user_id) as source:
+        cursor.execute(f'''
+            INSERT INTO user_daily_stats (user_id, day, chat_count, sentiment_sum, sentiment_sq_sum, sentiment_min, sentiment_max)
+            SELECT user_id, date(timestamp), COUNT(*),
+                   SUM(COALESCE(sentiment_score, 0)), SUM(COALESCE(sentiment_score, 0) * COALESCE(sentiment_score, 0)),
+                   MIN(COALESCE(sentiment_score, 0)), MAX(COALESCE(sentiment_score, 0))
+            FROM {source} {user_filter}
+            GROUP BY user_id, date(timestamp)
+        ''', params)
+        cursor.execute(f'''
+            INSERT INTO user_daily_indicators (user_id, day, indicator, count)
+            SELECT chat_history.user_id, date(chat_history.timestamp), indicator.value, COUNT(*)
+            FROM {source}, json_each(
+                CASE WHEN json_valid(chat_history.depression_indicators) THEN chat_history.depression_indicators ELSE '[]' END
+            ) AS indicator
+            {user_filter.replace('user_id', 'chat_history.user_id')}
+            GROUP BY chat_history.user_id, date(chat_history.timestamp), indicator.value
+        ''', params)
+
+def get_daily_stats(user_id, since_day):
+    """Đọc các bucket ngày của user từ since_day (YYYY-MM-DD), mới nhất trước"""
+    with database.cursor() as cursor:
+        days = cursor.execute('''
+            SELECT day, chat_count, sentiment_sum, sentiment_sq_sum, sentiment_min, sentiment_max
+            FROM user_daily_stats
+            WHERE user_id = ? AND day >= ?
+            ORDER BY day DESC
+        ''', (user_id, since_day)).fetchall()
+        indicators = cursor.execute('''
+            SELECT indicator, SUM(count) FROM user_daily_indicators
+            WHERE user_id = ? AND day >= ?
+            GROUP BY indicator
+        ''', (user_id, since_day)).fetchall()
+    return days, dict(indicators)
+
+def rollup_daily_stats(days, granularity='day'):
+    """Gộp các bucket ngày thành chuỗi theo ngày/tuần/tháng (cũ nhất trước)"""
+    def _period(day):
+        if granularity == 'week':
+            year, week, _ = datetime.strptime(day, '%Y-%m-%d').isocalendar()
+            return f'{year}-W{week:02d}'
+        if granularity == 'month':
+            return day[:7]
+        return day
+
+    periods = OrderedDict()
+    for day, count, total, sq_total, low, high in sorted(days):
+        bucket = periods.setdefault(_period(day), [0, 0.0, 0.0, low, high])
+        bucket[0] += count
+        bucket[1] += total
+        bucket[2] += sq_total
+        bucket[3] = min(bucket[3], low)
+        bucket[4] = max(bucket[4], high)
+
+    series = []
+    for period, (count, total, sq_total, low, high) in periods.items():
+        mean = total / count
+        series.append({
+            'period': period,
+            'chat_count': count,
+            'avg_sentiment': round(mean, 3),
+            'std_sentiment': round(max(sq_total / count - mean * mean, 0) ** 0.5, 3),
+            'min_sentiment': low,
+            'max_sentiment': high
+        })
+    return series
+
+# Chuỗi thời gian tâm trạng: mỗi điểm là epoch (float64) + điểm cảm xúc (float32) + bitmask dấu hiệu (uint16)
+MOOD_SERIES_CAPACITY = int(os.getenv('MOOD_SERIES_CAPACITY', '4096'))
+# Thứ tự bit được lưu xuống database: chỉ thêm danh mục mới vào cuối
+MOOD_INDICATOR_BITS = (
+    'sleep_problems', 'appetite_changes', 'energy_loss', 'concentration_issues',
+    'hopelessness', 'guilt_shame', 'social_withdrawal', 'suicidal_thoughts'
+)
+_MOOD_INDICATOR_INDEX = {name: bit for bit, name in enumerate(MOOD_INDICATOR_BITS)}
+
+def indicators_to_mask(depression_indicators):
+    mask = 0
+    for indicator in depression_indicators:
+        bit = _MOOD_INDICATOR_INDEX.get(indicator)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+def mask_to_indicators(mask):
+    return [name for bit, name in enumerate(MOOD_INDICATOR_BITS) if mask >> bit & 1]
+
+def _pack_mood_array(typecode, values):
+    packed = array(typecode, values)
+    # Lưu theo little-endian để file database dùng được trên mọi máy
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def _unpack_mood_array(typecode, blob):
+    unpacked = array(typecode)
+    unpacked.frombytes(blob[:len(blob) - len(blob) % unpacked.itemsize])
+    if sys.byteorder == 'big':
+        unpacked.byteswap()
+    return unpacked
+
+# Chuỗi tâm trạng của một user (cũ nhất trước), hỗ trợ lọc theo khoảng thời gian và gộp theo giờ/ngày
+class MoodSeries:
+    def __init__(self, times=None, scores=None, masks=None):
+        self.times = times if times is not None else array('d')
+        self.scores = scores if scores is not None else array('f')
+        self.masks = masks if masks is not None else array('H')
+        size = min(len(self.times), len(self.scores), len(self.masks))
+        del self.times[size:], self.scores[size:], self.masks[size:]
+        # Các lượt ghi đồng thời có thể nối lệch thứ tự vài giây: sắp lại để tìm kiếm nhị phân
+        times = np.frombuffer(self.times, dtype=np.float64) if size else np.empty(0)
+        if size > 1 and (np.diff(times) < 0).any():
+            order = np.argsort(times, kind='stable')
+            self.times = array('d', times[order].tolist())
+            self.scores = array('f', np.frombuffer(self.scores, dtype=np.float32)[order].tolist())
+            self.masks = array('H', np.frombuffer(self.masks, dtype=np.uint16)[order].tolist())
+
+    def __len__(self):
+        return len(self.times)
+
+    def nbytes(self):
+        return sum(values.itemsize * len(values) for values in (self.times, self.scores, self.masks))
+
+    def _window(self, since=None, until=None):
+        times = np.frombuffer(self.times, dtype=np.float64) if len(self.times) else np.empty(0)
+        start = int(np.searchsorted(times, since, 'left')) if since is not None else 0
+        end = int(np.searchsorted(times, until, 'right')) if until is not None else len(times)
+        return (
+            times[start:end],
+            np.frombuffer(self.scores, dtype=np.float32)[start:end] if end > start else np.empty(0, np.float32),
+            np.frombuffer(self.masks, dtype=np.uint16)[start:end] if end > start else np.empty(0, np.uint16)
+        )
+
+    @staticmethod
+    def _iso(epoch):
+        return datetime.utcfromtimestamp(round(epoch)).isoformat(timespec='seconds')
+
+    def points(self, since=None, until=None):
+        """Các điểm gốc trong [since, until]"""
+        times, scores, masks = self._window(since, until)
+        return [
+            {'timestamp': self._iso(t), 'sentiment': round(float(score), 4), 'indicators': mask_to_indicators(int(mask))}
+            for t, score, mask in zip(times.tolist(), scores, masks)
+        ]
+
+    def downsample(self, bucket_seconds, since=None, until=None):
+        """Trung bình/min/max theo bucket thời gian (căn theo UTC); dấu hiệu là hợp của các điểm trong bucket"""
+        times, scores, masks = self._window(since, until)
+        if not len(times):
+            return []
+        buckets = (times // bucket_seconds).astype(np.int64)
+        keys, starts, counts = np.unique(buckets, return_index=True, return_counts=True)
+        scores = scores.astype(np.float64)
+        sums = np.add.reduceat(scores, starts)
+        lows = np.minimum.reduceat(scores, starts)
+        highs = np.maximum.reduceat(scores, starts)
+        merged = np.bitwise_or.reduceat(masks, starts)
+        return [
+            {
+                'timestamp': self._iso(int(key) * bucket_seconds),
+                'count': int(count),
+                'sentiment': round(float(total / count), 4),
+                'min_sentiment': round(float(low), 4),
+                'max_sentiment': round(float(high), 4),
+                'indicators': mask_to_indicators(int(mask))
+            }
+            for key, count, total, low, high, mask in zip(keys, counts, sums, lows, highs, merged)
+        ]
+
+def append_mood_point(cursor, user_id, epoch, sentiment_score, depression_indicators):
+    """Nối một điểm vào chuỗi của user ngay trong SQLite; chỉ giữ MOOD_SERIES_CAPACITY điểm mới nhất (ring buffer)"""
+    cursor.execute('''
+        INSERT INTO mood_series (user_id, times, scores, masks) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            times = substr(CAST(times || excluded.times AS BLOB), -?),
+            scores = substr(CAST(scores || excluded.scores AS BLOB), -?),
+            masks = substr(CAST(masks || excluded.masks AS BLOB), -?)
+    ''', (
+        user_id,
+        _pack_mood_array('d', [epoch]),
+        _pack_mood_array('f', [sentiment_score]),
+        _pack_mood_array('H', [indicators_to_mask(depression_indicators)]),
+        MOOD_SERIES_CAPACITY * 8, MOOD_SERIES_CAPACITY * 4, MOOD_SERIES_CAPACITY * 2
+    ))
+
+def rebuild_mood_series(cursor, user_id=None):
+    """Dựng lại chuỗi tâm trạng từ chat_history và các file lưu trữ (toàn bộ hoặc một user)"""
+    user_filter = 'AND user_id = ?' if user_id is not None else ''
+    params = (user_id,) if user_id is not None else ()
+    cursor.execute(f"DELETE FROM mood_series WHERE 1 = 1 {user_filter}", params)
+
+    def _flush(current, times, scores, masks):
+        cursor.execute('INSERT INTO mood_series (user_id, times, scores, masks) VALUES (?, ?, ?, ?)', (
+            current,
+            _pack_mood_array('d', times[-MOOD_SERIES_CAPACITY:]),
+            _pack_mood_array('f', scores[-MOOD_SERIES_CAPACITY:]),
+            _pack_mood_array('H', masks[-MOOD_SERIES_CAPACITY:])
+        ))
+
+    with _chat_history_source(cursor, user_id) as source:
+        # Đọc bằng cursor riêng để vừa duyệt vừa ghi mà không phải nạp cả bảng vào bộ nhớ
+        reader = cursor.connection.execute(f'''
+            SELECT user_id, ROUND((julianday(timestamp) - 2440587.5) * 86400.0, 3), COALESCE(sentiment_score, 0), depression_indicators
+            FROM {source}
+            WHERE user_id IS NOT NULL AND julianday(timestamp) IS NOT NULL {user_filter}
+            ORDER BY user_id, 2, id
+        ''', params)
+        current, times, scores, masks = None, [], [], []
+        for row_user_id, epoch, sentiment_score, depression_indicators in reader:
+            if row_user_id != current:
+                if times:
+                    _flush(current, times, scores, masks)
+                current, times, scores, masks = row_user_id, [], [], []
+            try:
+                indicators = json.loads(depression_indicators or '[]')
+            except ValueError:
+                indicators = []
+            times.append(epoch)
+            scores.append(sentiment_score)
+            masks.append(indicators_to_mask(indicators))
+        if times:
+            _flush(current, times, scores, masks)
+
+def load_mood_series(user_id):
+    with database.cursor() as cursor:
+        row = cursor.execute('SELECT times, scores, masks FROM mood_series WHERE user_id = ?', (user_id,)).fetchone()
+    if row is None:
+        return MoodSeries()
+    times, scores, masks = row
+    return MoodSeries(_unpack_mood_array('d', times), _unpack_mood_array('f', scores), _unpack_mood_array('H', masks))
+
+def get_schema_version():
+    with database.cursor() as cursor:
+        return cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations').fetchone()[0]
+
+# Lưu trữ phân tầng: chat_history cũ hơn RETENTION_DAYS được chuyển (theo trọn tháng) sang file gzip NDJSON
+# trong ARCHIVE_DIR. Mỗi file là nhiều gzip member nối nhau, một member cho các dòng của một user (zcat đọc được cả file),
+# manifest chat_archives/chat_archive_segments ghi vị trí từng member để đọc riêng lịch sử một user.
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '180'))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_COLUMNS = ('id', 'user_id', 'timestamp', 'message', 'response', 'sentiment_score', 'depression_indicators')
+ARCHIVE_READ_SIZE = 1 << 16
+
+def _archive_row_to_json(row):
+    record = dict(zip(ARCHIVE_COLUMNS, row))
+    try:
+        record['depression_indicators'] = json.loads(record['depression_indicators'] or '[]')
+    except ValueError:
+        pass
+    return json.dumps(record, ensure_ascii=False)
+
+def _archive_row_from_json(line):
+    record = json.loads(line)
+    indicators = record['depression_indicators']
+    if not isinstance(indicators, str):
+        record['depression_indicators'] = json.dumps(indicators)
+    return tuple(record[column] for column in ARCHIVE_COLUMNS)
+
+def _archive_sort_key(row):
+    # Thứ tự trong file lưu trữ: user_id, timestamp, id
+    return row[1], row[2], row[0]
+
+def _read_archive_segment(path, byte_offset, byte_length):
+    """Giải nén một gzip member theo từng khối, trả về từng dòng"""
+    decompressor = zlib.decompressobj(31)
+    pending = b''
+    with open(path, 'rb') as f:
+        f.seek(byte_offset)
+        remaining = byte_length
+        while remaining:
+            block = f.read(min(ARCHIVE_READ_SIZE, remaining))
+            if not block:
+                raise IOError(f"File lưu trữ bị thiếu dữ liệu: {path}")
+            remaining -= len(block)
+            pending += decompressor.decompress(block)
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                if line:
+                    yield _archive_row_from_json(line)
+    pending += decompressor.flush()
+    for line in pending.split(b'\n'):
+        if line:
+            yield _archive_row_from_json(line)
+
+def iter_archived_rows(user_id=None, since=None, until=None, month=None, cursor=None):
+    """Duyệt các dòng đã lưu trữ (theo cột ARCHIVE_COLUMNS), lọc theo user/tháng và timestamp since/until"""
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append('segments.user_id = ?')
+        params.append(user_id)
+    if month is not None:
+        conditions.append('segments.month = ?')
+        params.append(month)
+    # Bỏ qua cả segment nằm ngoài khoảng thời gian mà không cần giải nén
+    if since is not None:
+        conditions.append('segments.last_timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('segments.first_timestamp <= ?')
+        params.append(until)
+    query = f'''
+        SELECT archives.path, segments.byte_offset, segments.byte_length
+        FROM chat_archive_segments AS segments JOIN chat_archives AS archives ON archives.month = segments.month
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY segments.month, segments.byte_offset
+    '''
+    # Trong transaction đang mở (dựng lại bảng tổng hợp) phải dùng cursor của transaction đó
+    if cursor is not None:
+        segments = cursor.execute(query, params).fetchall()
+    else:
+        with database.cursor() as own_cursor:
+            segments = own_cursor.execute(query, params).fetchall()
+
+    for path, byte_offset, byte_length in segments:
+        for row in _read_archive_segment(os.path.join(ARCHIVE_DIR, path), byte_offset, byte_length):
+            if (since is None or row[2] >= since) and (until is None or row[2] <= until):
+                yield row
+
+@contextmanager
+def _chat_history_source(cursor, user_id=None):
+    """Nguồn dữ liệu cho các hàm dựng lại: chat_history, cộng các dòng đã lưu trữ (nạp tạm vào bảng TEMP) nếu có"""
+    user_filter = 'WHERE user_id = ?' if user_id is not None else ''
+    params = (user_id,) if user_id is not None else ()
+    has_manifest = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_archive_segments'"
+    ).fetchone()
+    if not has_manifest or not cursor.execute(f'SELECT 1 FROM chat_archive_segments {user_filter} LIMIT 1', params).fetchone():
+        yield 'chat_history'
+        return
+
+    cursor.execute('''
+        CREATE TEMP TABLE archived_chat_history (
+            id INTEGER, user_id TEXT, timestamp TEXT, message TEXT, response TEXT,
+            sentiment_score REAL, depression_indicators TEXT
+        )
+    ''')
+    try:
+        rows = iter_archived_rows(user_id, cursor=cursor)
+        while True:
+            chunk = list(itertools.islice(rows, 1000))
+            if not chunk:
+                break
+            cursor.executemany('INSERT INTO temp.archived_chat_history VALUES (?, ?, ?, ?, ?, ?, ?)', chunk)
+        columns = 'id, user_id, message, response, sentiment_score, depression_indicators, timestamp'
+        yield f'''(
+            SELECT {columns} FROM main.chat_history
+            UNION ALL SELECT {columns} FROM temp.archived_chat_history
+        ) AS chat_history'''
+    finally:
+        cursor.execute('DROP TABLE temp.archived_chat_history')
+
+def _write_archive_month(month, rows):
+    """Ghi các dòng (đã sắp theo user_id, timestamp, id) ra file lưu trữ mới của tháng; trả về thông tin cho manifest"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    # Tên mới cho mỗi lần ghi: manifest cũ vẫn trỏ đúng file cũ tới khi transaction cập nhật commit
+    name = f'chat_history_{month}.{int(time.time() * 1000)}.ndjson.gz'
+    tmp_path = os.path.join(ARCHIVE_DIR, name + '.tmp')
+    digest = hashlib.sha256()
+    segments = []
+    total = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            def _write(data):
+                f.write(data)
+                digest.update(data)
+
+            for user_id, group in itertools.groupby(rows, key=lambda row: row[1]):
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                start = f.tell()
+                count, first, last = 0, None, None
+                for row in group:
+                    _write(compressor.compress((_archive_row_to_json(row) + '\n').encode('utf-8')))
+                    count += 1
+                    first = row[2] if first is None else first
+                    last = row[2]
+                _write(compressor.flush())
+                segments.append((user_id, month, start, f.tell() - start, count, first, last))
+                total += count
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, os.path.join(ARCHIVE_DIR, name))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {'path': name, 'rows': total, 'bytes': size, 'sha256': digest.hexdigest(), 'segments': segments}
+
+def _commit_archive_month(month, written, delete_range=None):
+    """Thay manifest của tháng (và xoá các dòng đã chuyển khỏi chat_history) trong một transaction, rồi bỏ file cũ"""
+    with database.cursor() as cursor:
+        cursor.execute('BEGIN')
+        previous = cursor.execute('SELECT path FROM chat_archives WHERE month = ?', (month,)).fetchone()
+        cursor.execute('DELETE FROM chat_archive_segments WHERE month = ?', (month,))
+        cursor.executemany('''
+            INSERT INTO chat_archive_segments (user_id, month, byte_offset, byte_length, rows, first_timestamp, last_timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', written['segments'])
+        cursor.execute('''
+            INSERT INTO chat_archives (month, path, rows, bytes, sha256, created_at) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (month) DO UPDATE SET
+                path = excluded.path, rows = excluded.rows, bytes = excluded.bytes,
+                sha256 = excluded.sha256, created_at = excluded.created_at
+        ''', (month, written['path'], written['rows'], written['bytes'], written['sha256']))
+        if delete_range is not None:
+            cursor.execute('''
+                DELETE FROM chat_history
+                WHERE timestamp >= ? AND timestamp < ? AND user_id IS NOT NULL AND id <= ?
+            ''', delete_range)
+    if previous is not None and previous[0] != written['path']:
+        try:
+            os.remove(os.path.join(ARCHIVE_DIR, previous[0]))
+        except OSError:
+            pass
+
+def _month_bounds(month):
+    year, month_number = map(int, month.split('-'))
+    return f'{month}-01', f'{year + month_number // 12:04d}-{month_number % 12 + 1:02d}-01'
+
+def archive_month(month):
+    """Chuyển các dòng chat_history của một tháng (YYYY-MM) sang file lưu trữ, gộp với phần đã lưu trữ trước đó"""
+    database.flush()
+    start, end = _month_bounds(month)
+    with database.cursor() as cursor:
+        max_id = cursor.execute(
+            'SELECT MAX(id) FROM chat_history WHERE timestamp >= ? AND timestamp < ? AND user_id IS NOT NULL', (start, end)
+        ).fetchone()[0]
+    if max_id is None:
+        return 0
+
+    def _hot_rows():
+        # Kết nối đọc riêng: duyệt theo thứ tự file lưu trữ mà không nạp cả tháng vào bộ nhớ
+        with database.reader() as conn:
+            yield from conn.execute(f'''
+                SELECT {', '.join(ARCHIVE_COLUMNS)} FROM chat_history
+                WHERE timestamp >= ? AND timestamp < ? AND user_id IS NOT NULL AND id <= ?
+                ORDER BY user_id, timestamp, id
+            ''', (start, end, max_id))
+
+    moved = 0
+    def _count(rows):
+        nonlocal moved
+        for row in rows:
+            moved += 1
+            yield row
+
+    written = _write_archive_month(month, heapq.merge(
+        iter_archived_rows(month=month), _count(_hot_rows()), key=_archive_sort_key
+    ))
+    _commit_archive_month(month, written, delete_range=(start, end, max_id))
+    return moved
+
+def rewrite_archive_month(month, transform):
+    """Ghi lại file lưu trữ của một tháng sau khi biến đổi các dòng (transform nhận và trả về iterator theo cùng thứ tự)"""
+    written = _write_archive_month(month, transform(iter_archived_rows(month=month)))
+    _commit_archive_month(month, written)
+    return written['rows']
+
+def cleanup_orphan_archives():
+    """Xoá file tạm và các bản cũ của những tháng đã có trong manifest (bị bỏ lại khi tiến trình dừng giữa chừng)"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return 0
+    with database.cursor() as cursor:
+        known = dict(cursor.execute('SELECT month, path FROM chat_archives').fetchall())
+    removed = 0
+    for name in os.listdir(ARCHIVE_DIR):
+        match = re.fullmatch(r'chat_history_(\d{4}-\d{2})\.\d+\.ndjson\.gz(\.tmp)?', name)
+        # Không đụng tới file của tháng chưa có trong manifest (có thể thuộc database khác dùng chung thư mục)
+        if match and (match.group(2) or (match.group(1) in known and known[match.group(1)] != name)):
+            os.remove(os.path.join(ARCHIVE_DIR, name))
+            removed += 1
+    return removed
+
+def archive_stats():
+    with database.cursor() as cursor:
+        months, rows, size = cursor.execute(
+            'SELECT COUNT(*), COALESCE(SUM(rows), 0), COALESCE(SUM(bytes), 0) FROM chat_archives'
+        ).fetchone()
+    return {'months': months, 'rows': rows, 'bytes': size}
 
 # Khởi tạo database
 init_database()
 
-# Load PhoBERT model để phân tích sentiment và nội dung tiếng Việt
+# Tên các model transformer dùng cho tiếng Việt
+PHOBERT_MODEL_NAME = os.getenv('PHOBERT_MODEL_NAME', 'vinai/phobert-base')
+SENTIMENT_MODEL_NAME = os.getenv('SENTIMENT_MODEL_NAME', 'cardiffnlp/twitter-roberta-base-sentiment-latest')
+PHOBERT_MAX_LENGTH = 256  # PhoBERT chỉ có 258 vị trí embedding
+
+# Backend suy luận transformer trên CPU: 'fp32' hoặc 'int8' (lượng tử hoá động các lớp Linear)
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'fp32')
+# Số token tối đa mỗi văn bản; tin nhắn dài hơn bị cắt (có thống kê trong /health)
+INFERENCE_MAX_LENGTH = max(8, min(int(os.getenv('INFERENCE_MAX_LENGTH', str(PHOBERT_MAX_LENGTH))), PHOBERT_MAX_LENGTH))
+# Số thread torch mỗi worker (0 = chia đều số CPU cho số worker gunicorn)
+TORCH_NUM_THREADS = int(os.getenv('TORCH_NUM_THREADS', '0'))
+
+# Backend chấm điểm sentiment: 'keyword' (tỉ lệ từ khoá) hoặc 'tfidf_lr' (model học từ chat_history)
+SENTIMENT_BACKEND = os.getenv('SENTIMENT_BACKEND', 'keyword')
+SENTIMENT_MODEL_DIR = os.getenv('SENTIMENT_MODEL_DIR', 'models')
+SENTIMENT_MODEL_MANIFEST = os.path.join(SENTIMENT_MODEL_DIR, 'sentiment_tfidf_lr.json')
+
+# Cấu hình gom batch cho suy luận PhoBERT
+PHOBERT_BATCH_SIZE = int(os.getenv('PHOBERT_BATCH_SIZE', '16'))
+PHOBERT_BATCH_WAIT_MS = float(os.getenv('PHOBERT_BATCH_WAIT_MS', '10'))
+
+# Cấu hình cache kết quả phân tích (mặc định chỉ cache trong bộ nhớ; đặt ANALYSIS_CACHE_DB để bật tầng SQLite)
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv('ANALYSIS_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+ANALYSIS_CACHE_DB = os.getenv('ANALYSIS_CACHE_DB', '')
+# Số kết quả mới gom lại trước mỗi lần ghi xuống tầng SQLite
+ANALYSIS_CACHE_WRITE_BATCH = int(os.getenv('ANALYSIS_CACHE_WRITE_BATCH', '64'))
+
+def _current_rss_bytes():
+    """Đọc bộ nhớ RSS hiện tại của tiến trình (byte)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _memory_usage():
+    """RSS, PSS và phần bộ nhớ chia sẻ/riêng của tiến trình (byte), đọc từ /proc/self/smaps_rollup"""
+    usage = {'rss': _current_rss_bytes()}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                    usage[key.lower()] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass  # Không phải Linux hoặc kernel cũ: chỉ có RSS
+    return usage
+
+# Registry quản lý các model nặng: chỉ tải khi dùng lần đầu
+class ModelRegistry:
+    def __init__(self):
+        self._loaders = {}
+        self._locks = {}
+        self._models = {}
+        self._stats = {}
+
+    def register(self, name, loader):
+        """Đăng ký hàm tải model, chưa tải ngay"""
+        self._loaders[name] = loader
+        self._locks[name] = threading.Lock()
+        self._stats[name] = {'status': 'not_loaded', 'load_seconds': None, 'rss_delta_mb': None, 'error': None}
+
+    def get(self, name):
+        """Lấy model, tải nếu chưa có (an toàn khi nhiều thread cùng gọi)"""
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._locks[name]:
+            if name in self._models:
+                return self._models[name]
+
+            stats = self._stats[name]
+            stats['status'] = 'loading'
+            rss_before = _current_rss_bytes()
+            start = time.perf_counter()
+            try:
+                model = self._loaders[name]()
+            except Exception as e:
+                stats['status'] = 'error'
+                stats['error'] = str(e)
+                logger.error(f"Lỗi tải model {name}: {e}")
+                raise
+
+            stats['load_seconds'] = round(time.perf_counter() - start, 3)
+            # Ước lượng theo RSS, có thể lệch nếu nhiều model tải song song
+            stats['rss_delta_mb'] = round((_current_rss_bytes() - rss_before) / (1024 * 1024), 1)
+            stats['status'] = 'loaded'
+            stats['error'] = None
+            self._models[name] = model
+            logger.info(f"Đã tải model {name} trong {stats['load_seconds']}s (+{stats['rss_delta_mb']} MB)")
+            return model
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def names(self):
+        return list(self._loaders)
+
+    def warm_up(self, names=None):
+        """Tải trước các model trong thread nền, không chặn request"""
+        names = [n for n in (names or list(self._loaders)) if n in self._loaders]
+
+        def _warm():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception:
+                    pass  # Lỗi đã được ghi log, request sau sẽ thử tải lại
+
+        thread = threading.Thread(target=_warm, name='model-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        return {name: dict(stats) for name, stats in self._stats.items()}
+
+_torch_configured = False
+
+def _configure_torch():
+    """Đặt số thread torch một lần cho tiến trình, tránh các worker tranh nhau CPU"""
+    global _torch_configured
+    if _torch_configured:
+        return
+    import torch
+
+    threads = TORCH_NUM_THREADS
+    if threads <= 0:
+        workers = int(os.getenv('GUNICORN_WORKERS', os.getenv('WEB_CONCURRENCY', '1')) or 1)
+        threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Chỉ đặt được trước khi torch chạy song song lần đầu
+    _torch_configured = True
+    logger.info(f"Torch dùng {threads} thread, backend suy luận {INFERENCE_BACKEND}")
+
+def _prepare_for_inference(module):
+    """Chuyển model sang chế độ suy luận; với backend int8 lượng tử hoá động các lớp Linear"""
+    import torch
+
+    _configure_torch()
+    module.eval()
+    module.requires_grad_(False)
+    if INFERENCE_BACKEND == 'int8':
+        module = torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif INFERENCE_BACKEND != 'fp32':
+        raise ValueError(f"INFERENCE_BACKEND không hợp lệ: {INFERENCE_BACKEND} (fp32 hoặc int8)")
+    return module
+
+def _load_phobert_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(PHOBERT_MODEL_NAME)
+
+def _load_phobert_model():
+    from transformers import AutoModel
+    return _prepare_for_inference(AutoModel.from_pretrained(PHOBERT_MODEL_NAME))
+
+def _load_sentiment_pipeline():
+    from transformers import pipeline
+    analyzer = pipeline("sentiment-analysis", model=SENTIMENT_MODEL_NAME)
+    analyzer.model = _prepare_for_inference(analyzer.model)
+    return analyzer
+
+# Model sentiment TF-IDF + LogisticRegression: rẻ trên CPU, chấm điểm theo batch
+class TfidfSentimentModel:
+    LABELS = (-1, 0, 1)
+
+    def __init__(self, vectorizer, classifier, version, metadata=None):
+        self.vectorizer = vectorizer
+        self.classifier = classifier
+        self.version = version
+        self.metadata = metadata or {}
+
+    def predict_proba(self, texts):
+        """Xác suất của các nhãn (-1, 0, 1) cho từng văn bản, dạng mảng (n, 3)"""
+        features = self.vectorizer.transform([normalize_text(text) for text in texts])
+        probabilities = self.classifier.predict_proba(features)
+        # Sắp cột theo LABELS kể cả khi dữ liệu huấn luyện thiếu nhãn nào đó
+        ordered = np.zeros((len(texts), len(self.LABELS)))
+        for column, label in enumerate(self.classifier.classes_):
+            ordered[:, self.LABELS.index(int(label))] = probabilities[:, column]
+        return ordered
+
+    def scores(self, texts):
+        """Điểm sentiment trong [-1, 1] = P(tích cực) - P(tiêu cực)"""
+        probabilities = self.predict_proba(texts)
+        return probabilities[:, 2] - probabilities[:, 0]
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'sentiment_tfidf_lr-{self.version}.pkl')
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Manifest trỏ tới artifact mới nhất, đọc được mà không cần tải model
+        with open(os.path.join(directory, 'sentiment_tfidf_lr.json'), 'w', encoding='utf-8') as f:
+            json.dump(dict(self.metadata, version=self.version, path=os.path.basename(path)), f, ensure_ascii=False, indent=2)
+        return path
+
+def _read_sentiment_manifest():
+    try:
+        with open(SENTIMENT_MODEL_MANIFEST, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _load_tfidf_sentiment_model():
+    manifest = _read_sentiment_manifest()
+    if manifest is None:
+        raise FileNotFoundError(f"Chưa có model sentiment đã huấn luyện ({SENTIMENT_MODEL_MANIFEST}), hãy chạy 'flask train-sentiment'")
+    with open(os.path.join(SENTIMENT_MODEL_DIR, manifest['path']), 'rb') as f:
+        return pickle.load(f)
+
+model_registry = ModelRegistry()
+model_registry.register('phobert_tokenizer', _load_phobert_tokenizer)
+model_registry.register('phobert_model', _load_phobert_model)
+model_registry.register('sentiment_pipeline', _load_sentiment_pipeline)
+model_registry.register('sentiment_tfidf_lr', _load_tfidf_sentiment_model)
+
+_warmup_started = False
+
+def start_model_warmup():
+    """Tải trước các model trong WARMUP_MODELS (vd: "phobert_tokenizer,phobert_model" hoặc "all")"""
+    global _warmup_started
+    if _warmup_started:
+        return None
+    _warmup_started = True
+
+    configured = os.getenv('WARMUP_MODELS', '').strip()
+    if not configured:
+        return None
+    names = None if configured == 'all' else [n.strip() for n in configured.split(',') if n.strip()]
+    logger.info(f"Bắt đầu tải trước model: {configured}")
+    return model_registry.warm_up(names)
+
+# Histogram với các bucket cố định, dùng để theo dõi độ trễ và kích thước batch
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def quantile(self, q):
+        """Ước lượng phân vị q bằng cận trên của bucket chứa nó"""
+        with self._lock:
+            counts, total = list(self._counts), self._count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            counts, total, value_sum = list(self._counts), self._count, self._sum
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+        return {'buckets': buckets, 'count': total, 'sum': value_sum}
+
+# Ngưỡng ghi log request chậm (ms) và bucket chung cho độ trễ
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '2000'))
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+# Đo thời gian từng request và từng giai đoạn xử lý vào histogram (mỗi lần đo chỉ tốn vài µs)
+class RequestTracer:
+    def __init__(self, slow_ms):
+        self.slow_ms = slow_ms
+        self.slow_requests = 0
+        self._request_hists = {}
+        self._stage_hists = {}
+        self._status_counts = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, table, key):
+        hist = table.get(key)
+        if hist is None:
+            with self._lock:
+                hist = table.setdefault(key, Histogram(LATENCY_BUCKETS))
+        return hist
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+    def record_stage(self, name, elapsed):
+        self._histogram(self._stage_hists, name).observe(elapsed)
+        # Ngoài request (thread nền, generator của stream) chỉ ghi vào histogram
+        if has_request_context() and 'trace_stages' in g:
+            g.trace_stages[name] = g.trace_stages.get(name, 0.0) + elapsed
+
+    def begin(self):
+        g.trace_start = time.perf_counter()
+        g.trace_stages = {}
+
+    def end(self, response):
+        start = g.pop('trace_start', None)
+        if start is None:
+            return response
+        # Với response dạng stream, đây là thời gian tới khi gửi header
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        self._histogram(self._request_hists, (request.method, route)).observe(elapsed)
+        key = (request.method, route, response.status_code)
+        with self._lock:
+            self._status_counts[key] = self._status_counts.get(key, 0) + 1
+            slow = elapsed * 1000 >= self.slow_ms
+            if slow:
+                self.slow_requests += 1
+        if slow:
+            logger.warning('slow_request ' + json.dumps({
+                'method': request.method,
+                'route': route,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(elapsed * 1000, 1),
+                'stages_ms': {name: round(value * 1000, 1) for name, value in g.trace_stages.items()}
+            }, ensure_ascii=False))
+        return response
+
+    def request_histograms(self):
+        with self._lock:
+            return sorted(self._request_hists.items())
+
+    def stage_histograms(self):
+        with self._lock:
+            return sorted(self._stage_hists.items())
+
+    def status_counts(self):
+        with self._lock:
+            return sorted(self._status_counts.items())
+
+tracer = RequestTracer(SLOW_REQUEST_MS)
+app.before_request(tracer.begin)
+app.after_request(tracer.end)
+
+# Bộ gom batch động: gom các yêu cầu đồng thời thành một lần suy luận
+class BatchingInferenceServer:
+    def __init__(self, infer_fn, max_batch_size=16, max_wait_ms=10, name='inference'):
+        self.infer_fn = infer_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self.batch_size_hist = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.queue_wait_hist = Histogram([0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0])
+        self.inference_hist = Histogram([0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0])
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        # Tạo lại thread sau khi fork (thread không được sao chép sang tiến trình con)
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=f'{self.name}-batcher', daemon=True)
+            self._thread.start()
+
+    def submit(self, item):
+        """Đưa một mục vào hàng đợi, trả về Future chứa kết quả"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def infer(self, item, timeout=None):
+        return self.submit(item).result(timeout)
+
+    def infer_many(self, items, timeout=None):
+        futures = [self.submit(item) for item in items]
+        return [future.result(timeout) for future in futures]
+
+    def _run(self):
+        work_queue = self._queue
+        while True:
+            first = work_queue.get()
+            batch = [first]
+            deadline = first[2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    # Hết thời gian chờ thì vẫn lấy nốt các mục đã có sẵn trong hàng đợi
+                    if remaining > 0:
+                        batch.append(work_queue.get(timeout=remaining))
+                    else:
+                        batch.append(work_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                self.queue_wait_hist.observe(started - enqueued)
+            self.batch_size_hist.observe(len(batch))
+
+            try:
+                results = run_blocking(self.infer_fn, [item for item, _, _ in batch])
+            except Exception as e:
+                logger.error(f"Lỗi suy luận batch {self.name}: {e}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                self.inference_hist.observe(time.perf_counter() - started)
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'pending': self._queue.qsize() if self._queue is not None else 0,
+            'batch_size': self.batch_size_hist.snapshot(),
+            'queue_wait_seconds': self.queue_wait_hist.snapshot(),
+            'inference_seconds': self.inference_hist.snapshot()
+        }
+
+def normalize_text(text):
+    """Chuẩn hoá văn bản trước khi so khớp: Unicode NFC + chữ thường"""
+    return unicodedata.normalize('NFC', text).lower()
+
+def _build_trie_regex(phrases):
+    """Ghép các cụm từ thành một regex dạng trie (các tiền tố chung chỉ so một lần)"""
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def _build(node):
+        branches = [re.escape(ch) + _build(child) for ch, child in sorted(node.items()) if ch != '']
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        body = '(?:' + '|'.join(branches) + ')'
+        # Nhánh dài được thử trước, nên mỗi vị trí luôn khớp cụm dài nhất
+        return body + '?' if '' in node else body
+
+    return _build(trie)
+
+class MatchResult:
+    """Kết quả so khớp: các vị trí (start, end, cụm từ) theo từng nhóm trên văn bản đã chuẩn hoá"""
+    __slots__ = ('spans',)
+
+    def __init__(self, spans):
+        self.spans = spans
+
+    def count(self, label):
+        """Số lần xuất hiện của các cụm từ trong nhóm"""
+        return len(self.spans.get(label, ()))
+
+    def distinct(self, label):
+        """Số cụm từ khác nhau của nhóm có xuất hiện"""
+        return len({phrase for _, _, phrase in self.spans.get(label, ())})
+
+    def has(self, label):
+        return label in self.spans
+
+    def to_dict(self):
+        return {
+            label: {'count': len(spans), 'spans': [list(span) for span in spans]}
+            for label, spans in self.spans.items()
+        }
+
+# Bộ so khớp biên dịch sẵn: tìm mọi từ khoá / dấu hiệu trong một lần quét văn bản
+class KeywordMatcher:
+    def __init__(self, groups):
+        self.groups = {label: list(phrases) for label, phrases in groups.items()}
+
+        labels_by_phrase = {}
+        for label, phrases in self.groups.items():
+            for phrase in phrases:
+                labels_by_phrase.setdefault(normalize_text(phrase), []).append(label)
+
+        # Cụm dài nhất khớp tại một vị trí kéo theo mọi cụm là tiền tố của nó,
+        # giữ đúng ngữ nghĩa "chuỗi con" của cách đếm cũ (vd "tự tin" chứa "tự ti")
+        self._hits_by_phrase = {
+            phrase: [(prefix, label) for prefix in labels_by_phrase if phrase.startswith(prefix)
+                     for label in labels_by_phrase[prefix]]
+            for phrase in labels_by_phrase
+        }
+        self._regex = re.compile('(?=(' + _build_trie_regex(labels_by_phrase) + '))')
+
+    def match(self, text):
+        """So khớp một văn bản, trả về MatchResult"""
+        spans = {}
+        hits_by_phrase = self._hits_by_phrase
+        for m in self._regex.finditer(normalize_text(text)):
+            start = m.start()
+            for phrase, label in hits_by_phrase[m.group(1)]:
+                spans.setdefault(label, []).append((start, start + len(phrase), phrase))
+        return MatchResult(spans)
+
+    def match_many(self, texts):
+        """So khớp một loạt văn bản"""
+        return [self.match(text) for text in texts]
+
+# Cache kết quả phân tích theo nội dung: LRU giới hạn byte trong bộ nhớ + tầng SQLite tuỳ chọn
+class AnalysisCache:
+    def __init__(self, max_bytes, db_path=None, write_batch=64):
+        self.max_bytes = max_bytes
+        self.db_path = db_path or None
+        self.write_batch = write_batch
+        self.version = ''
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        # Tầng SQLite có khoá riêng: đọc/ghi đĩa không chặn các lượt tra cache trong bộ nhớ
+        self._disk_lock = threading.Lock()
+        self._pending_writes = []
+        self._db = None
+        self._db_pid = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_errors = 0
+
+    def _disk(self):
+        # Mỗi tiến trình dùng một kết nối riêng (không dùng lại kết nối qua fork)
+        if not self.db_path:
+            return None
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=OFF')
+            self._db.execute('''
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    key TEXT PRIMARY KEY,
+                    version TEXT,
+                    value BLOB
+                )
+            ''')
+            self._db_pid = os.getpid()
+        return self._db
+
+    def set_version(self, version):
+        """Đổi phiên bản model/từ khoá: xoá toàn bộ kết quả cũ"""
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            self._entries.clear()
+            self._bytes = 0
+            self._pending_writes = []
+        if not self.db_path:
+            return
+        with self._disk_lock:
+            try:
+                db = self._disk()
+                db.execute('DELETE FROM analysis_cache WHERE version != ?', (version,))
+                db.commit()
+            except sqlite3.Error as e:
+                self.disk_errors += 1
+                logger.error(f"Lỗi dọn cache trên đĩa: {e}")
+
+    def make_key(self, kind, text):
+        return hashlib.sha256(f'{self.version}\x00{kind}\x00{text}'.encode('utf-8')).hexdigest()
+
+    def _store_memory(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def get_or_compute(self, kind, text, compute, cacheable=None):
+        """Trả về kết quả đã cache cho (kind, text) hoặc tính mới bằng compute() (chỉ lưu nếu cacheable(value))"""
+        key = self.make_key(kind, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        row = None
+        if self.db_path:
+            with self._disk_lock:
+                try:
+                    row = self._disk().execute('SELECT value FROM analysis_cache WHERE key = ?', (key,)).fetchone()
+                except sqlite3.Error as e:
+                    self.disk_errors += 1
+                    logger.error(f"Lỗi đọc cache trên đĩa: {e}")
+        if row is not None:
+            value = pickle.loads(row[0])
+            with self._lock:
+                self._store_memory(key, value, len(row[0]))
+                self.disk_hits += 1
+            return value
+
+        # Tính ngoài khoá để không chặn các thread khác
+        with self._lock:
+            self.misses += 1
+        value = compute()
+        if cacheable is not None and not cacheable(value):
+            return value
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        batch = None
+        with self._lock:
+            self._store_memory(key, value, len(blob))
+            if self.db_path:
+                self._pending_writes.append((key, self.version, blob))
+                if len(self._pending_writes) >= self.write_batch:
+                    batch, self._pending_writes = self._pending_writes, []
+        if batch:
+            self._write_disk(batch)
+        return value
+
+    def _write_disk(self, batch):
+        # Kết quả vẫn nằm trong bộ nhớ; ghi gộp nhiều mục trong một commit
+        with self._disk_lock:
+            try:
+                db = self._disk()
+                db.executemany('INSERT OR REPLACE INTO analysis_cache (key, version, value) VALUES (?, ?, ?)', batch)
+                db.commit()
+            except sqlite3.Error as e:
+                self.disk_errors += 1
+                logger.error(f"Lỗi ghi cache xuống đĩa: {e}")
+
+    def flush(self):
+        """Ghi các kết quả còn chờ xuống tầng SQLite"""
+        with self._lock:
+            batch, self._pending_writes = self._pending_writes, []
+        if batch:
+            self._write_disk(batch)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'version': self.version,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_errors': self.disk_errors,
+                'disk_enabled': bool(self.db_path),
+                'disk_pending_writes': len(self._pending_writes)
+            }
+
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_MAX_BYTES, ANALYSIS_CACHE_DB, ANALYSIS_CACHE_WRITE_BATCH)
+atexit.register(analysis_cache.flush)
+
+# Bộ xử lý NLP tiếng Việt, các model PhoBERT/RoBERTa được tải lười qua model_registry
 class VietnameseNLPProcessor:
     def __init__(self):
+        # Depression keywords và patterns
+        self.depression_keywords = [
+            'buồn', 'tuyệt vọng', 'chán nản', 'stress', 'lo lắng', 'cô đơn',
+            'mệt mỏi', 'không có ý nghĩa', 'thất vọng', 'trầm cảm', 'tự tử',
+            'khóc', 'mất ngủ', 'không ăn được', 'tự ti', 'vô dụng',
+            'không ai hiểu', 'cuộc sống khó khăn', 'áp lực', 'đau khổ'
+        ]
+
+        # Positive emotion keywords
+        self.positive_keywords = [
+            'vui vẻ', 'hạnh phúc', 'tích cực', 'hy vọng', 'yêu thương',
+            'thành công', 'tự tin', 'mạnh mẽ', 'biết ơn', 'sáng tạo'
+        ]
+
+        # Các cụm từ cho từng dấu hiệu trầm cảm
+        self.indicator_patterns = {
+            'sleep_problems': ['không ngủ được', 'mất ngủ', 'ngủ nhiều', 'ngủ không ngon'],
+            'appetite_changes': ['không ăn được', 'chán ăn', 'ăn nhiều', 'không có cảm giác đói'],
+            'energy_loss': ['mệt mỏi', 'kiệt sức', 'không có năng lượng', 'lười biếng'],
+            'concentration_issues': ['không tập trung', 'không thể suy nghĩ', 'trí nhớ kém'],
+            'hopelessness': ['tuyệt vọng', 'không có hy vọng', 'cuộc sống vô nghĩa'],
+            'guilt_shame': ['tự trách', 'cảm thấy tội lỗi', 'xấu hổ', 'tự ti'],
+            'social_withdrawal': ['cô đơn', 'không muốn gặp ai', 'tránh mọi người'],
+            'suicidal_thoughts': ['tự tử', 'chết đi', 'không muốn sống', 'kết thúc cuộc đời']
+        }
+
+        self.sentiment_backend = SENTIMENT_BACKEND
+        self.sentiment_fallbacks = 0
+        self._fallback_warned_at = 0.0
+        if self.sentiment_backend == 'tfidf_lr' and _read_sentiment_manifest() is None:
+            logger.warning(f"SENTIMENT_BACKEND=tfidf_lr nhưng chưa có model ({SENTIMENT_MODEL_MANIFEST}), tạm chấm bằng từ khoá")
+        self.rebuild_matcher()
+
+        # Thống kê độ dài chuỗi token đưa vào transformer
+        self.sequence_length_hist = Histogram([16, 32, 64, 128, 256])
+        self.inference_texts = 0
+        self.truncated_texts = 0
+        self._stats_lock = threading.Lock()
+
+        # Gom các yêu cầu embedding đồng thời thành batch PhoBERT
+        self.batcher = BatchingInferenceServer(
+            self.embed_batch,
+            max_batch_size=PHOBERT_BATCH_SIZE,
+            max_wait_ms=PHOBERT_BATCH_WAIT_MS,
+            name='phobert'
+        )
+
+        logger.info("Đã khởi tạo Vietnamese NLP Processor thành công")
+
+    @property
+    def phobert_tokenizer(self):
+        return model_registry.get('phobert_tokenizer')
+
+    @property
+    def phobert_model(self):
+        return model_registry.get('phobert_model')
+
+    @property
+    def sentiment_analyzer(self):
+        return model_registry.get('sentiment_pipeline')
+
+    @property
+    def learned_sentiment(self):
+        return model_registry.get('sentiment_tfidf_lr')
+
+    def _encode(self, tokenizer, texts):
+        """Token hoá có cắt theo INFERENCE_MAX_LENGTH và ghi nhận số văn bản bị cắt"""
+        # Cắt bớt ký tự trước để tin nhắn rất dài không làm tokenizer chạy lâu. Chỉ an toàn khi mỗi token ứng với
+        # không quá 16 ký tự (tính cả khoảng trắng): khi đó INFERENCE_MAX_LENGTH token đầu luôn nằm trong phần giữ lại.
+        # Subword BPE của PhoBERT hiếm khi dài hơn; văn bản bị cắt ở đây vẫn đủ token để chạm giới hạn bên dưới
+        texts = [text[:INFERENCE_MAX_LENGTH * 16] for text in texts]
+        encoded = tokenizer(texts, padding=True, truncation=True, max_length=INFERENCE_MAX_LENGTH, return_tensors='pt')
+        lengths = encoded['attention_mask'].sum(dim=1).tolist()
+        for length in lengths:
+            self.sequence_length_hist.observe(length)
+        # Chạm đúng giới hạn được tính là bị cắt (ước lượng, không cần token hoá lại toàn văn bản)
+        truncated = sum(1 for length in lengths if length >= INFERENCE_MAX_LENGTH)
+        # Gọi từ cả thread gom batch lẫn thread xử lý request
+        with self._stats_lock:
+            self.truncated_texts += truncated
+            self.inference_texts += len(lengths)
+        return encoded
+
+    def embed_batch(self, texts):
+        """Tính embedding PhoBERT (mean pooling) cho một batch văn bản đã padding"""
+        import torch
+
+        tokenizer = self.phobert_tokenizer
+        phobert = self.phobert_model
+        encoded = self._encode(tokenizer, texts)
+        with torch.inference_mode():
+            hidden = phobert(**encoded).last_hidden_state
+            mask = encoded['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            embeddings = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        return list(embeddings.numpy())
+
+    def classify_sentiment(self, texts):
+        """Chấm sentiment bằng pipeline RoBERTa; trả về danh sách {label: xác suất} cho mỗi văn bản"""
+        import torch
+
+        analyzer = self.sentiment_analyzer
+        encoded = self._encode(analyzer.tokenizer, texts)
+        with torch.inference_mode():
+            probabilities = torch.softmax(analyzer.model(**encoded).logits, dim=-1)
+        labels = analyzer.model.config.id2label
+        return [
+            {labels[index].lower(): round(float(value), 6) for index, value in enumerate(row)}
+            for row in probabilities.tolist()
+        ]
+
+    def inference_stats(self):
+        return {
+            'backend': INFERENCE_BACKEND,
+            'max_length': INFERENCE_MAX_LENGTH,
+            'texts': self.inference_texts,
+            'truncated': self.truncated_texts,
+            'sequence_length': self.sequence_length_hist.snapshot()
+        }
+
+    def embed(self, text, timeout=None):
+        """Lấy embedding PhoBERT của một văn bản qua bộ gom batch (có cache)"""
+        return analysis_cache.get_or_compute(
+            'phobert_embedding',
+            unicodedata.normalize('NFC', text),
+            lambda: self.batcher.infer(text, timeout)
+        )
+
+    def rebuild_matcher(self):
+        """Biên dịch lại bộ so khớp sau khi thay đổi danh sách từ khoá"""
+        self.matcher = KeywordMatcher({
+            'depression': self.depression_keywords,
+            'positive': self.positive_keywords,
+            **self.indicator_patterns
+        })
+
+        # Phiên bản phân tích: đổi từ khoá hoặc model thì cache cũ tự mất hiệu lực
+        learned_version = (_read_sentiment_manifest() or {}).get('version') if self.sentiment_backend == 'tfidf_lr' else None
+        fingerprint = json.dumps(
+            [self.matcher.groups, PHOBERT_MODEL_NAME, INFERENCE_BACKEND, INFERENCE_MAX_LENGTH, self.sentiment_backend, learned_version],
+            ensure_ascii=False, sort_keys=True
+        )
+        self.version = hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()[:16]
+        analysis_cache.set_version(self.version)
+
+    def keyword_score(self, text, depression_count, positive_count):
+        """Điểm sentiment theo tỉ lệ từ khoá tiêu cực/tích cực trên số từ"""
+        if depression_count > positive_count:
+            return -0.7 * (depression_count / len(text.split()))
+        elif positive_count > depression_count:
+            return 0.7 * (positive_count / len(text.split()))
+        return 0.0
+
+    def learned_scores(self, texts):
+        """Điểm của model tfidf_lr cho cả batch; None nếu model thiếu hoặc lỗi (khi đó chấm bằng từ khoá)"""
         try:
-            # Load PhoBERT model cho tiếng Việt
-            self.phobert_tokenizer = AutoTokenizer.from_pretrained("vinai/phobert-base")
-            self.phobert_model = AutoModel.from_pretrained("vinai/phobert-base")
-            
-            # Load Vietnamese sentiment analysis pipeline
-            self.sentiment_analyzer = pipeline(
-                "sentiment-analysis",
-                model="cardiffnlp/twitter-roberta-base-sentiment-latest"
-            )
-            
-            # Depression keywords và patterns
-            self.depression_keywords = [
-                'buồn', 'tuyệt vọng', 'chán nản', 'stress', 'lo lắng', 'cô đơn',
-                'mệt mỏi', 'không có ý nghĩa', 'thất vọng', 'trầm cảm', 'tự tử',
-                'khóc', 'mất ngủ', 'không ăn được', 'tự ti', 'vô dụng',
-                'không ai hiểu', 'cuộc sống khó khăn', 'áp lực', 'đau khổ'
-            ]
-            
-            # Positive emotion keywords
-            self.positive_keywords = [
-                'vui vẻ', 'hạnh phúc', 'tích cực', 'hy vọng', 'yêu thương',
-                'thành công', 'tự tin', 'mạnh mẽ', 'biết ơn', 'sáng tạo'
-            ]
-            
-            logger.info("Đã khởi tạo Vietnamese NLP Processor thành công")
+            # Chưa có model thì khỏi thử tải lại (và ghi log lỗi) ở mỗi tin nhắn
+            if not model_registry.is_loaded('sentiment_tfidf_lr') and _read_sentiment_manifest() is None:
+                raise FileNotFoundError(f"chưa có {SENTIMENT_MODEL_MANIFEST}")
+            return [float(score) for score in self.learned_sentiment.scores(texts)]
         except Exception as e:
-            logger.error(f"Lỗi khởi tạo Vietnamese NLP Processor: {e}")
-            raise
+            with self._stats_lock:
+                self.sentiment_fallbacks += 1
+            now = time.monotonic()
+            # Cảnh báo tối đa mỗi phút một lần để không tràn log khi model hỏng
+            if now - self._fallback_warned_at > 60:
+                self._fallback_warned_at = now
+                logger.warning(f"Model sentiment tfidf_lr không dùng được, tạm chấm bằng từ khoá: {e}")
+            return None
 
-    def analyze_sentiment(self, text):
-        """Phân tích cảm xúc của văn bản"""
+    def _analyze_sentiment(self, text, match=None, score=None):
+        """Như analyze_sentiment, kèm cờ cho biết kết quả là dự phòng (không được cache)"""
         try:
+            if match is None:
+                match = self.matcher.match(text)
+
             # Đếm từ khóa tiêu cực và tích cực
-            depression_count = sum(1 for keyword in self.depression_keywords if keyword in text.lower())
-            positive_count = sum(1 for keyword in self.positive_keywords if keyword in text.lower())
+            depression_count = match.distinct('depression')
+            positive_count = match.distinct('positive')
             
             # Tính điểm sentiment (-1 đến 1)
-            if depression_count > positive_count:
-                sentiment_score = -0.7 * (depression_count / len(text.split()))
-            elif positive_count > depression_count:
-                sentiment_score = 0.7 * (positive_count / len(text.split()))
+            degraded = False
+            if score is None and self.sentiment_backend == 'tfidf_lr':
+                scores = self.learned_scores([text])
+                if scores is None:
+                    degraded = True
+                else:
+                    score = scores[0]
+            if score is not None:
+                sentiment_score = float(score)
             else:
-                sentiment_score = 0.0
+                sentiment_score = self.keyword_score(text, depression_count, positive_count)
             
             # Đảm bảo điểm nằm trong khoảng [-1, 1]
             sentiment_score = max(-1, min(1, sentiment_score))
@@ -152,32 +1851,49 @@ class VietnameseNLPProcessor:
                 'depression_indicators': depression_count,
                 'positive_indicators': positive_count,
                 'analysis': 'negative' if sentiment_score < -0.3 else 'positive' if sentiment_score > 0.3 else 'neutral'
-            }
+            }, degraded
         except Exception as e:
             logger.error(f"Lỗi phân tích sentiment: {e}")
-            return {'score': 0, 'depression_indicators': 0, 'positive_indicators': 0, 'analysis': 'neutral'}
+            return {'score': 0, 'depression_indicators': 0, 'positive_indicators': 0, 'analysis': 'neutral'}, True
 
-    def extract_depression_indicators(self, text):
+    def analyze_sentiment(self, text, match=None, score=None):
+        """Phân tích cảm xúc của văn bản"""
+        return self._analyze_sentiment(text, match, score)[0]
+
+    def extract_depression_indicators(self, text, match=None):
         """Trích xuất các dấu hiệu trầm cảm từ văn bản"""
-        indicators = []
-        
-        # Patterns cho các dấu hiệu trầm cảm
-        patterns = {
-            'sleep_problems': r'(không ngủ được|mất ngủ|ngủ nhiều|ngủ không ngon)',
-            'appetite_changes': r'(không ăn được|chán ăn|ăn nhiều|không có cảm giác đói)',
-            'energy_loss': r'(mệt mỏi|kiệt sức|không có năng lượng|lười biếng)',
-            'concentration_issues': r'(không tập trung|không thể suy nghĩ|trí nhớ kém)',
-            'hopelessness': r'(tuyệt vọng|không có hy vọng|cuộc sống vô nghĩa)',
-            'guilt_shame': r'(tự trách|cảm thấy tội lỗi|xấu hổ|tự ti)',
-            'social_withdrawal': r'(cô đơn|không muốn gặp ai|tránh mọi người)',
-            'suicidal_thoughts': r'(tự tử|chết đi|không muốn sống|kết thúc cuộc đời)'
-        }
-        
-        for indicator, pattern in patterns.items():
-            if re.search(pattern, text.lower()):
-                indicators.append(indicator)
-        
-        return indicators
+        if match is None:
+            match = self.matcher.match(text)
+        return [indicator for indicator in self.indicator_patterns if match.has(indicator)]
+
+    def analyze_many(self, texts):
+        """Phân tích một loạt văn bản (không qua cache), dùng cho batch và chấm điểm lại"""
+        matches = self.matcher.match_many(texts)
+        # Model học được chấm cả batch trong một lần gọi; model lỗi thì chấm bằng từ khoá như analyze_text
+        scores = self.learned_scores(texts) if self.sentiment_backend == 'tfidf_lr' and texts else None
+        if scores is None:
+            scores = [self.keyword_score(text, match.distinct('depression'), match.distinct('positive')) for text, match in zip(texts, matches)]
+        return [
+            (self.analyze_sentiment(text, match, score), self.extract_depression_indicators(text, match))
+            for text, match, score in zip(texts, matches, scores)
+        ]
+
+    def analyze_text(self, text):
+        """Phân tích sentiment và dấu hiệu trầm cảm với một lần quét văn bản (có cache)"""
+        degraded = []
+
+        def _compute():
+            match = self.matcher.match(text)
+            sentiment_analysis, fallback = self._analyze_sentiment(text, match)
+            if fallback:
+                degraded.append(True)
+            return sentiment_analysis, self.extract_depression_indicators(text, match)
+
+        # Kết quả dự phòng (model lỗi) không được cache để lần sau chấm lại bằng model
+        sentiment_analysis, depression_indicators = analysis_cache.get_or_compute(
+            'analysis', normalize_text(text), _compute, cacheable=lambda value: not degraded
+        )
+        return dict(sentiment_analysis), list(depression_indicators)
 
 nlp_processor = VietnameseNLPProcessor()
 
@@ -294,60 +2010,784 @@ TÀI NGUYÊN KHẨN CẤP (khi phát hiện nguy cơ tự hại):
 HÃY TRẢ LỜI BẰNG TIẾNG VIỆT, SỬ DỤNG NGÔN NGỮ ẤM ÁP, DỄ HIỂU VÀ MANG TÍNH CHỮA LÀNH.
 """
 
-# Chọn model Gemini
+# Chọn model Gemini (system prompt truyền qua system_instruction thay vì một lượt "user" giả)
 MODEL_NAME = 'gemini-1.5-flash-latest'
+SUMMARY_MODEL_NAME = os.getenv('SUMMARY_MODEL_NAME', MODEL_NAME)
+def create_gemini_models():
+    return (
+        genai.GenerativeModel(MODEL_NAME, system_instruction=ENHANCED_SYSTEM_PROMPT),
+        genai.GenerativeModel(SUMMARY_MODEL_NAME)
+    )
+
 try:
-    model = genai.GenerativeModel(MODEL_NAME)
+    model, summary_model = create_gemini_models()
     logger.info(f"Đã khởi tạo model {MODEL_NAME} thành công")
 except Exception as e:
     logger.error(f"Lỗi khởi tạo model: {e}")
     raise
 
-# Lưu trữ lịch sử chat với context mở rộng
-chat_sessions = {}
+# Giới hạn số lời gọi Gemini đồng thời (Condition trở thành của gevent khi đã monkey-patch)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '32'))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '30'))
+
+# Mức ưu tiên khi chờ lượt gọi Gemini (số nhỏ được phục vụ trước)
+PRIORITY_CRISIS = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# Semaphore có hàng đợi ưu tiên: tin nhắn khủng hoảng được cấp lượt trước
+class PrioritySemaphore:
+    def __init__(self, value):
+        self._value = value
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def acquire(self, timeout=None, priority=PRIORITY_NORMAL):
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not (self._value > 0 and self._waiters[0] == ticket):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                    return False
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiters)
+            self._value -= 1
+            if self._value > 0:
+                self._cond.notify_all()
+            return True
+
+    def release(self):
+        with self._cond:
+            self._value += 1
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def waiting(self):
+        with self._cond:
+            return len(self._waiters)
+
+llm_semaphore = PrioritySemaphore(LLM_MAX_CONCURRENCY)
+
+class LLMBusyError(Exception):
+    """Không lấy được lượt gọi Gemini trong thời gian chờ"""
+
+# Cấu hình gọi Gemini: deadline, retry, hedging và circuit breaker
+GEMINI_DEADLINE = float(os.getenv('GEMINI_DEADLINE', '25'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '2'))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', '0.5'))
+GEMINI_HEDGE = os.getenv('GEMINI_HEDGE', '0') == '1'
+GEMINI_BREAKER_FAILURES = int(os.getenv('GEMINI_BREAKER_FAILURES', '5'))
+GEMINI_BREAKER_RESET = float(os.getenv('GEMINI_BREAKER_RESET', '30'))
+
+class GeminiUnavailableError(Exception):
+    """Gemini không phản hồi kịp hoặc circuit breaker đang mở"""
+
+# Các lỗi tạm thời, đáng để thử lại
+# Transport REST (chế độ gevent, server giả lập) báo lỗi mạng bằng ngoại lệ của requests,
+# không kế thừa ConnectionError/TimeoutError có sẵn; lỗi HTTP 5xx/429 được đổi sang google_exceptions
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    GeminiUnavailableError,
+    ConnectionError,
+    TimeoutError,
+    requests_exceptions.ConnectionError,
+    requests_exceptions.Timeout
+)
+
+# Circuit breaker: mở sau nhiều lỗi liên tiếp, cho một lời gọi thử sau thời gian chờ
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            # Lời gọi thử không báo kết quả trong reset_timeout: coi như thất bại, mở lại để thử lần sau
+            if self.state == 'half_open' and now - self._probe_started >= self.reset_timeout:
+                self.state = 'open'
+                self._opened_at = now
+            if self.state == 'open' and now - self._opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probe_started = now
+                return True
+            return self.state == 'closed'
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                    logger.warning("Circuit breaker Gemini chuyển sang trạng thái mở")
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+    def record_abandoned(self):
+        """Lời gọi kết thúc mà chưa biết Gemini ổn hay không (lỗi không retry, client ngắt kết nối): để lần sau thử lại"""
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+# Lớp bọc các lời gọi Gemini: deadline mỗi lời gọi, retry có jitter, hedging sau p95, circuit breaker
+class ResilientGeminiClient:
+    def __init__(self, deadline, max_retries, retry_base_delay, hedge, breaker):
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.hedge = hedge
+        self.breaker = breaker
+        self.latency_hist = Histogram([0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0])
+        self._recent_latencies = deque(maxlen=200)
+        self._executor = ThreadPoolExecutor(max_workers=2 * LLM_MAX_CONCURRENCY, thread_name_prefix='gemini')
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def reset_after_fork(self):
+        """Tạo thread pool mới trong worker (thread của master không tồn tại sau fork)"""
+        self._executor = ThreadPoolExecutor(max_workers=2 * LLM_MAX_CONCURRENCY, thread_name_prefix='gemini')
+
+    def _hedge_delay(self):
+        """Độ trễ p95 gần đây; chỉ hedge khi đã có đủ mẫu"""
+        if not self.hedge or len(self._recent_latencies) < 20:
+            return None
+        latencies = sorted(self._recent_latencies)
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def _timed(self, call, timeout):
+        start = time.monotonic()
+        try:
+            return call(timeout)
+        finally:
+            elapsed = time.monotonic() - start
+            self.latency_hist.observe(elapsed)
+            self._recent_latencies.append(elapsed)
+
+    def _attempt(self, call, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise GeminiUnavailableError("Hết thời gian chờ Gemini")
+
+        futures = [self._executor.submit(self._timed, call, remaining)]
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is not None and hedge_delay < remaining:
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                self.hedges += 1
+                futures.append(self._executor.submit(self._timed, call, deadline - time.monotonic()))
+
+        # Lấy kết quả thành công đầu tiên trong các lời gọi song song
+        errors = []
+        while futures:
+            done, _ = wait(futures, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                self.timeouts += 1
+                raise GeminiUnavailableError("Gemini không phản hồi trước deadline")
+            for future in done:
+                futures.remove(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    errors.append(e)
+        raise errors[0]
+
+    def _backoff(self, attempt, deadline):
+        # Full jitter, không vượt quá deadline còn lại
+        delay = random.uniform(0, self.retry_base_delay * (2 ** attempt))
+        delay = min(delay, max(0.0, deadline - time.monotonic()))
+        time.sleep(delay)
+
+    def call(self, call):
+        """Gọi call(timeout) -> response với deadline, retry và hedging"""
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise GeminiUnavailableError("Circuit breaker đang mở")
+
+        self.calls += 1
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._attempt(call, deadline)
+                self.breaker.record_success()
+                return response
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                if attempt == self.max_retries or time.monotonic() >= deadline or not self.breaker.allow():
+                    raise
+                self.retries += 1
+                logger.warning(f"Lỗi tạm thời từ Gemini, thử lại lần {attempt + 1}: {e}")
+                self._backoff(attempt, deadline)
+            except BaseException:
+                # Lỗi không retry (PermissionDenied, InvalidArgument, nội dung bị chặn...) không chứng tỏ Gemini ổn
+                self.breaker.record_abandoned()
+                raise
+
+    def stream(self, start_stream):
+        """Gọi start_stream(timeout) -> response dạng stream; chỉ retry khi chưa nhận được đoạn nào"""
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise GeminiUnavailableError("Circuit breaker đang mở")
+
+        self.calls += 1
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            received = False
+            try:
+                response = start_stream(max(0.1, deadline - start))
+                for chunk in response:
+                    if not received:
+                        received = True
+                        self.latency_hist.observe(time.monotonic() - start)
+                    yield chunk
+                self.breaker.record_success()
+                return
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record_failure()
+                if received or attempt == self.max_retries or time.monotonic() >= deadline or not self.breaker.allow():
+                    raise
+                self.retries += 1
+                logger.warning(f"Lỗi tạm thời từ Gemini (stream), thử lại lần {attempt + 1}: {e}")
+                self._backoff(attempt, deadline)
+            except BaseException:
+                # Lỗi không retry hoặc client ngắt kết nối (GeneratorExit): đã nhận được đoạn nào thì Gemini vẫn hoạt động
+                if received:
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_abandoned()
+                raise
+
+    def send_message(self, chat_model, history, content):
+        """Gửi một lượt chat và trả về response đầy đủ"""
+        def _call(timeout):
+            response = chat_model.start_chat(history=history).send_message(content, request_options={'timeout': timeout})
+            response.text  # Lỗi nội dung (bị chặn...) lộ ra ngay tại đây
+            return response
+        return self.call(_call)
+
+    def stream_message(self, chat_model, history, content):
+        """Gửi một lượt chat và trả về từng đoạn phản hồi"""
+        def _start(timeout):
+            return chat_model.start_chat(history=history).send_message(
+                content, stream=True, request_options={'timeout': timeout}
+            )
+        return self.stream(_start)
+
+    def stats(self):
+        return {
+            'breaker_state': self.breaker.state,
+            'breaker_failures': self.breaker.failures,
+            'breaker_trips': self.breaker.trips,
+            'calls': self.calls,
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'latency_seconds': self.latency_hist.snapshot(),
+            'latency_p95': self.latency_hist.quantile(0.95)
+        }
+
+gemini_client = ResilientGeminiClient(
+    GEMINI_DEADLINE,
+    GEMINI_MAX_RETRIES,
+    GEMINI_RETRY_BASE_DELAY,
+    GEMINI_HEDGE,
+    CircuitBreaker(GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET)
+)
+
+# Cấu hình ngân sách token cho lịch sử gửi kèm mỗi lượt
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '3000'))
+SUMMARY_MAX_WORDS = int(os.getenv('SUMMARY_MAX_WORDS', '150'))
+MAX_HISTORY_TURNS = 60
+
+def estimate_tokens(text):
+    """Ước lượng số token (tiếng Việt khoảng 3 ký tự/token với tokenizer của Gemini)"""
+    return max(1, len(text) // 3)
+
+# Quản lý context gửi Gemini: giữ các lượt gần nhất trong ngân sách token,
+# gộp các lượt cũ hơn vào bản tóm tắt được tạo trong nền
+class PromptContextManager:
+    def __init__(self, token_budget):
+        self.token_budget = token_budget
+        self.prompt_tokens_hist = Histogram([250, 500, 1000, 2000, 4000, 8000, 16000, 32000])
+        self.summaries = 0
+        self.summary_errors = 0
+        # user_id -> có lượt gộp mới trong lúc đang tóm tắt (cần chạy thêm một vòng)
+        self._summarizing = {}
+        self._summary_lock = threading.Lock()
+
+    @staticmethod
+    def turn_tokens(turn):
+        if 'tokens' not in turn:
+            turn['tokens'] = sum(estimate_tokens(part) for part in turn['parts'])
+        return turn['tokens']
+
+    def build_history(self, session):
+        """Lịch sử gửi kèm: bản tóm tắt (nếu có) + các lượt mới nhất vừa ngân sách"""
+        history = []
+        used = 0
+        for turn in reversed(session['history']):
+            used += self.turn_tokens(turn)
+            if used > self.token_budget and history:
+                break
+            history.append({'role': turn['role'], 'parts': list(turn['parts'])})
+        history.reverse()
+        # Gemini cần lượt đầu tiên là của user
+        while history and history[0]['role'] != 'user':
+            history.pop(0)
+
+        if session.get('summary'):
+            history[:0] = [
+                {'role': 'user', 'parts': [f"Tóm tắt phần trước của cuộc trò chuyện: {session['summary']}"]},
+                {'role': 'model', 'parts': ["Tôi đã nắm được bối cảnh trước đó."]}
+            ]
+        return history
+
+    def compact(self, session):
+        """Chuyển các lượt vượt ngân sách ra khỏi lịch sử vào pending_summary (tóm tắt sau bằng schedule_summary)"""
+        history = session['history']
+        total = sum(self.turn_tokens(turn) for turn in history)
+        folded = []
+        while len(history) > 2 and (total > self.token_budget or len(history) > MAX_HISTORY_TURNS):
+            # Gộp theo cặp user/model để lịch sử còn lại vẫn bắt đầu bằng user
+            for _ in range(2):
+                turn = history.pop(0)
+                total -= self.turn_tokens(turn)
+                folded.append(turn)
+        if not folded:
+            return
+
+        session.setdefault('pending_summary', []).extend(folded)
+
+    def schedule_summary(self, user_id):
+        """Tóm tắt pending_summary đã lưu của user trong nền; mỗi user tối đa một thread tóm tắt"""
+        with self._summary_lock:
+            if user_id in self._summarizing:
+                self._summarizing[user_id] = True
+                return
+            self._summarizing[user_id] = False
+        threading.Thread(target=self._summarize_pending, args=(user_id,), name='history-summary', daemon=True).start()
+
+    def _summarize_pending(self, user_id):
+        try:
+            while True:
+                self._summarize(user_id)
+                # Xoá cờ trong cùng khoá với lần kiểm tra để không bỏ sót lượt được gộp thêm
+                with self._summary_lock:
+                    if not self._summarizing[user_id]:
+                        del self._summarizing[user_id]
+                        return
+                    self._summarizing[user_id] = False
+        except BaseException:
+            with self._summary_lock:
+                self._summarizing.pop(user_id, None)
+            raise
+
+    def _summarize(self, user_id):
+        session = get_or_create_chat_session(user_id)
+        pending = list(session.get('pending_summary') or [])
+        if not pending:
+            return
+
+        transcript = '\n'.join(
+            f"{'Người dùng' if turn['role'] == 'user' else 'Trợ lý'}: {' '.join(turn['parts'])}" for turn in pending
+        )
+        prompt = (
+            f"Cập nhật bản tóm tắt cuộc trò chuyện hỗ trợ tâm lý dưới đây, tối đa {SUMMARY_MAX_WORDS} từ. "
+            "Giữ lại cảm xúc chính, sự kiện quan trọng, dấu hiệu nguy cơ và những gì đã được khuyên.\n\n"
+            f"Tóm tắt hiện có: {session.get('summary') or '(chưa có)'}\n\n"
+            f"Các lượt mới cần gộp:\n{transcript}"
+        )
+        try:
+            llm_semaphore.acquire(priority=PRIORITY_BACKGROUND)
+            try:
+                response = gemini_client.call(
+                    lambda timeout: summary_model.generate_content(prompt, request_options={'timeout': timeout})
+                )
+            finally:
+                llm_semaphore.release()
+            summary = response.text.strip()
+        except Exception as e:
+            self.summary_errors += 1
+            logger.error(f"Lỗi tóm tắt lịch sử cho user {user_id}: {e}")
+            return
+
+        def _apply(session):
+            session['summary'] = summary
+            session['pending_summary'] = session.get('pending_summary', [])[len(pending):]
+
+        # Phiên có thể đã được đọc lại từ kho, lấy bản mới nhất trước khi ghi
+        update_chat_session(user_id, get_or_create_chat_session(user_id), _apply)
+        self.summaries += 1
+
+    def record_usage(self, turn, response):
+        """Ghi nhận số token prompt thực tế (usage_metadata), nếu không có thì dùng ước lượng"""
+        usage = getattr(response, 'usage_metadata', None)
+        prompt_tokens = getattr(usage, 'prompt_token_count', None) or turn['estimated_prompt_tokens']
+        turn['prompt_tokens'] = prompt_tokens
+        self.prompt_tokens_hist.observe(prompt_tokens)
+
+    def stats(self):
+        return {
+            'token_budget': self.token_budget,
+            'prompt_tokens': self.prompt_tokens_hist.snapshot(),
+            'prompt_tokens_p50': self.prompt_tokens_hist.quantile(0.5),
+            'summaries': self.summaries,
+            'summary_errors': self.summary_errors
+        }
+
+prompt_context = PromptContextManager(PROMPT_TOKEN_BUDGET)
+
+def _llm_priority(turn):
+    return PRIORITY_CRISIS if turn['emergency_detected'] else PRIORITY_NORMAL
+
+def generate_reply(turn):
+    """Gửi tin nhắn tới Gemini và trả về toàn bộ phản hồi"""
+    with tracer.stage('llm_queue'):
+        acquired = llm_semaphore.acquire(timeout=LLM_QUEUE_TIMEOUT, priority=_llm_priority(turn))
+    if not acquired:
+        raise LLMBusyError("Quá nhiều yêu cầu Gemini đồng thời")
+    try:
+        with tracer.stage('gemini'):
+            response = gemini_client.send_message(model, turn['prompt_history'], turn['enhanced_context'])
+        prompt_context.record_usage(turn, response)
+        return response.text
+    finally:
+        llm_semaphore.release()
+
+def stream_reply(turn):
+    """Gửi tin nhắn tới Gemini và trả về từng đoạn phản hồi ngay khi nhận được"""
+    with tracer.stage('llm_queue'):
+        acquired = llm_semaphore.acquire(timeout=LLM_QUEUE_TIMEOUT, priority=_llm_priority(turn))
+    if not acquired:
+        raise LLMBusyError("Quá nhiều yêu cầu Gemini đồng thời")
+    start = time.perf_counter()
+    try:
+        last_chunk = None
+        for chunk in gemini_client.stream_message(model, turn['prompt_history'], turn['enhanced_context']):
+            if last_chunk is None:
+                tracer.record_stage('gemini_first_token', time.perf_counter() - start)
+            last_chunk = chunk
+            if chunk.text:
+                yield chunk.text
+        # Đoạn cuối của stream mang usage_metadata
+        prompt_context.record_usage(turn, last_chunk)
+    finally:
+        tracer.record_stage('gemini_stream', time.perf_counter() - start)
+        llm_semaphore.release()
+
+# Cấu hình kho phiên chat: 'memory' (LRU + TTL trong tiến trình) hoặc 'sqlite' (dùng chung giữa các worker)
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_MAX_COUNT = int(os.getenv('SESSION_MAX_COUNT', '5000'))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', str(64 * 1024 * 1024)))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', str(6 * 3600)))
+SESSION_REBUILD_TURNS = int(os.getenv('SESSION_REBUILD_TURNS', '15'))
+SESSION_SAVE_ATTEMPTS = 3
+
+def _estimate_session_bytes(session):
+    """Ước lượng bộ nhớ của một phiên chat (chủ yếu là văn bản lịch sử)"""
+    text_bytes = sum(len(part) for turn in session['history'] for part in turn['parts']) + len(session.get('summary') or '')
+    return 512 + 2 * text_bytes
+
+# Kho phiên trong bộ nhớ: LRU giới hạn số phiên và dung lượng, tự xoá phiên không hoạt động quá TTL
+class InMemorySessionStore:
+    def __init__(self, max_sessions, max_bytes, idle_ttl):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, user_id):
+        _, size = self._sessions.pop(user_id)
+        self._bytes -= size
+
+    def _expire_idle(self, now):
+        # Phiên ít dùng nhất nằm đầu OrderedDict
+        while self._sessions:
+            user_id, (session, _) = next(iter(self._sessions.items()))
+            if now - session['last_activity'] <= self.idle_ttl:
+                break
+            self._remove(user_id)
+            self.expirations += 1
+
+    def get(self, user_id):
+        with self._lock:
+            now = time.time()
+            self._expire_idle(now)
+            entry = self._sessions.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._sessions.move_to_end(user_id)
+            entry[0]['last_activity'] = now
+            self.hits += 1
+            return entry[0]
+
+    def save(self, user_id, session, force=False):
+        # Các thread cùng tiến trình dùng chung một object phiên nên không có xung đột cần phát hiện
+        with self._lock:
+            session['last_activity'] = time.time()
+            if user_id in self._sessions:
+                self._remove(user_id)
+            size = _estimate_session_bytes(session)
+            self._sessions[user_id] = (session, size)
+            self._bytes += size
+            while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._sessions)))
+                self.evictions += 1
+        return True
+
+    def delete(self, user_id):
+        with self._lock:
+            if user_id in self._sessions:
+                self._remove(user_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'sessions': len(self._sessions),
+                'bytes': self._bytes,
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+# Kho phiên dùng chung qua SQLite: worker nào cũng phục vụ được mọi user
+class SQLiteSessionStore:
+    def __init__(self, idle_ttl):
+        self.idle_ttl = idle_ttl
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.conflicts = 0
+        self._last_sweep = 0.0
+
+    def get(self, user_id):
+        with database.cursor() as cursor:
+            row = cursor.execute('SELECT data, last_activity, version FROM chat_sessions WHERE user_id = ?', (user_id,)).fetchone()
+            if row is not None and time.time() - row[1] > self.idle_ttl:
+                # Xoá phiên hết hạn để phiên mới được tạo (INSERT) thay vào
+                cursor.execute('DELETE FROM chat_sessions WHERE user_id = ? AND last_activity = ?', (user_id, row[1]))
+                row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        session = json.loads(row[0])
+        session['last_activity'] = time.time()
+        session['version'] = row[2]
+        return session
+
+    def save(self, user_id, session, force=False):
+        """Ghi phiên nếu chưa worker nào ghi kể từ lúc đọc (so version); trả về False khi xung đột"""
+        now = time.time()
+        expected = session.get('version')
+        session['last_activity'] = now
+        session['version'] = (expected or 0) + 1
+        data = json.dumps(session, ensure_ascii=False)
+        with database.cursor() as cursor:
+            if force:
+                cursor.execute('''
+                    INSERT INTO chat_sessions (user_id, data, last_activity, version) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        data = excluded.data, last_activity = excluded.last_activity, version = chat_sessions.version + 1
+                ''', (user_id, data, now, session['version']))
+                saved = True
+            elif expected is None:
+                saved = cursor.execute('''
+                    INSERT INTO chat_sessions (user_id, data, last_activity, version) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id) DO NOTHING
+                ''', (user_id, data, now, session['version'])).rowcount == 1
+            else:
+                saved = cursor.execute(
+                    'UPDATE chat_sessions SET data = ?, last_activity = ?, version = ? WHERE user_id = ? AND version = ?',
+                    (data, now, session['version'], user_id, expected)
+                ).rowcount == 1
+            # Dọn các phiên hết hạn tối đa mỗi phút một lần
+            if now - self._last_sweep > 60:
+                self._last_sweep = now
+                self.expirations += cursor.execute('DELETE FROM chat_sessions WHERE last_activity < ?', (now - self.idle_ttl,)).rowcount
+        if not saved:
+            session['version'] = expected
+            self.conflicts += 1
+        return saved
+
+    def delete(self, user_id):
+        with database.cursor() as cursor:
+            cursor.execute('DELETE FROM chat_sessions WHERE user_id = ?', (user_id,))
+
+    def stats(self):
+        with database.cursor() as cursor:
+            count = cursor.execute('SELECT COUNT(*) FROM chat_sessions').fetchone()[0]
+        return {
+            'backend': 'sqlite',
+            'sessions': count,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expirations': self.expirations,
+            'conflicts': self.conflicts
+        }
+
+def create_session_store():
+    if SESSION_BACKEND == 'sqlite':
+        return SQLiteSessionStore(SESSION_IDLE_TTL)
+    return InMemorySessionStore(SESSION_MAX_COUNT, SESSION_MAX_BYTES, SESSION_IDLE_TTL)
+
+session_store = create_session_store()
+session_rebuilds = 0
+
+def _new_chat_session():
+    # System prompt đi qua system_instruction; lời chào chỉ hiển thị, không gửi lại cho Gemini
+    return {
+        'history': [],
+        'summary': '',
+        'last_sentiment': None,
+        'last_activity': time.time()
+    }
+
+def _rebuild_chat_session(user_id):
+    """Dựng lại phiên từ các lượt gần nhất trong chat_history (sau lần reset cuối)"""
+    global session_rebuilds
+    with database.cursor() as cursor:
+        rows = cursor.execute('''
+            SELECT message, response, sentiment_score, depression_indicators, timestamp
+            FROM chat_history
+            WHERE user_id = ? AND timestamp > COALESCE((SELECT reset_at FROM session_resets WHERE user_id = ?), '')
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', (user_id, user_id, SESSION_REBUILD_TURNS)).fetchall()
+
+    session = _new_chat_session()
+    for message, response, sentiment_score, depression_indicators, timestamp in reversed(rows):
+        session['history'].append({'role': 'user', 'parts': [message]})
+        session['history'].append({'role': 'model', 'parts': [response]})
+        session['last_sentiment'] = sentiment_score
+    if rows:
+        session_rebuilds += 1
+    return session
 
 def get_or_create_chat_session(user_id='default_user'):
     """Lấy hoặc tạo phiên chat cho người dùng"""
-    if user_id not in chat_sessions:
-        chat_sessions[user_id] = {
-            'history': [
-                {'role': 'user', 'parts': [ENHANCED_SYSTEM_PROMPT]},
-                {'role': 'model', 'parts': ["Xin chào! Tôi là trợ lý AI được thiết kế đặc biệt để lắng nghe và hỗ trợ bạn trong những lúc khó khăn. Tôi được trang bị những công cụ AI tiên tiến để hiểu rõ hơn về cảm xúc và tình trạng tâm lý của bạn.\n\nBạn có thể chia sẻ bất cứ điều gì đang làm bạn lo lắng, buồn bã, hoặc khó chịu. Tôi sẽ lắng nghe mà không phán xét và cố gắng hỗ trợ bạn tốt nhất có thể.\n\nHôm nay bạn cảm thấy thế nào?"]}
-            ],
-            'mood_tracking': [],
-            'last_activity': datetime.now()
-        }
-    return chat_sessions[user_id]
+    session = session_store.get(user_id)
+    if session is None:
+        session = _rebuild_chat_session(user_id)
+        if not session_store.save(user_id, session):
+            # Worker khác vừa tạo phiên: dùng bản của nó
+            session = session_store.get(user_id) or session
+    return session
+
+def update_chat_session(user_id, session, apply):
+    """Áp dụng apply(session) rồi ghi; nếu worker khác đã ghi phiên trước, đọc lại và áp dụng lại để không mất lượt"""
+    for attempt in range(SESSION_SAVE_ATTEMPTS):
+        result = apply(session)
+        # Lần cuối vẫn xung đột thì ghi đè, còn hơn làm mất lượt hiện tại
+        with tracer.stage('session_save'):
+            saved = session_store.save(user_id, session, force=attempt == SESSION_SAVE_ATTEMPTS - 1)
+        if saved:
+            return result
+        logger.info(f"Phiên của user {user_id} vừa được worker khác cập nhật, áp dụng lại")
+        session = session_store.get(user_id) or _new_chat_session()
+
+def save_chat_session(user_id, session):
+    """Ghi đè phiên sau khi thay đổi, không kiểm tra xung đột"""
+    session_store.save(user_id, session, force=True)
+
+def reset_chat_session(user_id):
+    """Xoá phiên và đánh dấu thời điểm reset để không dựng lại lịch sử cũ"""
+    session_store.delete(user_id)
+    with database.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO session_resets (user_id, reset_at) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET reset_at = excluded.reset_at
+        ''', (user_id, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+
+def session_stats():
+    return dict(session_store.stats(), rebuilds=session_rebuilds)
+
+def _insert_chat(cursor, user_id, message, response, sentiment_score, depression_indicators, timestamp):
+    cursor.execute('''
+        INSERT INTO chat_history (user_id, message, response, sentiment_score, depression_indicators, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, message, response, sentiment_score, json.dumps(depression_indicators), timestamp))
+    accumulate_daily_stats(cursor, user_id, timestamp[:10], sentiment_score, depression_indicators)
+    epoch = (datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S') - datetime(1970, 1, 1)).total_seconds()
+    append_mood_point(cursor, user_id, epoch, sentiment_score, depression_indicators)
 
 def save_chat_to_database(user_id, message, response, sentiment_analysis, depression_indicators):
-    """Lưu cuộc trò chuyện vào database"""
+    """Lưu cuộc trò chuyện vào database (qua hàng đợi ghi nền)"""
     try:
-        conn = sqlite3.connect('depression_support.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO chat_history (user_id, message, response, sentiment_score, depression_indicators)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
+        # Thời điểm lượt chat hoàn tất (đã có phản hồi), lấy trước khi vào hàng đợi thay vì lúc commit
+        # (UTC, cùng định dạng CURRENT_TIMESTAMP); gần với thứ tự ghi nên mood_series vẫn theo thời gian
+        database.submit(
+            _insert_chat,
             user_id,
             message,
             response,
             sentiment_analysis['score'],
-            json.dumps(depression_indicators)
-        ))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Đã lưu cuộc trò chuyện cho user {user_id}")
+            depression_indicators,
+            datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        )
+        logger.info(f"Đã đưa cuộc trò chuyện của user {user_id} vào hàng đợi ghi")
     except Exception as e:
         logger.error(f"Lỗi lưu database: {e}")
 
+def _insert_user_tracking(cursor, user_id, mood_score, depression_level, recommended_actions, last_check):
+    cursor.execute('''
+        INSERT INTO user_tracking (user_id, mood_score, depression_level, recommended_actions, last_check)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            mood_score = excluded.mood_score,
+            depression_level = excluded.depression_level,
+            recommended_actions = excluded.recommended_actions,
+            last_check = excluded.last_check
+    ''', (user_id, mood_score, depression_level, recommended_actions, last_check))
+
 def update_user_tracking(user_id, sentiment_analysis, recommendations):
-    """Cập nhật thông tin theo dõi người dùng"""
+    """Cập nhật thông tin theo dõi người dùng (qua hàng đợi ghi nền)"""
     try:
-        conn = sqlite3.connect('depression_support.db')
-        cursor = conn.cursor()
-        
         # Xác định mức độ trầm cảm
         score = sentiment_analysis['score']
         if score < -0.7:
@@ -359,19 +2799,14 @@ def update_user_tracking(user_id, sentiment_analysis, recommendations):
         else:
             depression_level = 'normal'
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_tracking (user_id, mood_score, depression_level, recommended_actions, last_check)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
+        database.submit(
+            _insert_user_tracking,
             user_id,
             score,
             depression_level,
             json.dumps(recommendations),
             datetime.now()
-        ))
-        
-        conn.commit()
-        conn.close()
+        )
         logger.info(f"Đã cập nhật theo dõi cho user {user_id}")
     except Exception as e:
         logger.error(f"Lỗi cập nhật tracking: {e}")
@@ -380,108 +2815,609 @@ def update_user_tracking(user_id, sentiment_analysis, recommendations):
 def home():
     return render_template('index.html')
 
-@app.route('/chat', methods=['POST'])
-def enhanced_chat():
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "Không có dữ liệu JSON"}), 400
-            
-        user_input = data.get('message')
-        user_id = data.get('user_id', 'default_user')
-        
-        if not user_input or not isinstance(user_input, str) or not user_input.strip():
-            return jsonify({"error": "Tin nhắn không hợp lệ hoặc trống"}), 400
+# Phản hồi dự phòng khi Gemini gặp lỗi
+FALLBACK_RESPONSE = "Tôi hiểu bạn đang cần được lắng nghe. Mặc dù có một chút trục trặc kỹ thuật, tôi vẫn muốn bạn biết rằng cảm xúc của bạn là hoàn toàn hợp lý và bạn không cô đơn trong điều này."
 
-        logger.info(f"Nhận tin nhắn từ user {user_id}: {user_input[:50]}...")
-        
-        # Phân tích sentiment và dấu hiệu trầm cảm
-        sentiment_analysis = nlp_processor.analyze_sentiment(user_input)
-        depression_indicators = nlp_processor.extract_depression_indicators(user_input)
-        
-        # Lấy phiên chat
+def is_emergency(sentiment_analysis, depression_indicators):
+    return any('suicidal_thoughts' in ind for ind in depression_indicators) or sentiment_analysis['score'] < -0.8
+
+def prepare_chat_turn(user_id, user_input):
+    """Phân tích tin nhắn và chuẩn bị mọi thứ cần có trước khi gọi Gemini"""
+    # Phân tích sentiment và dấu hiệu trầm cảm
+    with tracer.stage('nlp'):
+        sentiment_analysis, depression_indicators = run_blocking(nlp_processor.analyze_text, user_input)
+
+    # Lấy phiên chat; lịch sử gửi kèm chỉ gồm các lượt trước (tin nhắn hiện tại đi trong enhanced_context)
+    with tracer.stage('session_load'):
         chat_session_data = get_or_create_chat_session(user_id)
-        chat_session_data['history'].append({'role': 'user', 'parts': [user_input]})
-        
-        # Tạo context mở rộng cho AI
-        enhanced_context = f"""
-        Phân tích tâm trạng hiện tại:
-        - Điểm cảm xúc: {sentiment_analysis['score']:.2f} (-1 đến 1)
-        - Đánh giá: {sentiment_analysis['analysis']}
-        - Dấu hiệu trầm cảm phát hiện: {len(depression_indicators)} dấu hiệu
-        - Chi tiết: {', '.join(depression_indicators) if depression_indicators else 'Không có dấu hiệu rõ ràng'}
-        
-        Tin nhắn người dùng: {user_input}
-        
-        Hãy phản hồi dựa trên phân tích này và đưa ra lời khuyên phù hợp.
-        """
-        
-        # Gửi tới Gemini
-        try:
-            chat_session = model.start_chat(history=chat_session_data['history'])
-            response = chat_session.send_message(enhanced_context)
-            bot_response = response.text
-        except Exception as e:
-            logger.error(f"Lỗi API Gemini: {e}")
-            # Fallback response
-            bot_response = "Tôi hiểu bạn đang cần được lắng nghe. Mặc dù có một chút trục trặc kỹ thuật, tôi vẫn muốn bạn biết rằng cảm xúc của bạn là hoàn toàn hợp lý và bạn không cô đơn trong điều này."
-        
+        prompt_history = prompt_context.build_history(chat_session_data)
+
+    # Tạo context mở rộng cho AI (gọn để không tốn token mỗi lượt)
+    indicators_text = ', '.join(depression_indicators) if depression_indicators else 'không rõ'
+    enhanced_context = (
+        f"[Phân tích: cảm xúc {sentiment_analysis['score']:.2f} ({sentiment_analysis['analysis']}); "
+        f"dấu hiệu: {indicators_text}]\n{user_input}"
+    )
+
+    # Lấy đề xuất hoạt động
+    with tracer.stage('recommend'):
+        recommendations = recommender.recommend_activities(sentiment_analysis, depression_indicators)
+
+    # Kiểm tra tình huống khẩn cấp
+    emergency_detected = is_emergency(sentiment_analysis, depression_indicators)
+
+    return {
+        'user_id': user_id,
+        'user_input': user_input,
+        'session': chat_session_data,
+        'sentiment_analysis': sentiment_analysis,
+        'depression_indicators': depression_indicators,
+        'recommendations': recommendations,
+        'emergency_detected': emergency_detected,
+        'enhanced_context': enhanced_context,
+        'prompt_history': prompt_history,
+        'estimated_prompt_tokens': estimate_tokens(ENHANCED_SYSTEM_PROMPT) + estimate_tokens(enhanced_context) +
+            sum(estimate_tokens(part) for turn in prompt_history for part in turn['parts'])
+    }
+
+def finalize_chat_turn(turn, bot_response):
+    """Cập nhật lịch sử, theo dõi tâm trạng và database sau khi có phản hồi; trả về mood_trend"""
+    user_id = turn['user_id']
+
+    # Lưu vào database
+    with tracer.stage('db_write'):
+        run_blocking(save_chat_to_database, user_id, turn['user_input'], bot_response, turn['sentiment_analysis'], turn['depression_indicators'])
+        run_blocking(update_user_tracking, user_id, turn['sentiment_analysis'], turn['recommendations'])
+
+    def _apply(chat_session_data):
         # Cập nhật lịch sử
+        chat_session_data['history'].append({'role': 'user', 'parts': [turn['user_input']]})
         chat_session_data['history'].append({'role': 'model', 'parts': [bot_response]})
-        chat_session_data['mood_tracking'].append({
-            'timestamp': datetime.now().isoformat(),
-            'sentiment': sentiment_analysis['score'],
-            'indicators': depression_indicators
-        })
-        
-        # Lấy đề xuất hoạt động
-        recommendations = recommender.recommend_activities(sentiment_analysis, depression_indicators)
-        
-        # Kiểm tra tình huống khẩn cấp
-        emergency_detected = any('suicidal_thoughts' in ind for ind in depression_indicators) or sentiment_analysis['score'] < -0.8
-        
+
+        # Lịch sử tâm trạng nằm trong mood_series (ghi cùng chat_history); phiên chỉ giữ điểm gần nhất
+        sentiment = turn['sentiment_analysis']['score']
+        last_sentiment = chat_session_data.get('last_sentiment')
+        chat_session_data['last_sentiment'] = sentiment
+        chat_session_data.pop('mood_tracking', None)
+
+        # Giới hạn lịch sử theo ngân sách token
+        with tracer.stage('compact'):
+            prompt_context.compact(chat_session_data)
+        has_pending_summary[0] = bool(chat_session_data.get('pending_summary'))
+        return "improving" if last_sentiment is not None and sentiment > last_sentiment else "stable"
+
+    has_pending_summary = [False]
+    mood_trend = update_chat_session(user_id, turn['session'], _apply)
+    # Chỉ tóm tắt sau khi phiên (kèm pending_summary) đã được lưu; _apply có thể chạy lại khi xung đột
+    if has_pending_summary[0]:
+        prompt_context.schedule_summary(user_id)
+    return mood_trend
+
+# user_id mặc định khi client không gửi: dùng chung cho mọi người dùng ẩn danh
+ANONYMOUS_USER_ID = 'default_user'
+
+def _parse_chat_request():
+    """Đọc và kiểm tra JSON của /chat; trả về (user_input, user_id, lỗi)"""
+    data = request.get_json()
+    if not data:
+        return None, None, (jsonify({"error": "Không có dữ liệu JSON"}), 400)
+
+    user_input = data.get('message')
+    user_id = data.get('user_id') or ANONYMOUS_USER_ID
+
+    if not user_input or not isinstance(user_input, str) or not user_input.strip():
+        return None, None, (jsonify({"error": "Tin nhắn không hợp lệ hoặc trống"}), 400)
+    return user_input, user_id, None
+
+# Kiểm soát tải cho /chat: token bucket theo user và toàn cục, hàng đợi chờ có giới hạn (429/503 kèm Retry-After),
+# gộp tin nhắn trùng đang xử lý. Bucket theo user và việc gộp chỉ áp dụng khi client gửi user_id; tin nhắn ẩn danh
+# chỉ qua giới hạn chung. Tin nhắn khủng hoảng luôn được nhận. Đặt *_RATE=0 để tắt giới hạn tương ứng;
+# mỗi worker gunicorn có bộ đếm riêng. Hàng đợi và việc gộp chỉ có tác dụng khi một tiến trình xử lý nhiều request
+# cùng lúc (GUNICORN_WORKER_CLASS=gevent, hoặc server phát triển của Flask); worker sync mỗi lần chỉ xử lý một request.
+# Mặc định mỗi user gửi liền được 10 tin, sau đó trung bình một tin mỗi 2 giây
+ADMISSION_USER_RATE = float(os.getenv('ADMISSION_USER_RATE', '0.5'))
+ADMISSION_USER_BURST = float(os.getenv('ADMISSION_USER_BURST', '10'))
+ADMISSION_GLOBAL_RATE = float(os.getenv('ADMISSION_GLOBAL_RATE', '20'))
+ADMISSION_GLOBAL_BURST = float(os.getenv('ADMISSION_GLOBAL_BURST', '40'))
+ADMISSION_MAX_ACTIVE = int(os.getenv('ADMISSION_MAX_ACTIVE', str(LLM_MAX_CONCURRENCY)))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '64'))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '10'))
+ADMISSION_MAX_TRACKED_USERS = int(os.getenv('ADMISSION_MAX_TRACKED_USERS', '10000'))
+# Bản trùng chờ kết quả của yêu cầu đầu tiên tối đa chừng này
+ADMISSION_COALESCE_TIMEOUT = ADMISSION_QUEUE_TIMEOUT + GEMINI_DEADLINE + 5
+
+class AdmissionRejected(Exception):
+    """Yêu cầu bị từ chối để giảm tải (status 429/503, retry_after giây)"""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """Lấy một token; trả về 0 nếu được, ngược lại số giây tới khi có token"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+class AdmissionController:
+    def __init__(self, user_rate, user_burst, global_rate, global_burst, max_active, queue_size, queue_timeout, max_users):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_active = max_active
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.max_users = max_users
+        self.slots = PrioritySemaphore(max_active)
+        self._global_bucket = TokenBucket(global_rate, global_burst, time.monotonic()) if global_rate > 0 else None
+        self._user_buckets = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.active = 0
+        self.admitted = 0
+        self.crisis_admitted = 0
+        self.coalesced = 0
+        self.shed = {'user_rate': 0, 'global_rate': 0, 'queue_full': 0, 'queue_timeout': 0, 'coalesce_timeout': 0}
+        self.queue_wait_hist = Histogram(LATENCY_BUCKETS)
+        # Thời gian xử lý trung bình (EWMA) một lượt, dùng để ước lượng Retry-After khi hàng đợi đầy
+        self._service_seconds = 1.0
+
+    def _user_bucket(self, user_id, now):
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self._user_buckets[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+            if len(self._user_buckets) > self.max_users:
+                self._user_buckets.popitem(last=False)
+        else:
+            self._user_buckets.move_to_end(user_id)
+        return bucket
+
+    def _reject(self, reason, status, retry_after):
+        with self._lock:
+            self.shed[reason] += 1
+        raise AdmissionRejected(status, reason, max(1, int(-(-retry_after // 1))))
+
+    def _estimated_wait(self):
+        return self._service_seconds * (self.slots.waiting() + 1) / self.max_active
+
+    def _admit_crisis(self):
+        # Không tốn token, không xếp hàng
+        with self._lock:
+            self.crisis_admitted += 1
+            self.active += 1
+        return self._releaser(holds_slot=False)
+
+    def _admit_slot(self):
+        with self._lock:
+            self.admitted += 1
+            self.active += 1
+        return self._releaser(holds_slot=True)
+
+    def admit(self, user_id, is_crisis=None):
+        """Xin lượt xử lý cho một tin nhắn; trả về hàm release (gọi nhiều lần vẫn an toàn) hoặc raise AdmissionRejected.
+        user_id=None: chỉ áp dụng giới hạn chung. is_crisis() chỉ được gọi khi tin nhắn sắp bị từ chối hoặc phải xếp hàng"""
+        now = time.monotonic()
+        user_wait = global_wait = 0.0
+        with self._lock:
+            user_bucket = self._user_bucket(user_id, now) if self.user_rate > 0 and user_id is not None else None
+            if user_bucket is not None:
+                user_wait = user_bucket.take(now)
+            if not user_wait and self._global_bucket is not None:
+                global_wait = self._global_bucket.take(now)
+                # Bị chặn bởi giới hạn chung thì không tính vào hạn mức của user
+                if global_wait and user_bucket is not None:
+                    user_bucket.refund()
+        if user_wait or global_wait:
+            if is_crisis is not None and is_crisis():
+                return self._admit_crisis()
+            if user_wait:
+                self._reject('user_rate', 429, user_wait)
+            self._reject('global_rate', 503, global_wait)
+
+        # Còn chỗ trống thì nhận ngay, không cần phân tích tin nhắn
+        if self.slots.acquire(timeout=0):
+            self.queue_wait_hist.observe(0.0)
+            return self._admit_slot()
+        if is_crisis is not None and is_crisis():
+            return self._admit_crisis()
+
+        if self.slots.waiting() >= self.queue_size:
+            self._reject('queue_full', 503, self._estimated_wait())
+        start = time.perf_counter()
+        acquired = self.slots.acquire(timeout=self.queue_timeout)
+        self.queue_wait_hist.observe(time.perf_counter() - start)
+        if not acquired:
+            self._reject('queue_timeout', 503, self._estimated_wait())
+        return self._admit_slot()
+
+    def _releaser(self, holds_slot):
+        start = time.perf_counter()
+        released = False
+
+        def release():
+            nonlocal released
+            with self._lock:
+                if released:
+                    return
+                released = True
+                self.active -= 1
+                self._service_seconds += 0.2 * (time.perf_counter() - start - self._service_seconds)
+            if holds_slot:
+                self.slots.release()
+        return release
+
+    def coalesce_timeout(self):
+        """Bản trùng chờ quá lâu kết quả của yêu cầu đầu tiên: từ chối như khi quá tải"""
+        self._reject('coalesce_timeout', 503, self._estimated_wait())
+
+    def join(self, key):
+        """Đăng ký một yêu cầu; trả về (True, future) cho yêu cầu đầu tiên, (False, future) cho bản trùng đang chờ"""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return False, future
+            future = self._in_flight[key] = Future()
+            return True, future
+
+    def leave(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': self.active,
+                'queue_depth': self.slots.waiting(),
+                'queue_size': self.queue_size,
+                'max_active': self.max_active,
+                'in_flight': len(self._in_flight),
+                'tracked_users': len(self._user_buckets),
+                'admitted': self.admitted,
+                'crisis_admitted': self.crisis_admitted,
+                'coalesced': self.coalesced,
+                'shed': dict(self.shed),
+                'queue_wait_seconds': self.queue_wait_hist.snapshot()
+            }
+
+admission = AdmissionController(
+    ADMISSION_USER_RATE, ADMISSION_USER_BURST, ADMISSION_GLOBAL_RATE, ADMISSION_GLOBAL_BURST,
+    ADMISSION_MAX_ACTIVE, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT, ADMISSION_MAX_TRACKED_USERS
+)
+
+def _admit_chat(user_id, user_input):
+    """Kiểm soát tải trước khi xử lý tin nhắn; chỉ phân tích (có cache) để nhận biết khủng hoảng khi sắp từ chối"""
+    def is_crisis():
+        sentiment_analysis, depression_indicators = run_blocking(nlp_processor.analyze_text, user_input)
+        return is_emergency(sentiment_analysis, depression_indicators)
+
+    with tracer.stage('admission'):
+        # Người dùng ẩn danh dùng chung một user_id: không gom họ vào một bucket
+        return admission.admit(None if user_id == ANONYMOUS_USER_ID else user_id, is_crisis)
+
+def _rejected_response(rejected):
+    messages = {
+        429: "Bạn đang gửi tin nhắn quá nhanh, hãy thử lại sau ít giây nhé.",
+        503: "Hệ thống đang quá tải, hãy thử lại sau ít giây nhé."
+    }
+    response = jsonify({"error": messages[rejected.status], "reason": rejected.reason, "retry_after": rejected.retry_after})
+    response.status_code = rejected.status
+    response.headers['Retry-After'] = str(rejected.retry_after)
+    return response
+
+# Đường tắt khủng hoảng: trả tài nguyên khẩn cấp ngay, phản hồi của Gemini gửi sau qua /chat/reply/<reply_id>
+# (static/js/script.js và chatbot_api.php long-poll địa chỉ này). Đặt CRISIS_FAST_PATH=0 cho client chưa hỗ trợ
+CRISIS_FAST_PATH = os.getenv('CRISIS_FAST_PATH', '1') == '1'
+PENDING_REPLY_TTL = 600
+PENDING_REPLY_POLL_INTERVAL = 0.25
+CRISIS_INTERIM_REPLY = "Mình rất tiếc khi bạn đang phải trải qua điều này, và mình đang ở đây cùng bạn. Nếu bạn đang nghĩ tới việc làm hại bản thân, hãy gọi ngay một trong các đường dây nóng bên dưới (miễn phí, 24/7). Mình sẽ trả lời bạn đầy đủ ngay sau đây."
+
+# Phản hồi đang được tạo trong nền cho các tin nhắn khủng hoảng (lưu trong SQLite, tự hết hạn)
+class PendingReplyStore:
+    def __init__(self, ttl, poll_interval):
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        # Event chỉ để đánh thức long-poll trong cùng tiến trình; worker khác thì đọc lại database
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def create(self, user_id):
+        reply_id = uuid.uuid4().hex
+        now = time.time()
+        with database.cursor() as cursor:
+            cursor.execute('DELETE FROM pending_replies WHERE created_at < ?', (now - self.ttl,))
+            cursor.execute('INSERT INTO pending_replies (reply_id, user_id, created_at) VALUES (?, ?, ?)',
+                           (reply_id, user_id, now))
+        with self._lock:
+            self._events[reply_id] = threading.Event()
+        return reply_id
+
+    def complete(self, reply_id, result):
+        with database.cursor() as cursor:
+            cursor.execute('UPDATE pending_replies SET result = ? WHERE reply_id = ?',
+                           (json.dumps(result, ensure_ascii=False), reply_id))
+        with self._lock:
+            event = self._events.pop(reply_id, None)
+        if event is not None:
+            event.set()
+
+    def _load(self, reply_id):
+        with database.cursor() as cursor:
+            return cursor.execute('SELECT result FROM pending_replies WHERE reply_id = ? AND created_at >= ?',
+                                  (reply_id, time.time() - self.ttl)).fetchone()
+
+    def get(self, reply_id, wait_seconds=0):
+        """Trả về (tồn tại, kết quả); kết quả là None nếu sau wait_seconds vẫn chưa xong"""
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            row = self._load(reply_id)
+            if row is None:
+                return False, None
+            if row[0] is not None:
+                return True, json.loads(row[0])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True, None
+            with self._lock:
+                event = self._events.get(reply_id)
+            if event is not None:
+                event.wait(remaining)
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+
+    def pending(self):
+        with database.cursor() as cursor:
+            return cursor.execute('SELECT COUNT(*) FROM pending_replies WHERE result IS NULL AND created_at >= ?',
+                                  (time.time() - self.ttl,)).fetchone()[0]
+
+pending_replies = PendingReplyStore(PENDING_REPLY_TTL, PENDING_REPLY_POLL_INTERVAL)
+time_to_resources_hist = Histogram([0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0])
+crisis_fast_path_count = 0
+
+def _generate_and_finalize(turn):
+    """Gọi Gemini (có fallback) rồi hoàn tất lượt chat; trả về (phản hồi, mood_trend)"""
+    try:
+        bot_response = generate_reply(turn)
+    except Exception as e:
+        logger.error(f"Lỗi API Gemini: {e}")
+        bot_response = FALLBACK_RESPONSE
+    return bot_response, finalize_chat_turn(turn, bot_response)
+
+def _complete_crisis_reply(reply_id, turn):
+    try:
+        bot_response, mood_trend = _generate_and_finalize(turn)
+        pending_replies.complete(reply_id, {"status": "done", "reply": bot_response, "mood_trend": mood_trend})
+    except Exception as e:
+        logger.error(f"Lỗi tạo phản hồi khủng hoảng cho user {turn['user_id']}: {e}")
+        pending_replies.complete(reply_id, {"status": "done", "reply": FALLBACK_RESPONSE, "mood_trend": "stable"})
+
+def _chat_turn_response(request_start, user_id, user_input):
+    """Xử lý một tin nhắn /chat sau khi được nhận; trả về dict phản hồi"""
+    global crisis_fast_path_count
+    release = _admit_chat(user_id, user_input)
+    try:
+        logger.info(f"Nhận tin nhắn từ user {user_id}: {user_input[:50]}...")
+        turn = prepare_chat_turn(user_id, user_input)
+
         # Chuẩn bị response
         enhanced_response = {
-            "reply": bot_response,
-            "sentiment_analysis": sentiment_analysis,
-            "depression_indicators": depression_indicators,
-            "recommendations": recommendations,
-            "emergency_detected": emergency_detected,
-            "mood_trend": "improving" if len(chat_session_data['mood_tracking']) > 1 and 
-                         chat_session_data['mood_tracking'][-1]['sentiment'] > chat_session_data['mood_tracking'][-2]['sentiment'] 
-                         else "stable"
+            "sentiment_analysis": turn['sentiment_analysis'],
+            "depression_indicators": turn['depression_indicators'],
+            "recommendations": turn['recommendations'],
+            "emergency_detected": turn['emergency_detected']
         }
-        
-        if emergency_detected:
+        if turn['emergency_detected']:
             enhanced_response["emergency_resources"] = recommender.get_emergency_resources()
-        
-        # Lưu vào database
-        save_chat_to_database(user_id, user_input, bot_response, sentiment_analysis, depression_indicators)
-        update_user_tracking(user_id, sentiment_analysis, recommendations)
-        
-        # Giới hạn lịch sử
-        if len(chat_session_data['history']) > 30:
-            chat_session_data['history'] = [chat_session_data['history'][0]] + chat_session_data['history'][-30:]
-        
+
+        # Khủng hoảng: trả tài nguyên ngay, không chờ Gemini
+        if turn['emergency_detected'] and CRISIS_FAST_PATH:
+            reply_id = pending_replies.create(user_id)
+            threading.Thread(target=_complete_crisis_reply, args=(reply_id, turn), name='crisis-reply', daemon=True).start()
+            enhanced_response.update({
+                "reply": CRISIS_INTERIM_REPLY,
+                "reply_pending": True,
+                "reply_id": reply_id,
+                "reply_url": f"/chat/reply/{reply_id}"
+            })
+            crisis_fast_path_count += 1
+            time_to_resources_hist.observe(time.perf_counter() - request_start)
+            logger.info(f"Đã trả tài nguyên khẩn cấp cho user {user_id}, phản hồi {reply_id} đang được tạo")
+            return enhanced_response
+
+        # Gửi tới Gemini
+        bot_response, mood_trend = _generate_and_finalize(turn)
+        enhanced_response["reply"] = bot_response
+        enhanced_response["mood_trend"] = mood_trend
+        if turn['emergency_detected']:
+            time_to_resources_hist.observe(time.perf_counter() - request_start)
+
         logger.info(f"Xử lý hoàn tất cho user {user_id}")
-        return jsonify(enhanced_response)
+        return enhanced_response
+    finally:
+        release()
+
+@app.route('/chat', methods=['POST'])
+def enhanced_chat():
+    try:
+        request_start = time.perf_counter()
+        user_input, user_id, error = _parse_chat_request()
+        if error:
+            return error
+
+        if user_id == ANONYMOUS_USER_ID:
+            # Không biết ai gửi: hai người khác nhau có thể gửi cùng một câu nên không gộp
+            enhanced_response = _chat_turn_response(request_start, user_id, user_input)
+        else:
+            # Tin nhắn giống hệt của cùng user đang được xử lý (vd: proxy gửi lại khi hết thời gian chờ):
+            # chờ và dùng chung kết quả thay vì gọi Gemini và ghi lịch sử hai lần
+            key = (user_id, normalize_text(user_input))
+            leader, future = admission.join(key)
+            if leader:
+                try:
+                    future.set_result(_chat_turn_response(request_start, user_id, user_input))
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    admission.leave(key, future)
+                enhanced_response = future.result()
+            else:
+                logger.info(f"Gộp tin nhắn trùng đang xử lý của user {user_id}")
+                try:
+                    enhanced_response = dict(future.result(timeout=ADMISSION_COALESCE_TIMEOUT), coalesced=True)
+                except FutureTimeoutError:
+                    admission.coalesce_timeout()
+
+        with tracer.stage('serialize'):
+            return jsonify(enhanced_response)
 
+    except AdmissionRejected as rejected:
+        logger.warning(f"Từ chối tin nhắn ({rejected.reason}), thử lại sau {rejected.retry_after}s")
+        return _rejected_response(rejected)
     except Exception as e:
         logger.error(f"Lỗi trong enhanced_chat: {e}")
         logger.error(traceback.format_exc())
         return jsonify({"error": "Đã có lỗi xảy ra khi xử lý yêu cầu", "detail": str(e)}), 500
 
+@app.route('/chat/reply/<reply_id>', methods=['GET'])
+def get_pending_reply(reply_id):
+    """Lấy phản hồi được tạo sau của tin nhắn khủng hoảng (?wait=giây để long-poll)"""
+    wait_seconds = min(request.args.get('wait', 0, type=float), 25.0)
+    found, result = pending_replies.get(reply_id, wait_seconds)
+    if not found:
+        return jsonify({"error": "Không tìm thấy phản hồi hoặc đã hết hạn"}), 404
+    if result is None:
+        return jsonify({"status": "pending"}), 202
+    return jsonify(result)
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def enhanced_chat_stream():
+    """Như /chat nhưng trả về Server-Sent Events: phân tích trước, sau đó từng đoạn phản hồi của Gemini"""
+    try:
+        request_start = time.perf_counter()
+        user_input, user_id, error = _parse_chat_request()
+        if error:
+            return error
+
+        # Giữ lượt xử lý tới khi stream kết thúc
+        release = _admit_chat(user_id, user_input)
+        try:
+            logger.info(f"Nhận tin nhắn (stream) từ user {user_id}: {user_input[:50]}...")
+            turn = prepare_chat_turn(user_id, user_input)
+        except Exception:
+            release()
+            raise
+    except AdmissionRejected as rejected:
+        logger.warning(f"Từ chối tin nhắn stream ({rejected.reason}), thử lại sau {rejected.retry_after}s")
+        return _rejected_response(rejected)
+    except Exception as e:
+        logger.error(f"Lỗi trong enhanced_chat_stream: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": "Đã có lỗi xảy ra khi xử lý yêu cầu", "detail": str(e)}), 500
+
+    def generate():
+        initial = {
+            "sentiment_analysis": turn['sentiment_analysis'],
+            "depression_indicators": turn['depression_indicators'],
+            "recommendations": turn['recommendations'],
+            "emergency_detected": turn['emergency_detected']
+        }
+        if turn['emergency_detected']:
+            initial["emergency_resources"] = recommender.get_emergency_resources()
+        yield _sse_event('analysis', initial)
+        if turn['emergency_detected']:
+            time_to_resources_hist.observe(time.perf_counter() - request_start)
+
+        chunks = []
+        finalized = False
+        try:
+            try:
+                for text in stream_reply(turn):
+                    chunks.append(text)
+                    yield _sse_event('token', {"text": text})
+            except Exception as e:
+                logger.error(f"Lỗi API Gemini (stream): {e}")
+                if not chunks:
+                    chunks.append(FALLBACK_RESPONSE)
+                    yield _sse_event('token', {"text": FALLBACK_RESPONSE})
+
+            bot_response = ''.join(chunks)
+            finalized = True
+            mood_trend = finalize_chat_turn(turn, bot_response)
+            logger.info(f"Xử lý hoàn tất (stream) cho user {user_id}")
+            yield _sse_event('done', {"reply": bot_response, "mood_trend": mood_trend})
+        finally:
+            # Client ngắt kết nối giữa chừng: vẫn lưu phần phản hồi đã nhận
+            if not finalized:
+                finalize_chat_turn(turn, ''.join(chunks) or FALLBACK_RESPONSE)
+            release()
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Generator chưa chạy khi client ngắt sớm thì finally ở trên không chạy
+    response.call_on_close(release)
+    return response
+
+MOOD_TRACKING_DEFAULT_DAYS = 7
+MOOD_RESOLUTIONS = {'hour': 3600, 'day': 86400}
+
+def _parse_time_arg(name, default):
+    """Đọc tham số thời gian dạng epoch giây hoặc ISO 8601 (UTC)"""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is not None:
+            return parsed.timestamp()
+        return (parsed - datetime(1970, 1, 1)).total_seconds()
+
 @app.route('/mood-tracking/<user_id>', methods=['GET'])
 def get_mood_tracking(user_id):
-    """Lấy lịch sử theo dõi tâm trạng"""
+    """Lấy lịch sử tâm trạng trong khoảng ?since=&until= (mặc định 7 ngày gần nhất), ?resolution=raw|hour|day"""
+    try:
+        until = _parse_time_arg('until', time.time())
+        since = _parse_time_arg('since', until - MOOD_TRACKING_DEFAULT_DAYS * 86400)
+    except ValueError:
+        return jsonify({"error": "Thời gian không hợp lệ (epoch giây hoặc ISO 8601)"}), 400
+    resolution = request.args.get('resolution', 'raw')
+    if resolution != 'raw' and resolution not in MOOD_RESOLUTIONS:
+        return jsonify({"error": "resolution phải là raw, hour hoặc day"}), 400
+
     try:
-        if user_id in chat_sessions:
-            mood_data = chat_sessions[user_id]['mood_tracking']
-            # Chỉ lấy 7 ngày gần nhất
-            recent_data = mood_data[-7*24:] if len(mood_data) > 7*24 else mood_data
-            return jsonify({"mood_tracking": recent_data})
+        with tracer.stage('db_read'):
+            series = run_blocking(load_mood_series, user_id)
+        if resolution == 'raw':
+            points = series.points(since, until)
         else:
-            return jsonify({"mood_tracking": []})
+            points = series.downsample(MOOD_RESOLUTIONS[resolution], since, until)
+        return jsonify({"mood_tracking": points, "resolution": resolution})
     except Exception as e:
         logger.error(f"Lỗi lấy mood tracking: {e}")
         return jsonify({"error": "Lỗi lấy dữ liệu theo dõi"}), 500
@@ -493,8 +3429,7 @@ def reset_chat():
         user_id = data.get('user_id', 'default_user') if data else 'default_user'
         
         # Reset phiên chat
-        if user_id in chat_sessions:
-            del chat_sessions[user_id]
+        reset_chat_session(user_id)
         
         # Tạo phiên mới
         get_or_create_chat_session(user_id)
@@ -510,63 +3445,954 @@ def health_check():
     return jsonify({
         "status": "ok", 
         "message": "Enhanced Depression Support AI đang hoạt động",
-        "features": ["PhoBERT Integration", "Mood Tracking", "Personalized Recommendations", "Emergency Detection"]
+        "features": ["PhoBERT Integration", "Mood Tracking", "Personalized Recommendations", "Emergency Detection"],
+        "models": model_registry.stats(),
+        "inference": dict(nlp_processor.batcher.stats(), **nlp_processor.inference_stats()),
+        "sentiment": {"backend": nlp_processor.sentiment_backend, "fallbacks": nlp_processor.sentiment_fallbacks},
+        "analysis_cache": analysis_cache.stats(),
+        "database": dict(database.stats(), schema_version=get_schema_version(), archive=archive_stats()),
+        "sessions": session_stats(),
+        "admission": admission.stats(),
+        "process": dict(pid=os.getpid(), **_memory_usage()),
+        "prompt": prompt_context.stats(),
+        "gemini": gemini_client.stats(),
+        "crisis": {
+            "fast_path_count": crisis_fast_path_count,
+            "pending_replies": pending_replies.pending(),
+            "llm_waiting": llm_semaphore.waiting(),
+            "time_to_resources_seconds": time_to_resources_hist.snapshot()
+        }
     }), 200
 
+# Xuất số liệu theo định dạng text của Prometheus (mỗi worker gunicorn có bộ đếm riêng)
+class PrometheusWriter:
+    def __init__(self, prefix='iamhere_'):
+        self.prefix = prefix
+        self.lines = []
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{_prometheus_escape(value)}"' for key, value in labels.items()) + '}'
+
+    def _header(self, name, kind, help_text):
+        self.lines.append(f'# HELP {self.prefix}{name} {help_text}')
+        self.lines.append(f'# TYPE {self.prefix}{name} {kind}')
+
+    def gauge(self, name, help_text, samples):
+        self._write(name, 'gauge', help_text, samples)
+
+    def counter(self, name, help_text, samples):
+        self._write(name, 'counter', help_text, samples)
+
+    def _write(self, name, kind, help_text, samples):
+        self._header(name, kind, help_text)
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f'{self.prefix}{name}{self._labels(labels)} {value}')
+
+    def histogram(self, name, help_text, samples):
+        self._header(name, 'histogram', help_text)
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, hist in samples:
+            snapshot = hist.snapshot()
+            for bound, count in snapshot['buckets'].items():
+                self.lines.append(f'{self.prefix}{name}_bucket{self._labels(dict(labels, le=bound))} {count}')
+            self.lines.append(f'{self.prefix}{name}_sum{self._labels(labels)} {snapshot["sum"]}')
+            self.lines.append(f'{self.prefix}{name}_count{self._labels(labels)} {snapshot["count"]}')
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+def _prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Số liệu vận hành cho Prometheus: độ trễ từng route/giai đoạn, phiên, cache, hàng đợi DB, Gemini"""
+    writer = PrometheusWriter()
+
+    writer.histogram('request_duration_seconds', 'Thời gian xử lý request theo route',
+                     [({'method': method, 'route': route}, hist) for (method, route), hist in tracer.request_histograms()])
+    writer.counter('requests_total', 'Số request theo route và mã trạng thái',
+                   [({'method': method, 'route': route, 'status': status}, count) for (method, route, status), count in tracer.status_counts()])
+    writer.counter('slow_requests_total', f'Số request chậm hơn {SLOW_REQUEST_MS:g} ms', tracer.slow_requests)
+    writer.histogram('stage_duration_seconds', 'Thời gian từng giai đoạn xử lý',
+                     [({'stage': name}, hist) for name, hist in tracer.stage_histograms()])
+
+    sessions = session_stats()
+    writer.gauge('active_sessions', 'Số phiên chat đang giữ', sessions['sessions'])
+    if 'bytes' in sessions:
+        writer.gauge('session_bytes', 'Dung lượng ước tính của các phiên chat trong bộ nhớ', sessions['bytes'])
+    writer.counter('session_lookups_total', 'Số lần tra phiên chat',
+                   [({'result': 'hit'}, sessions['hits']), ({'result': 'miss'}, sessions['misses'])])
+    writer.counter('session_rebuilds_total', 'Số phiên dựng lại từ chat_history', session_rebuilds)
+
+    cache = analysis_cache.stats()
+    writer.counter('analysis_cache_lookups_total', 'Số lần tra cache phân tích',
+                   [({'result': 'hit'}, cache['hits']), ({'result': 'disk_hit'}, cache['disk_hits']), ({'result': 'miss'}, cache['misses'])])
+    writer.gauge('analysis_cache_entries', 'Số mục trong cache phân tích', cache['entries'])
+    writer.gauge('analysis_cache_bytes', 'Dung lượng cache phân tích', cache['bytes'])
+
+    db = database.stats()
+    writer.gauge('db_write_queue_depth', 'Số thao tác ghi đang chờ trong hàng đợi', db['queue_depth'])
+    writer.counter('db_writes_total', 'Số thao tác ghi đã thực hiện', db['written'])
+    writer.counter('db_write_errors_total', 'Số thao tác ghi lỗi', db['errors'])
+
+    batcher = nlp_processor.batcher
+    writer.gauge('inference_pending', 'Số câu đang chờ suy luận PhoBERT', batcher.stats()['pending'])
+    writer.histogram('inference_batch_size', 'Kích thước batch suy luận', batcher.batch_size_hist)
+    writer.histogram('inference_seconds', 'Thời gian một batch suy luận', batcher.inference_hist)
+    writer.counter('inference_texts_total', 'Số văn bản đưa vào transformer', nlp_processor.inference_texts)
+    writer.counter('inference_truncated_total', f'Số văn bản bị cắt ở {INFERENCE_MAX_LENGTH} token', nlp_processor.truncated_texts)
+    writer.histogram('inference_sequence_length', 'Số token mỗi văn bản sau khi cắt', nlp_processor.sequence_length_hist)
+
+    gemini = gemini_client.stats()
+    writer.gauge('gemini_breaker_open', 'Circuit breaker của Gemini đang mở', int(gemini['breaker_state'] == 'open'))
+    writer.counter('gemini_calls_total', 'Số lần gọi Gemini', gemini['calls'])
+    writer.counter('gemini_retries_total', 'Số lần thử lại Gemini', gemini['retries'])
+    writer.counter('gemini_timeouts_total', 'Số lần Gemini quá hạn', gemini['timeouts'])
+    writer.counter('gemini_rejected_total', 'Số lần từ chối do breaker mở', gemini['rejected'])
+    writer.histogram('gemini_latency_seconds', 'Độ trễ gọi Gemini', gemini_client.latency_hist)
+    writer.gauge('llm_waiting', 'Số request đang chờ lượt gọi Gemini', llm_semaphore.waiting())
+    writer.histogram('prompt_tokens', 'Số token prompt mỗi lượt', prompt_context.prompt_tokens_hist)
+
+    admission_stats = admission.stats()
+    writer.gauge('admission_queue_depth', 'Số tin nhắn đang chờ lượt xử lý', admission_stats['queue_depth'])
+    writer.gauge('admission_active', 'Số tin nhắn đang được xử lý', admission_stats['active'])
+    writer.counter('admission_admitted_total', 'Số tin nhắn được nhận xử lý',
+                   [({'kind': 'normal'}, admission_stats['admitted']), ({'kind': 'crisis'}, admission_stats['crisis_admitted'])])
+    writer.counter('admission_coalesced_total', 'Số tin nhắn trùng được gộp với yêu cầu đang xử lý', admission_stats['coalesced'])
+    writer.counter('admission_shed_total', 'Số tin nhắn bị từ chối để giảm tải',
+                   [({'reason': reason}, count) for reason, count in admission_stats['shed'].items()])
+    writer.histogram('admission_queue_wait_seconds', 'Thời gian chờ lượt xử lý', admission.queue_wait_hist)
+
+    writer.counter('crisis_fast_path_total', 'Số lần trả tài nguyên khẩn cấp trước khi có phản hồi Gemini', crisis_fast_path_count)
+    writer.gauge('pending_replies', 'Số phản hồi khủng hoảng đang được tạo', pending_replies.pending())
+    writer.histogram('time_to_resources_seconds', 'Thời gian tới khi trả tài nguyên khẩn cấp', time_to_resources_hist)
+
+    writer.counter('exported_rows_total', 'Số dòng lịch sử đã xuất qua /export', exported_rows)
+    writer.counter('report_requests_total', 'Số lần lấy báo cáo cảm xúc',
+                   [({'result': 'cache_hit'}, report_cache_hits), ({'result': 'built'}, report_builds)])
+
+    memory = _memory_usage()
+    writer.gauge('process_resident_memory_bytes', 'Bộ nhớ RSS của worker', memory['rss'])
+    if 'pss' in memory:
+        writer.gauge('process_proportional_memory_bytes', 'Bộ nhớ PSS của worker (phần dùng chung chia đều cho các tiến trình)', memory['pss'])
+        writer.gauge('process_private_memory_bytes', 'Bộ nhớ riêng của worker',
+                     memory.get('private_clean', 0) + memory.get('private_dirty', 0))
+    return Response(writer.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/dashboard/<user_id>')
 def user_dashboard(user_id):
-    """Dashboard cho người dùng xem thống kê cá nhân"""
+    """Dashboard cho người dùng xem thống kê cá nhân (đọc từ bảng tổng hợp theo ngày)"""
     try:
-        conn = sqlite3.connect('depression_support.db')
-        cursor = conn.cursor()
-        
-        # Lấy dữ liệu 30 ngày gần nhất
-        thirty_days_ago = datetime.now() - timedelta(days=30)
-        cursor.execute('''
-            SELECT * FROM chat_history 
-            WHERE user_id = ? AND timestamp > ?
-            ORDER BY timestamp DESC
-        ''', (user_id, thirty_days_ago))
-        
-        chat_history = cursor.fetchall()
+        # Lấy dữ liệu 30 ngày gần nhất (ngày theo UTC như timestamp trong chat_history)
+        since_day = (datetime.utcnow() - timedelta(days=30)).strftime('%Y-%m-%d')
+        with tracer.stage('db_read'):
+            days, indicator_counts = run_blocking(get_daily_stats, user_id, since_day)
         
         # Thống kê cơ bản
-        if chat_history:
-            avg_sentiment = sum(row[4] for row in chat_history) / len(chat_history)
-            chat_count = len(chat_history)
+        chat_count = sum(day[1] for day in days)
+        if chat_count:
+            avg_sentiment = sum(day[2] for day in days) / chat_count
             
-            # Xu hướng cải thiện
-            recent_chats = chat_history[:5]
-            old_chats = chat_history[-5:] if len(chat_history) > 5 else []
+            # Xu hướng cải thiện: so sánh các ngày gần nhất với các ngày cũ nhất (mỗi nhóm ít nhất 5 tin nhắn)
+            def _group_average(ordered_days):
+                count = total = 0
+                for day in ordered_days:
+                    count += day[1]
+                    total += day[2]
+                    if count >= 5:
+                        break
+                return total / count
             
             trend = "stable"
-            if recent_chats and old_chats:
-                recent_avg = sum(row[4] for row in recent_chats) / len(recent_chats)
-                old_avg = sum(row[4] for row in old_chats) / len(old_chats)
+            if chat_count > 5:
+                recent_avg = _group_average(days)
+                old_avg = _group_average(reversed(days))
                 if recent_avg > old_avg + 0.1:
                     trend = "improving"
                 elif recent_avg < old_avg - 0.1:
                     trend = "concerning"
         else:
             avg_sentiment = 0
-            chat_count = 0
             trend = "no_data"
         
-        conn.close()
-        
         dashboard_data = {
             "user_id": user_id,
             "chat_count": chat_count,
             "avg_sentiment": round(avg_sentiment, 2),
             "trend": trend,
-            "last_30_days_data": len(chat_history)
+            "last_30_days_data": chat_count,
+            "indicator_counts": indicator_counts
         }
         
+        # Chuỗi thống kê theo ngày/tuần/tháng: ?granularity=day|week|month
+        granularity = request.args.get('granularity')
+        if granularity in ('day', 'week', 'month'):
+            dashboard_data["series"] = rollup_daily_stats(days, granularity)
+        
         return jsonify(dashboard_data)
     except Exception as e:
         logger.error(f"Lỗi tạo dashboard: {e}")
         return jsonify({"error": "Lỗi tạo dashboard"}), 500
 
+# Xuất lịch sử và báo cáo cảm xúc: yêu cầu header "Authorization: Bearer <EXPORT_TOKEN>"; chưa đặt EXPORT_TOKEN thì tắt hẳn
+EXPORT_TOKEN = os.getenv('EXPORT_TOKEN')
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', '500'))
+EXPORT_COLUMNS = ('id', 'timestamp', 'message', 'response', 'sentiment_score', 'depression_indicators')
+exported_rows = 0
+
+def _check_export_token():
+    """Trả về response lỗi nếu thiếu/sai token xuất dữ liệu, None nếu hợp lệ"""
+    if not EXPORT_TOKEN:
+        return jsonify({"error": "Chức năng xuất dữ liệu chưa được bật (thiếu EXPORT_TOKEN)"}), 403
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer ') and hmac.compare_digest(header[7:].encode(), EXPORT_TOKEN.encode()):
+        return None
+    return jsonify({"error": "Không có quyền xuất dữ liệu"}), 401
+
+def _safe_filename(user_id):
+    return re.sub(r'[^A-Za-z0-9_-]', '_', user_id)[:64] or 'user'
+
+def _format_db_time(epoch):
+    return (datetime(1970, 1, 1) + timedelta(seconds=epoch)).strftime('%Y-%m-%d %H:%M:%S')
+
+def iter_chat_history_chunks(user_id, since=None, until=None, fetch_size=EXPORT_FETCH_SIZE):
+    """Duyệt lịch sử của user theo thời gian (phần đã lưu trữ trước, rồi chat_history), mỗi lần fetch_size dòng"""
+    conditions = ['user_id = ?']
+    params = [user_id]
+    if since is not None:
+        since = _format_db_time(since)
+        conditions.append('timestamp >= ?')
+        params.append(since)
+    if until is not None:
+        until = _format_db_time(until)
+        conditions.append('timestamp <= ?')
+        params.append(until)
+
+    # Bỏ cột user_id của dòng lưu trữ để cùng dạng với EXPORT_COLUMNS
+    archived = (row[:1] + row[2:] for row in iter_archived_rows(user_id, since, until))
+    while True:
+        rows = run_blocking(list, itertools.islice(archived, fetch_size))
+        if not rows:
+            break
+        yield rows
+
+    # Kết nối đọc riêng: export dài không chặn thread ghi nền hay các request khác
+    with database.reader() as conn:
+        cursor = conn.execute(f'''
+            SELECT id, timestamp, message, response, sentiment_score, depression_indicators
+            FROM chat_history
+            WHERE {' AND '.join(conditions)}
+            ORDER BY timestamp, id
+        ''', params)
+        while True:
+            rows = run_blocking(cursor.fetchmany, fetch_size)
+            if not rows:
+                return
+            yield rows
+
+def _export_indicators(raw):
+    try:
+        return json.loads(raw) if raw else []
+    except (TypeError, ValueError):
+        return []
+
+def generate_ndjson_export(chunks):
+    global exported_rows
+    for rows in chunks:
+        lines = []
+        for row in rows:
+            record = dict(zip(EXPORT_COLUMNS, row))
+            record['depression_indicators'] = _export_indicators(record['depression_indicators'])
+            lines.append(json.dumps(record, ensure_ascii=False))
+        exported_rows += len(rows)
+        yield '\n'.join(lines) + '\n'
+
+def generate_csv_export(chunks):
+    import csv
+    import io
+    global exported_rows
+    # BOM để Excel nhận đúng tiếng Việt UTF-8
+    buffer = io.StringIO()
+    buffer.write('\ufeff')
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        for row in rows:
+            writer.writerow(row[:5] + (';'.join(_export_indicators(row[5])),))
+        exported_rows += len(rows)
+        yield buffer.getvalue()
+
+EXPORT_FORMATS = {
+    'ndjson': (generate_ndjson_export, 'application/x-ndjson; charset=utf-8'),
+    'csv': (generate_csv_export, 'text/csv; charset=utf-8')
+}
+
+@app.route('/export/<user_id>', methods=['GET'])
+def export_chat_history(user_id):
+    """Xuất toàn bộ lịch sử trò chuyện của user dạng stream: ?format=ndjson|csv&since=&until="""
+    denied = _check_export_token()
+    if denied is not None:
+        return denied
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": "format phải là ndjson hoặc csv"}), 400
+    try:
+        since = _parse_time_arg('since', None)
+        until = _parse_time_arg('until', None)
+    except ValueError:
+        return jsonify({"error": "Thời gian không hợp lệ (epoch giây hoặc ISO 8601)"}), 400
+
+    generate, mimetype = EXPORT_FORMATS[export_format]
+    filename = f'chat_history_{_safe_filename(user_id)}.{export_format}'
+    logger.info(f"Xuất lịch sử trò chuyện của user {user_id} ({export_format})")
+    return Response(generate(iter_chat_history_chunks(user_id, since, until)), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no'
+    })
+
+# Báo cáo cảm xúc dựng từ bảng tổng hợp theo ngày, lưu cache trên đĩa tới khi có tin nhắn mới
+REPORT_CACHE_DIR = os.getenv('REPORT_CACHE_DIR', 'reports')
+REPORT_DEFAULT_DAYS = 30
+REPORT_MAX_DAYS = 366
+# Tăng khi đổi nội dung/bố cục báo cáo để bỏ các file cache cũ
+REPORT_LAYOUT_VERSION = 1
+REPORT_FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'fonts', 'K2D')
+REPORT_INDICATOR_LABELS = {
+    'sleep_problems': 'Rối loạn giấc ngủ',
+    'appetite_changes': 'Thay đổi khẩu vị',
+    'energy_loss': 'Mệt mỏi, thiếu năng lượng',
+    'concentration_issues': 'Khó tập trung',
+    'hopelessness': 'Cảm giác tuyệt vọng',
+    'guilt_shame': 'Cảm giác tội lỗi, xấu hổ',
+    'social_withdrawal': 'Thu mình, ngại giao tiếp',
+    'suicidal_thoughts': 'Ý nghĩ tự hại'
+}
+report_cache_hits = 0
+report_builds = 0
+_report_fonts_registered = False
+
+def _report_data_version(user_id, since_day):
+    """Dấu phiên bản dữ liệu của báo cáo: đổi khi có tin nhắn mới trong khoảng since_day"""
+    with database.cursor() as cursor:
+        row = cursor.execute('''
+            SELECT COUNT(*), COALESCE(SUM(chat_count), 0), COALESCE(SUM(sentiment_sum), 0), MAX(day)
+            FROM user_daily_stats
+            WHERE user_id = ? AND day >= ?
+        ''', (user_id, since_day)).fetchone()
+    key = json.dumps([REPORT_LAYOUT_VERSION, user_id, since_day, list(row)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def build_emotion_report(user_id, since_day):
+    """Tổng hợp số liệu báo cáo cảm xúc từ user_daily_stats/user_daily_indicators"""
+    days, indicator_counts = get_daily_stats(user_id, since_day)
+    series = rollup_daily_stats(days)
+    chat_count = sum(day[1] for day in days)
+
+    day_moods = {'positive': 0, 'neutral': 0, 'negative': 0}
+    for point in series:
+        if point['avg_sentiment'] > 0.1:
+            day_moods['positive'] += 1
+        elif point['avg_sentiment'] < -0.1:
+            day_moods['negative'] += 1
+        else:
+            day_moods['neutral'] += 1
+
+    return {
+        'user_id': user_id,
+        'generated_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'since_day': since_day,
+        'chat_count': chat_count,
+        'active_days': len(series),
+        'avg_sentiment': round(sum(day[2] for day in days) / chat_count, 3) if chat_count else None,
+        'day_moods': day_moods,
+        'indicator_counts': dict(sorted(indicator_counts.items(), key=lambda item: -item[1])),
+        'best_day': max(series, key=lambda point: point['avg_sentiment']) if series else None,
+        'worst_day': min(series, key=lambda point: point['avg_sentiment']) if series else None,
+        'series': series
+    }
+
+def _register_report_fonts():
+    global _report_fonts_registered
+    if _report_fonts_registered:
+        return
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    pdfmetrics.registerFont(TTFont('K2D', os.path.join(REPORT_FONT_DIR, 'K2D-Regular.ttf')))
+    pdfmetrics.registerFont(TTFont('K2D-Bold', os.path.join(REPORT_FONT_DIR, 'K2D-Bold.ttf')))
+    pdfmetrics.registerFont(TTFont('K2D-Italic', os.path.join(REPORT_FONT_DIR, 'K2D-Italic.ttf')))
+    _report_fonts_registered = True
+
+def _report_date(day):
+    return datetime.strptime(day, '%Y-%m-%d').strftime('%d/%m/%Y')
+
+def _report_mood_chart(series, width, height):
+    """Biểu đồ điểm cảm xúc trung bình theo ngày"""
+    from reportlab.lib import colors
+    from reportlab.graphics.shapes import Drawing
+    from reportlab.graphics.charts.linecharts import HorizontalLineChart
+
+    drawing = Drawing(width, height)
+    chart = HorizontalLineChart()
+    chart.x, chart.y = 40, 30
+    chart.width, chart.height = width - 60, height - 45
+    chart.data = [[point['avg_sentiment'] for point in series]]
+    chart.lines[0].strokeColor = colors.HexColor('#4a90d9')
+    chart.lines[0].strokeWidth = 2
+    # Giữ tối đa khoảng 10 nhãn ngày trên trục hoành
+    step = max(1, -(-len(series) // 10))
+    chart.categoryAxis.categoryNames = [
+        _report_date(point['period'])[:5] if index % step == 0 else ''
+        for index, point in enumerate(series)
+    ]
+    chart.categoryAxis.joinAxisMode = 'bottom'
+    chart.categoryAxis.labels.fontName = 'K2D'
+    chart.categoryAxis.labels.fontSize = 8
+    chart.valueAxis.valueMin = -1
+    chart.valueAxis.valueMax = 1
+    chart.valueAxis.valueStep = 0.5
+    chart.valueAxis.labels.fontName = 'K2D'
+    chart.valueAxis.labels.fontSize = 8
+    chart.valueAxis.visibleGrid = True
+    chart.valueAxis.gridStrokeColor = colors.HexColor('#dddddd')
+    drawing.add(chart)
+    return drawing
+
+def render_emotion_report_pdf(report, path):
+    """Xuất báo cáo ra PDF (ReportLab, font K2D) theo bố cục phiếu theo dõi của dự án"""
+    from xml.sax.saxutils import escape
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_RIGHT
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.lib.units import cm
+    from reportlab.platypus import SimpleDocTemplate, KeepTogether, Paragraph, Spacer, Table, TableStyle
+
+    _register_report_fonts()
+    header = ParagraphStyle('header', fontName='K2D-Bold', fontSize=12, leading=16, alignment=TA_CENTER)
+    title = ParagraphStyle('title', fontName='K2D-Bold', fontSize=18, leading=24, alignment=TA_CENTER, spaceBefore=12, spaceAfter=12)
+    heading = ParagraphStyle('heading', fontName='K2D-Bold', fontSize=14, leading=18, spaceBefore=12, spaceAfter=6)
+    body = ParagraphStyle('body', fontName='K2D', fontSize=11, leading=16, alignment=TA_JUSTIFY)
+    signature = ParagraphStyle('signature', fontName='K2D', fontSize=11, leading=16, alignment=TA_RIGHT)
+    signature_italic = ParagraphStyle('signature_italic', parent=signature, fontName='K2D-Italic')
+
+    def _table(rows, col_widths):
+        table = Table(rows, colWidths=col_widths)
+        table.setStyle(TableStyle([
+            ('FONTNAME', (0, 0), (-1, -1), 'K2D'),
+            ('FONTNAME', (0, 0), (-1, 0), 'K2D-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#e8f0fb')),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#999999')),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 6)
+        ]))
+        return table
+
+    generated = datetime.strptime(report['generated_at'], '%Y-%m-%d %H:%M:%S').strftime('%d/%m/%Y')
+    story = [
+        Paragraph('Cộng hoà xã hội chủ nghĩa Việt Nam', header),
+        Paragraph('Độc lập - Tự do - Hạnh phúc', header),
+        Paragraph('-----oOo-----', header),
+        Paragraph('Hành Trình Theo Dõi Sức Khỏe Tâm Lý', title),
+        Paragraph(
+            'Phiếu theo dõi sức khỏe tâm lý này được xây dựng, quản lý và cấp phép chính thức bởi dự án IAmHere. '
+            'Mọi thông tin trong phiếu được đảm bảo tuân thủ các tiêu chuẩn bảo mật và quyền riêng tư. '
+            f'Thông tin này được cấp phép chính thức vào ngày {generated}.', body),
+        Paragraph('Thông Tin Người Dùng', heading),
+        _table([
+            ['Thông Tin', 'Chi Tiết'],
+            ['Mã người dùng', Paragraph(escape(report['user_id']), body)],
+            ['Khoảng thời gian', f"{_report_date(report['since_day'])} - {generated}"],
+            ['Số cuộc trò chuyện', str(report['chat_count'])],
+            ['Số ngày có trò chuyện', str(report['active_days'])],
+            ['Điểm cảm xúc trung bình', '-' if report['avg_sentiment'] is None else f"{report['avg_sentiment']:+.2f}"]
+        ], [6 * cm, 10 * cm]),
+        Paragraph('Thống Kê Cảm Xúc', heading),
+        _table([
+            ['Loại Cảm Xúc', 'Số Ngày'],
+            ['Tích cực', str(report['day_moods']['positive'])],
+            ['Trung tính', str(report['day_moods']['neutral'])],
+            ['Tiêu cực', str(report['day_moods']['negative'])]
+        ], [10 * cm, 6 * cm])
+    ]
+
+    if report['indicator_counts']:
+        story.append(Paragraph('Dấu Hiệu Cần Lưu Ý', heading))
+        story.append(_table(
+            [['Dấu Hiệu', 'Số Lần']] + [
+                [REPORT_INDICATOR_LABELS.get(indicator, indicator), str(count)]
+                for indicator, count in report['indicator_counts'].items()
+            ],
+            [10 * cm, 6 * cm]
+        ))
+
+    if report['series']:
+        best, worst = report['best_day'], report['worst_day']
+        story.append(Paragraph('Những Ngày Đáng Chú Ý', heading))
+        story.append(_table([
+            ['', 'Ngày', 'Cảm Xúc Trung Bình', 'Số Tin Nhắn'],
+            ['Ngày Tích Cực Nhất', _report_date(best['period']), f"{best['avg_sentiment']:+.2f}", str(best['chat_count'])],
+            ['Ngày Tiêu Cực Nhất', _report_date(worst['period']), f"{worst['avg_sentiment']:+.2f}", str(worst['chat_count'])]
+        ], [5 * cm, 3.5 * cm, 4 * cm, 3.5 * cm]))
+        story.append(KeepTogether([
+            Paragraph('Biến Động Cảm Xúc', heading),
+            _report_mood_chart(report['series'], 16 * cm, 8 * cm)
+        ]))
+    else:
+        story.append(Paragraph('Chưa có cuộc trò chuyện nào trong khoảng thời gian này.', body))
+
+    story += [
+        Spacer(1, 12),
+        Paragraph(
+            'Dù kết quả có ra sao, IAmHere hy vọng phiếu theo dõi sẽ mang đến những giá trị tích cực '
+            'và hữu ích cho hành trình chăm sóc sức khỏe tinh thần của bạn.', body),
+        Spacer(1, 18),
+        Paragraph('Trân trọng,', signature),
+        Paragraph(f'(Đã ký vào ngày {generated})', signature_italic),
+        Paragraph('Đội ngũ Dự Án IAmHere', signature)
+    ]
+    SimpleDocTemplate(path, pagesize=A4, leftMargin=2.5 * cm, rightMargin=2.5 * cm,
+                      topMargin=2 * cm, bottomMargin=2 * cm, title='Báo cáo cảm xúc IAmHere').build(story)
+
+def _write_report_json(report, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False)
+
+REPORT_FORMATS = {
+    'pdf': (render_emotion_report_pdf, 'application/pdf'),
+    'json': (_write_report_json, 'application/json')
+}
+
+def get_emotion_report(user_id, days_back, report_format):
+    """Trả về đường dẫn file báo cáo trong cache, chỉ dựng lại khi dữ liệu tổng hợp đã thay đổi"""
+    global report_cache_hits, report_builds
+    since_day = (datetime.utcnow() - timedelta(days=days_back)).strftime('%Y-%m-%d')
+    version = _report_data_version(user_id, since_day)
+    # Thêm hash của user_id để hai user có tên gần giống nhau không dùng chung file
+    prefix = (f'emotion_report_user_{_safe_filename(user_id)}_'
+              f'{hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:8]}_{days_back}d_')
+    # Đường dẫn tuyệt đối: send_file của Flask hiểu đường dẫn tương đối theo thư mục app
+    path = os.path.abspath(os.path.join(REPORT_CACHE_DIR, f'{prefix}{version}.{report_format}'))
+    if os.path.exists(path):
+        report_cache_hits += 1
+        return path
+
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    report = build_emotion_report(user_id, since_day)
+    # Ghi ra file tạm rồi đổi tên: request đồng thời không bao giờ đọc phải file dở dang
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        REPORT_FORMATS[report_format][0](report, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    report_builds += 1
+
+    # Bỏ các phiên bản cũ của cùng báo cáo
+    for name in os.listdir(REPORT_CACHE_DIR):
+        if name.startswith(prefix) and name.endswith(f'.{report_format}') and name != os.path.basename(path):
+            try:
+                os.remove(os.path.join(REPORT_CACHE_DIR, name))
+            except OSError:
+                pass
+    return path
+
+@app.route('/report/<user_id>', methods=['GET'])
+def emotion_report(user_id):
+    """Báo cáo cảm xúc của user: ?format=pdf|json&days=30"""
+    denied = _check_export_token()
+    if denied is not None:
+        return denied
+    report_format = request.args.get('format', 'pdf')
+    if report_format not in REPORT_FORMATS:
+        return jsonify({"error": "format phải là pdf hoặc json"}), 400
+    try:
+        days_back = int(request.args.get('days', REPORT_DEFAULT_DAYS))
+    except ValueError:
+        return jsonify({"error": "days phải là số nguyên"}), 400
+    if not 1 <= days_back <= REPORT_MAX_DAYS:
+        return jsonify({"error": f"days phải trong khoảng 1-{REPORT_MAX_DAYS}"}), 400
+
+    try:
+        with tracer.stage('report'):
+            path = run_blocking(get_emotion_report, user_id, days_back, report_format)
+    except ImportError:
+        return jsonify({"error": "Chưa cài reportlab để xuất PDF, hãy dùng format=json"}), 501
+    except Exception as e:
+        logger.error(f"Lỗi tạo báo cáo cảm xúc: {e}")
+        return jsonify({"error": "Lỗi tạo báo cáo cảm xúc"}), 500
+    return send_file(path, mimetype=REPORT_FORMATS[report_format][1], as_attachment=report_format == 'pdf',
+                     download_name=f'emotion_report_user_{_safe_filename(user_id)}.{report_format}')
+
+ANALYZE_BATCH_MAX_TEXTS = 1000
+
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """Phân tích sentiment và dấu hiệu trầm cảm cho nhiều văn bản, không gọi Gemini"""
+    try:
+        data = request.get_json()
+        texts = data.get('texts') if data else None
+        if not isinstance(texts, list) or not texts or not all(isinstance(text, str) for text in texts):
+            return jsonify({"error": "Cần danh sách 'texts' gồm các chuỗi"}), 400
+        if len(texts) > ANALYZE_BATCH_MAX_TEXTS:
+            return jsonify({"error": f"Tối đa {ANALYZE_BATCH_MAX_TEXTS} văn bản mỗi yêu cầu"}), 400
+
+        results = []
+        for sentiment_analysis, depression_indicators in run_blocking(nlp_processor.analyze_many, texts):
+            results.append({
+                "sentiment_analysis": sentiment_analysis,
+                "depression_indicators": depression_indicators,
+                "emergency_detected": 'suicidal_thoughts' in depression_indicators or sentiment_analysis['score'] < -0.8
+            })
+        return jsonify({"version": nlp_processor.version, "results": results})
+    except Exception as e:
+        logger.error(f"Lỗi phân tích batch: {e}")
+        return jsonify({"error": "Lỗi phân tích batch", "detail": str(e)}), 500
+
+def _rescore_rows(rows):
+    """Chấm điểm lại các dòng (id, message); chạy trong tiến trình con của process pool"""
+    analyses = nlp_processor.analyze_many([message or '' for _, message in rows])
+    return [
+        (sentiment_analysis['score'], json.dumps(depression_indicators), row_id)
+        for (row_id, _), (sentiment_analysis, depression_indicators) in zip(rows, analyses)
+    ]
+
+@app.cli.command('rescore-history')
+@click.option('--chunk-size', default=5000, show_default=True, help='Số dòng đọc mỗi lần (phân trang theo id)')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Số tiến trình chấm điểm')
+@click.option('--restart', is_flag=True, help='Bỏ checkpoint cũ, chấm lại từ đầu')
+def rescore_history_command(chunk_size, workers, restart):
+    """Chấm điểm lại sentiment_score và depression_indicators trong chat_history (cả phần đã lưu trữ) theo từ khoá hiện tại"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    job = 'rescore_history'
+    database.flush()
+    with database.cursor() as cursor:
+        checkpoint = cursor.execute('SELECT last_id, version FROM job_checkpoints WHERE job = ?', (job,)).fetchone()
+    # Chỉ tiếp tục từ checkpoint nếu cùng phiên bản từ khoá/model
+    last_id = checkpoint[0] if checkpoint and checkpoint[1] == nlp_processor.version and not restart else 0
+    if last_id:
+        click.echo(f"Tiếp tục từ id {last_id}")
+
+    start = time.perf_counter()
+    total = 0
+    # fork để tiến trình con dùng luôn nlp_processor đã khởi tạo
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        while True:
+            with database.cursor() as cursor:
+                rows = cursor.execute(
+                    'SELECT id, message FROM chat_history WHERE id > ? ORDER BY id LIMIT ?', (last_id, chunk_size)
+                ).fetchall()
+            if not rows:
+                break
+
+            slice_size = max(1, -(-len(rows) // workers))
+            updates = [update for part in pool.map(_rescore_rows, [rows[i:i + slice_size] for i in range(0, len(rows), slice_size)])
+                       for update in part]
+            last_id = rows[-1][0]
+
+            # Cập nhật và lưu checkpoint trong cùng một transaction để có thể chạy tiếp khi bị ngắt
+            with database.cursor() as cursor:
+                cursor.execute('BEGIN')
+                cursor.executemany('UPDATE chat_history SET sentiment_score = ?, depression_indicators = ? WHERE id = ?', updates)
+                cursor.execute('''
+                    INSERT INTO job_checkpoints (job, last_id, version, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (job) DO UPDATE SET last_id = excluded.last_id, version = excluded.version, updated_at = excluded.updated_at
+                ''', (job, last_id, nlp_processor.version))
+
+            total += len(rows)
+            elapsed = time.perf_counter() - start
+            click.echo(f"Đã chấm lại {total} dòng (tới id {last_id}), {total / elapsed:.0f} dòng/giây")
+
+    # Các tháng đã lưu trữ: chấm lại rồi ghi lại cả file, checkpoint theo từng tháng
+    def _rescore_archived(rows):
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            slice_size = max(1, -(-len(chunk) // workers))
+            parts = [[(row[0], row[3]) for row in chunk[i:i + slice_size]] for i in range(0, len(chunk), slice_size)]
+            updates = [update for part in pool.map(_rescore_rows, parts) for update in part]
+            for row, (sentiment_score, depression_indicators, _) in zip(chunk, updates):
+                yield row[:5] + (sentiment_score, depression_indicators)
+
+    with database.cursor() as cursor:
+        months = [month for (month,) in cursor.execute('SELECT month FROM chat_archives ORDER BY month')]
+        done = {job[len('rescore_archive:'):] for (job,) in cursor.execute(
+            "SELECT job FROM job_checkpoints WHERE job LIKE 'rescore_archive:%' AND version = ?", (nlp_processor.version,)
+        )}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        for month in months:
+            if month in done and not restart:
+                continue
+            rows = rewrite_archive_month(month, _rescore_archived)
+            with database.cursor() as cursor:
+                cursor.execute('''
+                    INSERT INTO job_checkpoints (job, last_id, version, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (job) DO UPDATE SET last_id = excluded.last_id, version = excluded.version, updated_at = excluded.updated_at
+                ''', (f'rescore_archive:{month}', rows, nlp_processor.version))
+            total += rows
+            click.echo(f"Đã chấm lại {rows} dòng lưu trữ tháng {month}")
+
+    # Điểm đã thay đổi nên bảng tổng hợp theo ngày và chuỗi tâm trạng cần tính lại
+    with database.cursor() as cursor:
+        cursor.execute('BEGIN')
+        rebuild_daily_stats(cursor)
+        rebuild_mood_series(cursor)
+    elapsed = time.perf_counter() - start
+    click.echo(f"Hoàn tất: {total} dòng trong {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} dòng/giây)")
+
+def _iter_chat_messages(chunk_size=5000):
+    """Duyệt các tin nhắn đã lưu trữ rồi các tin nhắn trong chat_history theo từng trang id"""
+    for row in iter_archived_rows():
+        if row[3] and row[3].strip():
+            yield row[3]
+    last_id = 0
+    while True:
+        with database.cursor() as cursor:
+            rows = cursor.execute(
+                'SELECT id, message FROM chat_history WHERE id > ? ORDER BY id LIMIT ?', (last_id, chunk_size)
+            ).fetchall()
+        if not rows:
+            return
+        for _, message in rows:
+            if message and message.strip():
+                yield message
+        last_id = rows[-1][0]
+
+def _label_from_score(score):
+    return -1 if score < -0.3 else 1 if score > 0.3 else 0
+
+def train_sentiment_model(texts, labels, test_fraction=0.2):
+    """Huấn luyện TF-IDF (n-gram ký tự) + LogisticRegression; trả về (model, báo cáo so sánh)"""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.metrics import accuracy_score, f1_score
+
+    # Chia train/test ổn định theo hash nội dung
+    train_idx, test_idx = [], []
+    for index, text in enumerate(texts):
+        bucket = int(hashlib.md5(text.encode('utf-8')).hexdigest(), 16) % 100
+        (test_idx if bucket < test_fraction * 100 else train_idx).append(index)
+    if not test_idx:
+        test_idx = train_idx[-max(1, len(train_idx) // 5):]
+
+    vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 4), min_df=2, sublinear_tf=True, max_features=200000)
+    features = vectorizer.fit_transform([normalize_text(texts[i]) for i in train_idx])
+    classifier = LogisticRegression(max_iter=1000, C=4.0, class_weight='balanced')
+    classifier.fit(features, [labels[i] for i in train_idx])
+
+    version = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    learned = TfidfSentimentModel(vectorizer, classifier, version)
+
+    # So sánh độ chính xác và độ trễ với backend từ khoá trên tập test
+    test_texts = [texts[i] for i in test_idx]
+    test_labels = [labels[i] for i in test_idx]
+
+    start = time.perf_counter()
+    learned_scores = learned.scores(test_texts)
+    learned_batch_ms = (time.perf_counter() - start) * 1000 / len(test_texts)
+    start = time.perf_counter()
+    for text in test_texts[:200]:
+        learned.scores([text])
+    learned_single_ms = (time.perf_counter() - start) * 1000 / min(len(test_texts), 200)
+
+    start = time.perf_counter()
+    keyword_scores = []
+    for text, match in zip(test_texts, nlp_processor.matcher.match_many(test_texts)):
+        keyword_scores.append(nlp_processor.keyword_score(text, match.distinct('depression'), match.distinct('positive')))
+    keyword_ms = (time.perf_counter() - start) * 1000 / len(test_texts)
+
+    learned_labels = [_label_from_score(score) for score in learned_scores]
+    keyword_labels = [_label_from_score(score) for score in keyword_scores]
+    report = {
+        'version': version,
+        'train_size': len(train_idx),
+        'test_size': len(test_idx),
+        'label_counts': {str(label): labels.count(label) for label in TfidfSentimentModel.LABELS},
+        'tfidf_lr': {
+            'accuracy': round(accuracy_score(test_labels, learned_labels), 4),
+            'macro_f1': round(f1_score(test_labels, learned_labels, average='macro'), 4),
+            'ms_per_message_batch': round(learned_batch_ms, 4),
+            'ms_per_message_single': round(learned_single_ms, 4)
+        },
+        'keyword': {
+            'accuracy': round(accuracy_score(test_labels, keyword_labels), 4),
+            'macro_f1': round(f1_score(test_labels, keyword_labels, average='macro'), 4),
+            'ms_per_message': round(keyword_ms, 4)
+        }
+    }
+    learned.metadata = {'trained_at': version, 'report': report}
+    return learned, report
+
+def _benchmark_transformer_pipeline(texts, labels):
+    """Độ trễ và độ chính xác của pipeline RoBERTa trên một mẫu nhỏ (để so sánh)"""
+    mapping = {'negative': -1, 'neutral': 0, 'positive': 1}
+    sample = list(zip(texts, labels))[:200]
+    start = time.perf_counter()
+    predictions = []
+    for offset in range(0, len(sample), PHOBERT_BATCH_SIZE):
+        for probabilities in nlp_processor.classify_sentiment([text for text, _ in sample[offset:offset + PHOBERT_BATCH_SIZE]]):
+            predictions.append(mapping.get(max(probabilities, key=probabilities.get), 0))
+    elapsed_ms = (time.perf_counter() - start) * 1000 / len(sample)
+    correct = sum(1 for prediction, (_, label) in zip(predictions, sample) if prediction == label)
+    return {'accuracy': round(correct / len(sample), 4), 'ms_per_message_batch': round(elapsed_ms, 4), 'sample_size': len(sample)}
+
+@app.cli.command('train-sentiment')
+@click.option('--labels-csv', default=None, help='CSV có cột text,label (label: -1/0/1 hoặc negative/neutral/positive)')
+@click.option('--compare-transformer', is_flag=True, help='Đo thêm pipeline RoBERTa để so sánh')
+def train_sentiment_command(labels_csv, compare_transformer):
+    """Huấn luyện model sentiment TF-IDF + LR từ dữ liệu gán nhãn hoặc nhãn giả từ chat_history"""
+    if labels_csv:
+        import csv
+        mapping = {'negative': -1, 'neutral': 0, 'positive': 1}
+        texts, labels = [], []
+        with open(labels_csv, encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                label = row['label'].strip().lower()
+                texts.append(row['text'])
+                labels.append(mapping[label] if label in mapping else int(label))
+        source = labels_csv
+    else:
+        # Nhãn giả từ backend từ khoá trên toàn bộ chat_history
+        database.flush()
+        texts = list(dict.fromkeys(_iter_chat_messages()))
+        labels = []
+        for text, match in zip(texts, nlp_processor.matcher.match_many(texts)):
+            labels.append(_label_from_score(nlp_processor.keyword_score(text, match.distinct('depression'), match.distinct('positive'))))
+        source = 'chat_history (pseudo-labels)'
+
+    if len(set(labels)) < 2:
+        raise click.ClickException("Cần ít nhất hai nhãn khác nhau để huấn luyện")
+
+    learned, report = train_sentiment_model(texts, labels)
+    report['source'] = source
+    if compare_transformer:
+        report['transformer'] = _benchmark_transformer_pipeline(texts, labels)
+    learned.metadata['report'] = report
+
+    path = learned.save(SENTIMENT_MODEL_DIR)
+    with open(os.path.join(SENTIMENT_MODEL_DIR, f'sentiment_tfidf_lr-{learned.version}.report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    click.echo(json.dumps(report, ensure_ascii=False, indent=2))
+    click.echo(f"Đã lưu model tại {path}; dùng với SENTIMENT_BACKEND=tfidf_lr")
+
+@app.cli.command('backfill-daily-stats')
+@click.option('--user-id', default=None, help='Chỉ tính lại cho một user')
+def backfill_daily_stats_command(user_id):
+    """Tính lại bảng tổng hợp theo ngày và chuỗi tâm trạng từ chat_history và các file lưu trữ"""
+    database.flush()
+    start = time.perf_counter()
+    with database.cursor() as cursor:
+        cursor.execute('BEGIN')
+        rebuild_daily_stats(cursor, user_id)
+        rebuild_mood_series(cursor, user_id)
+        buckets = cursor.execute('SELECT COUNT(*) FROM user_daily_stats').fetchone()[0]
+        series = cursor.execute('SELECT COUNT(*) FROM mood_series').fetchone()[0]
+    click.echo(f"Đã tính lại {buckets} bucket ngày và {series} chuỗi tâm trạng trong {time.perf_counter() - start:.2f}s")
+
+@app.cli.command('archive-history')
+@click.option('--older-than-days', default=RETENTION_DAYS, show_default=True, help='Lưu trữ các tháng kết thúc trước mốc này')
+@click.option('--dry-run', is_flag=True, help='Chỉ liệt kê các tháng sẽ được lưu trữ')
+def archive_history_command(older_than_days, dry_run):
+    """Chuyển chat_history cũ sang file gzip NDJSON theo tháng trong ARCHIVE_DIR rồi thu hồi dung lượng database"""
+    database.flush()
+    # Chỉ lưu trữ trọn tháng: các tháng trước tháng chứa mốc cắt
+    cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).strftime('%Y-%m-01')
+    with database.cursor() as cursor:
+        months = cursor.execute('''
+            SELECT substr(timestamp, 1, 7), COUNT(*) FROM chat_history
+            WHERE timestamp < ? AND user_id IS NOT NULL
+            GROUP BY 1 ORDER BY 1
+        ''', (cutoff,)).fetchall()
+    if dry_run:
+        for month, count in months:
+            click.echo(f"{month}: {count} dòng")
+        return
+
+    start = time.perf_counter()
+    total = 0
+    for month, _ in months:
+        moved = archive_month(month)
+        total += moved
+        click.echo(f"Đã lưu trữ {moved} dòng tháng {month}")
+    removed = cleanup_orphan_archives()
+    if removed:
+        click.echo(f"Đã xoá {removed} file lưu trữ dở dang")
+
+    size_before = os.path.getsize(database.path)
+    free_pages = database.compact()
+    click.echo(f"Hoàn tất: {total} dòng trong {time.perf_counter() - start:.1f}s; "
+               f"thu hồi {free_pages} trang, database {size_before / 1e6:.1f} MB -> {os.path.getsize(database.path) / 1e6:.1f} MB")
+
+# Chế độ nhiều worker gunicorn (preload_app): model và bảng từ khoá được tải trong master trước khi fork
+# để các worker dùng chung trang nhớ theo copy-on-write. PRELOAD_MODELS cùng cú pháp với WARMUP_MODELS.
+PRELOAD_MODELS = os.getenv('PRELOAD_MODELS', '').strip()
+
+def _share_model_memory(loaded):
+    """Đưa tensor của model (hoặc model trong pipeline) vào shared memory"""
+    module = getattr(loaded, 'model', loaded)
+    share = getattr(module, 'share_memory', None)
+    if callable(share):
+        share()
+
+def preload_for_fork():
+    """Gọi trong master gunicorn ngay trước khi tạo worker"""
+    import gc
+
+    names = model_registry.names() if PRELOAD_MODELS == 'all' else [n.strip() for n in PRELOAD_MODELS.split(',') if n.strip()]
+    for name in names:
+        try:
+            _share_model_memory(model_registry.get(name))
+        except Exception:
+            pass  # Lỗi đã được ghi log, worker sẽ tự tải lại khi cần
+
+    # Worker mở kết nối SQLite riêng; master không giữ kết nối hay thao tác ghi dở qua fork
+    database.close()
+
+    # Đóng băng các object hiện có: GC của worker không quét (và ghi vào) chúng nên trang nhớ không bị sao chép
+    gc.collect()
+    gc.freeze()
+    memory = _memory_usage()
+    logger.info(f"Đã tải trước {len(names)} model và đóng băng {gc.get_freeze_count()} object trong master "
+                f"(RSS {memory['rss'] / 1048576:.0f} MB)")
+
+def reinit_after_fork(workers=None):
+    """Gọi trong mỗi worker ngay sau fork: tạo lại trạng thái riêng của tiến trình"""
+    global session_store, model, summary_model, _torch_configured
+
+    if workers is not None:
+        os.environ['GUNICORN_WORKERS'] = str(workers)
+        if workers > 1 and SESSION_BACKEND != 'sqlite':
+            logger.warning(f"{workers} worker nhưng SESSION_BACKEND={SESSION_BACKEND}: phiên chat không dùng chung giữa các worker")
+
+    # Client Gemini (kênh gRPC/HTTP) và thread pool không dùng chung được qua fork
+    configure_genai()
+    model, summary_model = create_gemini_models()
+    gemini_client.reset_after_fork()
+
+    session_store = create_session_store()
+    # Các worker không dùng chung chuỗi ngẫu nhiên của master (jitter khi retry)
+    random.seed()
+
+    if 'torch' in sys.modules:
+        _torch_configured = False
+        _configure_torch()
+    # Kết nối SQLite, thread ghi nền và bộ gom batch tự tạo lại theo pid khi dùng lần đầu
+
 if __name__ == "__main__":
     logger.info("Khởi động Enhanced Depression Support AI Service...")
+    start_model_warmup()
     app.run(host='0.0.0.0', port=10000)
\ No newline at end of file
@@ -0,0 +1,676 @@
+"""Benchmark và load-test cho ai_service với Gemini giả lập cục bộ (không tốn quota API).
+
+Cách dùng:
+    # Server Gemini giả lập (REST), dùng với GEMINI_API_ENDPOINT=http://localhost:8089 GEMINI_TRANSPORT=rest
+    python benchmark.py stub --port 8089 --latency-ms 800 --failure-rate 0.02
+
+    # Chạy toàn bộ benchmark trong tiến trình (tự bật stub), ghi kết quả JSON
+    python benchmark.py run --output bench_output.json
+
+    # Bắn tải vào một server đang chạy
+    python benchmark.py run --url http://localhost:8000 --concurrency 50 --duration 60
+
+    # So sánh hai lần chạy (vd: giữa hai commit)
+    python benchmark.py compare old.json new.json
+
+    # Độ trễ/bộ nhớ của từng backend suy luận (fp32, int8) và độ lệch int8 so với fp32
+    python benchmark.py inference --output inference.json
+
+    # PSS của master và từng worker gunicorn (tự chạy gunicorn với N worker, hoặc đo master có sẵn qua --pid)
+    PRELOAD_MODELS=all python benchmark.py pss --workers 4
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Tin nhắn tiếng Việt mẫu theo nhóm, trộn theo tỉ lệ gần với lưu lượng thật
+MESSAGES = {
+    'greeting': [
+        'Xin chào',
+        'Chào bạn, hôm nay mình muốn nói chuyện một chút',
+        'Hi, bạn có ở đó không?',
+    ],
+    'neutral': [
+        'Hôm nay mình đi làm về muộn, trời mưa to quá',
+        'Mình đang học cho kỳ thi cuối kỳ tuần sau',
+        'Bạn có thể gợi ý cho mình vài cuốn sách hay không?',
+    ],
+    'negative': [
+        'Tôi buồn',
+        'Dạo này mình thấy mệt mỏi và mất ngủ liên tục, không tập trung được vào việc gì',
+        'Mình cảm thấy cô đơn, không ai hiểu mình cả, áp lực công việc quá lớn',
+        'Mình chán ăn, kiệt sức và cảm thấy tội lỗi vì không làm được gì ra hồn',
+        'Cuộc sống khó khăn quá, mình thất vọng về bản thân và hay khóc một mình',
+    ],
+    'positive': [
+        'Hôm nay mình thấy vui vẻ và hạnh phúc hơn nhiều',
+        'Mình biết ơn vì đã có bạn lắng nghe, mình thấy tự tin hơn rồi',
+    ],
+    'crisis': [
+        'Mình tuyệt vọng lắm, không muốn sống nữa',
+        'Mình nghĩ tới chuyện tự tử, cuộc sống vô nghĩa',
+    ],
+}
+MESSAGE_WEIGHTS = {'greeting': 0.15, 'neutral': 0.3, 'negative': 0.4, 'positive': 0.12, 'crisis': 0.03}
+LONG_MESSAGE = ' '.join(MESSAGES['negative'] + MESSAGES['neutral']) * 20
+
+# Tỉ lệ các endpoint trong kịch bản tải
+ENDPOINT_WEIGHTS = {'chat': 0.75, 'dashboard': 0.1, 'mood': 0.12, 'reset': 0.03}
+
+STUB_REPLIES = [
+    'Mình hiểu cảm giác của bạn. Cảm ơn bạn đã chia sẻ với mình. ',
+    'Những gì bạn đang trải qua thật không dễ dàng. ',
+    'Bạn có muốn kể thêm về điều gì khiến bạn cảm thấy như vậy không? ',
+    'Hãy thử hít thở sâu vài lần và cho bản thân nghỉ ngơi một chút nhé. ',
+]
+
+
+def pick_message(rng):
+    group = rng.choices(list(MESSAGE_WEIGHTS), weights=list(MESSAGE_WEIGHTS.values()))[0]
+    if rng.random() < 0.01:
+        return LONG_MESSAGE
+    return rng.choice(MESSAGES[group])
+
+
+# ---------------------------------------------------------------------------
+# Gemini giả lập (REST generateContent / streamGenerateContent)
+# ---------------------------------------------------------------------------
+
+class GeminiStubHandler(BaseHTTPRequestHandler):
+    latency_ms = 800.0
+    jitter_ms = 200.0
+    failure_rate = 0.0
+    chunks = 4
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        time.sleep(max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000.0)
+
+    def _payload(self, text, prompt_tokens):
+        return {
+            'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}, 'finishReason': 'STOP', 'index': 0}],
+            'usageMetadata': {
+                'promptTokenCount': prompt_tokens,
+                'candidatesTokenCount': max(1, len(text) // 3),
+                'totalTokenCount': prompt_tokens + max(1, len(text) // 3),
+            },
+        }
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        prompt_tokens = max(1, len(body.decode('utf-8', 'ignore')) // 3)
+
+        if random.random() < self.failure_rate:
+            self._delay()
+            self.send_response(503)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': {'code': 503, 'message': 'stub overloaded', 'status': 'UNAVAILABLE'}}).encode())
+            return
+
+        reply = ''.join(random.sample(STUB_REPLIES, k=len(STUB_REPLIES)))
+        if ':streamGenerateContent' in self.path:
+            # Trả về từng đoạn, độ trễ chia đều cho các đoạn: SSE nếu client yêu cầu alt=sse,
+            # ngược lại là một mảng JSON được stream dần (định dạng của transport REST trong SDK)
+            sse = 'alt=sse' in self.path
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream' if sse else 'application/json')
+            self.end_headers()
+            size = -(-len(reply) // self.chunks)
+            for index, start in enumerate(range(0, len(reply), size)):
+                time.sleep(max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000.0 / self.chunks)
+                chunk = json.dumps(self._payload(reply[start:start + size], prompt_tokens), ensure_ascii=False)
+                if sse:
+                    self.wfile.write(f'data: {chunk}\r\n\r\n'.encode())
+                else:
+                    self.wfile.write((('[' if index == 0 else ',') + chunk).encode())
+                self.wfile.flush()
+            if not sse:
+                self.wfile.write(b']')
+            return
+
+        self._delay()
+        data = json.dumps(self._payload(reply, prompt_tokens), ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_stub(port=0, latency_ms=800.0, jitter_ms=200.0, failure_rate=0.0):
+    """Chạy Gemini giả lập trong thread nền, trả về (server, url)"""
+    handler = type('ConfiguredStub', (GeminiStubHandler,), {
+        'latency_ms': latency_ms, 'jitter_ms': jitter_ms, 'failure_rate': failure_rate,
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='gemini-stub', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def stub_environment(stub_url, workdir):
+    """Biến môi trường để ai_service dùng stub và database tạm thay vì dữ liệu thật"""
+    return {
+        'GOOGLE_API_KEY': os.environ.get('GOOGLE_API_KEY') or 'benchmark-key',
+        'GEMINI_API_ENDPOINT': stub_url,
+        'GEMINI_TRANSPORT': 'rest',
+        'DATABASE_PATH': os.path.join(workdir, 'benchmark.db'),
+        'ANALYSIS_CACHE_DB': '',
+        # Giới hạn tốc độ của /chat sẽ từ chối phần lớn tải tổng hợp; đặt biến môi trường để đo cả lớp kiểm soát tải
+        'ADMISSION_USER_RATE': os.environ.get('ADMISSION_USER_RATE', '0'),
+        'ADMISSION_GLOBAL_RATE': os.environ.get('ADMISSION_GLOBAL_RATE', '0'),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Bộ sinh tải
+# ---------------------------------------------------------------------------
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'max_ms': round(max(latencies) * 1000, 2) if latencies else None,
+    }
+
+
+class HttpClient:
+    def __init__(self, base_url, timeout=130):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+class FlaskClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, payload=None):
+        response = self.client.open(path, method=method, json=payload)
+        response.get_data()
+        return response.status_code
+
+
+def run_load(make_client, concurrency, duration, users, seed=0):
+    """Chạy tải hỗn hợp trong `duration` giây với `concurrency` luồng"""
+    results = {name: [] for name in ENDPOINT_WEIGHTS}
+    errors = {name: 0 for name in ENDPOINT_WEIGHTS}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        client = make_client()
+        while time.perf_counter() < deadline:
+            user_id = f'bench-user-{rng.randrange(users)}'
+            endpoint = rng.choices(list(ENDPOINT_WEIGHTS), weights=list(ENDPOINT_WEIGHTS.values()))[0]
+            start = time.perf_counter()
+            if endpoint == 'chat':
+                status = client.request('POST', '/chat', {'message': pick_message(rng), 'user_id': user_id})
+            elif endpoint == 'dashboard':
+                status = client.request('GET', f'/dashboard/{user_id}')
+            elif endpoint == 'mood':
+                status = client.request('GET', f'/mood-tracking/{user_id}')
+            else:
+                status = client.request('POST', '/reset', {'user_id': user_id})
+            elapsed = time.perf_counter() - start
+            with lock:
+                results[endpoint].append(elapsed)
+                if status >= 400:
+                    errors[endpoint] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(values) for values in results.values())
+    return {
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 2),
+        'users': users,
+        'requests': total,
+        'requests_per_s': round(total / elapsed, 2),
+        'errors': errors,
+        'all': summarize([value for values in results.values() for value in values]),
+        'endpoints': {name: summarize(values) for name, values in results.items()},
+    }
+
+
+# ---------------------------------------------------------------------------
+# Đo khởi động, bộ nhớ và micro-benchmark
+# ---------------------------------------------------------------------------
+
+STARTUP_SNIPPET = """
+import time, json
+start = time.perf_counter()
+import ai_service
+elapsed = time.perf_counter() - start
+print(json.dumps({'import_s': elapsed, 'rss_mb': ai_service._current_rss_bytes() / 1048576}))
+"""
+
+
+def measure_startup(env, workdir, repeats=3):
+    """Thời gian import ai_service (tạo app) và RSS ngay sau khi khởi động, trong tiến trình mới"""
+    # Chạy trong thư mục tạm để log/database của lần đo không ghi vào repo
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), **env)
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SNIPPET], env=env, cwd=workdir,
+                                capture_output=True, text=True, check=True).stdout
+        measured = json.loads(output.strip().splitlines()[-1])
+        measured['process_s'] = time.perf_counter() - start
+        runs.append(measured)
+    return {
+        'import_s_min': round(min(run['import_s'] for run in runs), 3),
+        'process_s_min': round(min(run['process_s'] for run in runs), 3),
+        'rss_mb': round(min(run['rss_mb'] for run in runs), 1),
+    }
+
+
+def measure_session_memory(ai_service, sessions=500):
+    """RSS tăng thêm trên mỗi phiên chat đang hoạt động"""
+    import gc
+    gc.collect()
+    before = ai_service._current_rss_bytes()
+    for index in range(sessions):
+        user_id = f'memory-user-{index}'
+        session = ai_service.get_or_create_chat_session(user_id)
+        for turn in range(6):
+            session['history'].append({'role': 'user', 'parts': [random.choice(MESSAGES['negative'])]})
+            session['history'].append({'role': 'model', 'parts': [''.join(STUB_REPLIES)]})
+        ai_service.save_chat_session(user_id, session)
+    gc.collect()
+    after = ai_service._current_rss_bytes()
+    return {'sessions': sessions, 'rss_per_session_kb': round((after - before) / sessions / 1024, 2)}
+
+
+def micro_benchmarks(ai_service, iterations=2000):
+    """µs/lần cho các hàm phân tích chính (gọi trực tiếp, không qua analysis_cache)"""
+    processor = ai_service.nlp_processor
+    recommender = ai_service.recommender
+    samples = [text for group in MESSAGES.values() for text in group]
+
+    def timed(fn, texts):
+        start = time.perf_counter()
+        for index in range(iterations):
+            fn(texts[index % len(texts)])
+        return round((time.perf_counter() - start) * 1e6 / iterations, 2)
+
+    analysis = processor.analyze_sentiment(samples[0])
+    indicators = processor.extract_depression_indicators(samples[0])
+    return {
+        'analyze_sentiment_us': timed(processor.analyze_sentiment, samples),
+        'analyze_sentiment_long_us': timed(processor.analyze_sentiment, [LONG_MESSAGE]),
+        'extract_depression_indicators_us': timed(processor.extract_depression_indicators, samples),
+        'extract_depression_indicators_long_us': timed(processor.extract_depression_indicators, [LONG_MESSAGE]),
+        'recommend_activities_us': timed(lambda _: recommender.recommend_activities(analysis, indicators), samples),
+        'long_message_chars': len(LONG_MESSAGE),
+    }
+
+
+INFERENCE_WORKER_SNIPPET = """
+import json, sys, time
+import numpy as np
+import ai_service
+
+texts, with_sentiment, output = json.loads(sys.argv[1]), sys.argv[2] == '1', sys.argv[3]
+processor = ai_service.nlp_processor
+result = {}
+
+rss_before = ai_service._current_rss_bytes()
+start = time.perf_counter()
+processor.phobert_tokenizer, processor.phobert_model
+result['phobert_load_s'] = time.perf_counter() - start
+result['phobert_rss_mb'] = (ai_service._current_rss_bytes() - rss_before) / 1048576
+
+processor.embed_batch(texts[:2])
+single = []
+for text in texts:
+    start = time.perf_counter()
+    processor.embed_batch([text])
+    single.append(time.perf_counter() - start)
+start = time.perf_counter()
+embeddings = np.concatenate([np.stack(processor.embed_batch(texts[i:i + 16])) for i in range(0, len(texts), 16)])
+result['phobert_batch16_ms_per_text'] = (time.perf_counter() - start) * 1000 / len(texts)
+result['phobert_single_ms'] = sorted(single)[len(single) // 2] * 1000
+np.save(output + '.phobert.npy', embeddings)
+
+if with_sentiment:
+    rss_before = ai_service._current_rss_bytes()
+    processor.sentiment_analyzer
+    result['sentiment_rss_mb'] = (ai_service._current_rss_bytes() - rss_before) / 1048576
+    processor.classify_sentiment(texts[:2])
+    start = time.perf_counter()
+    probabilities = [p for i in range(0, len(texts), 16) for p in processor.classify_sentiment(texts[i:i + 16])]
+    result['sentiment_batch16_ms_per_text'] = (time.perf_counter() - start) * 1000 / len(texts)
+    result['sentiment_probabilities'] = probabilities
+
+result['rss_mb'] = ai_service._current_rss_bytes() / 1048576
+result['inference'] = processor.inference_stats()
+with open(output, 'w', encoding='utf-8') as f:
+    json.dump(result, f)
+"""
+
+
+def measure_inference_backend(backend, texts, with_sentiment, workdir, threads):
+    """Tải model và đo trong tiến trình riêng để RSS của mỗi backend không lẫn vào nhau"""
+    output = os.path.join(workdir, f'inference-{backend}.json')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)),
+               INFERENCE_BACKEND=backend, TORCH_NUM_THREADS=str(threads),
+               GOOGLE_API_KEY=os.environ.get('GOOGLE_API_KEY') or 'benchmark-key',
+               DATABASE_PATH=os.path.join(workdir, 'benchmark.db'), ANALYSIS_CACHE_DB='')
+    subprocess.run([sys.executable, '-c', INFERENCE_WORKER_SNIPPET, json.dumps(texts), '1' if with_sentiment else '0', output],
+                   env=env, cwd=workdir, check=True, capture_output=True)
+    with open(output, encoding='utf-8') as f:
+        return json.load(f), output
+
+
+def compare_inference_outputs(reference, reference_path, candidate, candidate_path):
+    """Độ lệch của candidate so với reference: cosine của embedding PhoBERT, độ khớp nhãn và xác suất sentiment"""
+    import numpy as np
+
+    base = np.load(reference_path + '.phobert.npy')
+    other = np.load(candidate_path + '.phobert.npy')
+    cosine = (base * other).sum(axis=1) / (np.linalg.norm(base, axis=1) * np.linalg.norm(other, axis=1))
+    parity = {'phobert_cosine_min': round(float(cosine.min()), 5), 'phobert_cosine_mean': round(float(cosine.mean()), 5)}
+
+    if 'sentiment_probabilities' in reference and 'sentiment_probabilities' in candidate:
+        pairs = list(zip(reference['sentiment_probabilities'], candidate['sentiment_probabilities']))
+        parity['sentiment_label_agreement'] = round(
+            sum(1 for a, b in pairs if max(a, key=a.get) == max(b, key=b.get)) / len(pairs), 4)
+        parity['sentiment_max_prob_diff'] = round(max(abs(a[label] - b[label]) for a, b in pairs for label in a), 5)
+    return parity
+
+
+def read_memory(pid):
+    """RSS/PSS và phần chia sẻ/riêng (MB) của một tiến trình, từ /proc/<pid>/smaps_rollup"""
+    usage = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                usage[key.lower() + '_mb'] = round(int(value.split()[0]) / 1024, 1)
+    return usage
+
+
+def child_pids(parent):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Trường sau tên tiến trình (có thể chứa dấu cách) là state rồi tới ppid
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def measure_workers(master_pid):
+    workers = [dict(pid=pid, **read_memory(pid)) for pid in child_pids(master_pid)]
+    master = dict(pid=master_pid, **read_memory(master_pid))
+    total_pss = master['pss_mb'] + sum(worker['pss_mb'] for worker in workers)
+    return {
+        'master': master,
+        'workers': workers,
+        'worker_count': len(workers),
+        'total_pss_mb': round(total_pss, 1),
+        'avg_worker_pss_mb': round(sum(w['pss_mb'] for w in workers) / len(workers), 1) if workers else None,
+        'avg_worker_private_mb': round(sum(w['private_clean_mb'] + w['private_dirty_mb'] for w in workers) / len(workers), 1) if workers else None,
+        # Tổng RSS đếm trùng phần dùng chung; chênh lệch so với tổng PSS là phần tiết kiệm được nhờ copy-on-write
+        'total_rss_mb': round(master['rss_mb'] + sum(w['rss_mb'] for w in workers), 1),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Lệnh
+# ---------------------------------------------------------------------------
+
+def command_stub(args):
+    server, url = start_stub(args.port, args.latency_ms, args.jitter_ms, args.failure_rate)
+    print(f'Gemini giả lập đang chạy tại {url} (Ctrl+C để dừng)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def command_run(args):
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'config': {
+            'concurrency': args.concurrency, 'duration_s': args.duration, 'users': args.users,
+            'stub_latency_ms': args.latency_ms, 'stub_failure_rate': args.failure_rate,
+        },
+    }
+
+    if args.url:
+        results['load'] = run_load(lambda: HttpClient(args.url), args.concurrency, args.duration, args.users, args.seed)
+    else:
+        workdir = tempfile.mkdtemp(prefix='iamhere-bench-')
+        _, stub_url = start_stub(0, args.latency_ms, args.jitter_ms, args.failure_rate)
+        env = stub_environment(stub_url, workdir)
+        results['startup'] = measure_startup(env, workdir)
+
+        os.environ.update(env)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import ai_service
+
+        results['micro'] = micro_benchmarks(ai_service)
+        results['load'] = run_load(lambda: FlaskClient(ai_service.app), args.concurrency, args.duration, args.users, args.seed)
+        results['memory'] = measure_session_memory(ai_service)
+        ai_service.database.flush()
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+def command_inference(args):
+    texts = [text for group in MESSAGES.values() for text in group] + [LONG_MESSAGE]
+    workdir = tempfile.mkdtemp(prefix='iamhere-inference-')
+    threads = args.threads or max(1, os.cpu_count() or 1)
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'config': {'threads': threads, 'texts': len(texts), 'sentiment': not args.no_sentiment},
+        'backends': {},
+    }
+
+    outputs = {}
+    for backend in args.backends.split(','):
+        measured, path = measure_inference_backend(backend, texts, not args.no_sentiment, workdir, threads)
+        outputs[backend] = (measured, path)
+        results['backends'][backend] = {key: round(value, 3) if isinstance(value, float) else value
+                                        for key, value in measured.items() if key != 'sentiment_probabilities'}
+
+    # Tham chiếu là fp32; mỗi backend còn lại được so với nó
+    if 'fp32' in outputs:
+        results['parity'] = {
+            backend: compare_inference_outputs(*outputs['fp32'], *outputs[backend])
+            for backend in outputs if backend != 'fp32'
+        }
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+def command_pss(args):
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {'workers': args.workers, 'preload_models': os.environ.get('PRELOAD_MODELS', ''), 'duration_s': args.duration},
+    }
+    if args.pid:
+        results['memory'] = measure_workers(args.pid)
+    else:
+        workdir = tempfile.mkdtemp(prefix='iamhere-pss-')
+        _, stub_url = start_stub(0, args.latency_ms, args.jitter_ms, args.failure_rate)
+        root = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, PYTHONPATH=root, GUNICORN_WORKERS=str(args.workers), **stub_environment(stub_url, workdir))
+        url = f'http://127.0.0.1:{args.port}'
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', os.path.join(root, 'gunicorn.conf.py'),
+             '--bind', f'127.0.0.1:{args.port}', 'ai_service:app'],
+            env=env, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            client = HttpClient(url, timeout=5)
+            deadline = time.time() + args.startup_timeout
+            while True:
+                try:
+                    if client.request('GET', '/health') == 200 and len(child_pids(server.pid)) >= args.workers:
+                        break
+                except OSError:
+                    pass
+                if time.time() > deadline or server.poll() is not None:
+                    raise SystemExit('gunicorn không khởi động được')
+                time.sleep(0.5)
+            results['memory_idle'] = measure_workers(server.pid)
+            if args.duration > 0:
+                results['load'] = run_load(lambda: HttpClient(url), args.concurrency, args.duration, args.users)
+            results['memory'] = measure_workers(server.pid)
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+def _flatten(data, prefix=''):
+    flat = {}
+    for key, value in data.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def command_compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = _flatten(json.load(f))
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = _flatten(json.load(f))
+    for key in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[key], candidate[key]
+        change = f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+        print(f'{key:55s} {old:>12} -> {new:>12}  {change}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_stub_options(sub):
+        sub.add_argument('--latency-ms', type=float, default=800.0, help='Độ trễ trung bình của Gemini giả lập')
+        sub.add_argument('--jitter-ms', type=float, default=200.0, help='Độ lệch chuẩn của độ trễ')
+        sub.add_argument('--failure-rate', type=float, default=0.02, help='Tỉ lệ trả về 503')
+
+    stub = subparsers.add_parser('stub', help='Chạy server Gemini giả lập')
+    stub.add_argument('--port', type=int, default=8089)
+    add_stub_options(stub)
+    stub.set_defaults(func=command_stub)
+
+    run = subparsers.add_parser('run', help='Chạy benchmark')
+    run.add_argument('--url', help='Bắn tải vào server đang chạy thay vì chạy trong tiến trình')
+    run.add_argument('--concurrency', type=int, default=20)
+    run.add_argument('--duration', type=float, default=30.0, help='Thời gian tải (giây)')
+    run.add_argument('--users', type=int, default=200, help='Số user_id khác nhau')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', help='Ghi kết quả JSON vào file')
+    add_stub_options(run)
+    run.set_defaults(func=command_run)
+
+    compare = subparsers.add_parser('compare', help='So sánh hai file kết quả')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+    compare.set_defaults(func=command_compare)
+
+    inference = subparsers.add_parser('inference', help='Đo và so sánh các backend suy luận transformer')
+    inference.add_argument('--backends', default='fp32,int8')
+    inference.add_argument('--threads', type=int, default=0, help='TORCH_NUM_THREADS (mặc định: số CPU)')
+    inference.add_argument('--no-sentiment', action='store_true', help='Chỉ đo PhoBERT, bỏ qua pipeline RoBERTa')
+    inference.add_argument('--output', help='Ghi kết quả JSON vào file')
+    inference.set_defaults(func=command_inference)
+
+    pss = subparsers.add_parser('pss', help='Đo PSS của master và các worker gunicorn')
+    pss.add_argument('--pid', type=int, help='Đo master gunicorn đang chạy thay vì tự khởi động')
+    pss.add_argument('--workers', type=int, default=4)
+    pss.add_argument('--port', type=int, default=8765)
+    pss.add_argument('--startup-timeout', type=float, default=300.0)
+    pss.add_argument('--duration', type=float, default=10.0, help='Thời gian tải trước khi đo lần hai (0 = chỉ đo lúc rảnh)')
+    pss.add_argument('--concurrency', type=int, default=8)
+    pss.add_argument('--users', type=int, default=200)
+    pss.add_argument('--output', help='Ghi kết quả JSON vào file')
+    add_stub_options(pss)
+    pss.set_defaults(func=command_pss)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,15 +9,63 @@ if ($_SERVER['REQUEST_METHOD'] == 'OPTIONS') {
     exit(0);
 }
 
+// Mã định danh ổn định cho mỗi người dùng (lưu trong cookie), để dịch vụ AI giữ phiên chat
+// và giới hạn tốc độ theo từng người thay vì gộp mọi người vào cùng một user
+function get_visitor_id() {
+    $cookie_name = 'iamhere_visitor';
+    if (isset($_COOKIE[$cookie_name]) && preg_match('/^[a-f0-9]{32}$/', $_COOKIE[$cookie_name])) {
+        return $_COOKIE[$cookie_name];
+    }
+    $visitor_id = bin2hex(random_bytes(16));
+    setcookie($cookie_name, $visitor_id, [
+        'expires' => time() + 365 * 24 * 3600,
+        'path' => '/',
+        'httponly' => true,
+        'samesite' => 'Lax'
+    ]);
+    return $visitor_id;
+}
+$user_id = 'web-' . get_visitor_id();
+
 // Cấu hình kết nối
 $python_host = 'localhost'; // Điều chỉnh nếu cần
 $python_port = '5001';      // Điều chỉnh nếu cần
 $python_service_url = "http://{$python_host}:{$python_port}/chat";
 $python_reset_url = "http://{$python_host}:{$python_port}/reset";
+$python_reply_url = "http://{$python_host}:{$python_port}/chat/reply";
 
 // Timeout cho kết nối (tăng lên để tránh lỗi timeout)
 $timeout = 30; // 30 giây
 
+// Long-poll phản hồi đầy đủ của tin nhắn khủng hoảng: GET chatbot_api.php?reply_id=...
+// (dịch vụ AI trả số đường dây nóng ngay, phản hồi của AI tạo sau)
+if ($_SERVER['REQUEST_METHOD'] === 'GET' && isset($_GET['reply_id'])) {
+    $reply_id = $_GET['reply_id'];
+    if (!preg_match('/^[a-f0-9]{32}$/', $reply_id)) {
+        http_response_code(400);
+        echo json_encode(['error' => 'Mã phản hồi không hợp lệ.']);
+        exit;
+    }
+    $wait = 20; // Giây chờ mỗi lần, nhỏ hơn $timeout
+    $context = stream_context_create([
+        'http' => [
+            'method' => 'GET',
+            'ignore_errors' => true,
+            'timeout' => $timeout
+        ]
+    ]);
+    $result = @file_get_contents("{$python_reply_url}/{$reply_id}?wait={$wait}", false, $context);
+    if ($result === FALSE || !isset($http_response_header[0])) {
+        http_response_code(503);
+        echo json_encode(['error' => 'Không thể kết nối đến dịch vụ AI']);
+        exit;
+    }
+    preg_match('{HTTP\/\S*\s(\d{3})}', $http_response_header[0], $match);
+    http_response_code((int)($match[1] ?? 500));
+    echo $result; // 200: phản hồi đã xong, 202: vẫn đang tạo, 404: hết hạn
+    exit;
+}
+
 if ($_SERVER['REQUEST_METHOD'] === 'POST') {
     $input = json_decode(file_get_contents('php://input'), true);
     
@@ -27,7 +75,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
             'http' => [
                 'header'  => "Content-type: application/json\r\n",
                 'method'  => 'POST',
-                'content' => json_encode([]), // Reset không cần payload
+                'content' => json_encode(['user_id' => $user_id]), // Reset phiên của người dùng này
                 'ignore_errors' => true, // Để bắt lỗi từ Python service
                 'timeout' => $timeout // Thêm timeout
             ]
@@ -84,7 +132,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
             exit;
         }
 
-        $data = ['message' => $user_message];
+        $data = ['message' => $user_message, 'user_id' => $user_id];
         $options = [
             'http' => [
                 'header'  => "Content-Type: application/json\r\n",
@@ -117,10 +165,22 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 $status_code = $match[1] ?? 500;
                 
                 if ($status_code >= 200 && $status_code < 300) {
-                    // Trả về phản hồi JSON từ Python service cho frontend
+                    // Trả về phản hồi JSON từ Python service cho frontend; phản hồi khủng hoảng đang tạo
+                    // thì frontend hỏi lại qua chính proxy này
+                    $response_data = json_decode($result, true);
+                    if (!empty($response_data['reply_pending']) && isset($response_data['reply_id'])) {
+                        $response_data['reply_url'] = $_SERVER['SCRIPT_NAME'] . '?reply_id=' . urlencode($response_data['reply_id']);
+                        $result = json_encode($response_data, JSON_UNESCAPED_UNICODE);
+                    }
                     echo $result;
                 } else {
                     http_response_code($status_code);
+                    // Chuyển tiếp Retry-After (429/503 khi dịch vụ AI đang giảm tải) để client không gửi lại ngay
+                    foreach ($http_response_header as $header_line) {
+                        if (stripos($header_line, 'Retry-After:') === 0) {
+                            header($header_line);
+                        }
+                    }
                     $error_detail = json_decode($result, true);
                     echo json_encode([
                         'error' => 'Lỗi từ dịch vụ AI',
@@ -141,6 +201,6 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
     }
 } else {
     http_response_code(405); // Method Not Allowed
-    echo json_encode(['error' => 'Phương thức không được hỗ trợ. Chỉ chấp nhận POST.']);
+    echo json_encode(['error' => 'Phương thức không được hỗ trợ. Chỉ chấp nhận POST (hoặc GET với reply_id).']);
 }
 ?>
\ No newline at end of file
@@ -1,7 +1,18 @@
-bind = "0.0.0.0:8000"
-workers = 1
-worker_class = "sync"
-worker_connections = 1000
+import os
+
+# Chế độ bất đồng bộ: GUNICORN_WORKER_CLASS=gevent để một worker phục vụ hàng trăm
+# cuộc trò chuyện trong khi chờ Gemini. Cần monkey-patch trước khi preload app.
+# Hàng đợi kiểm soát tải và việc gộp tin nhắn trùng của /chat chỉ có tác dụng với gevent:
+# worker sync mỗi lần chỉ xử lý một request.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+if worker_class == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = "0.0.0.0:" + os.getenv("PORT", "8000")
+# Nhiều worker: model được tải trong master và dùng chung qua copy-on-write (xem preload_for_fork)
+workers = int(os.getenv("GUNICORN_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
 timeout = 120
 keepalive = 2
 max_requests = 1000
@@ -9,4 +20,35 @@ max_requests_jitter = 50
 preload_app = True
 accesslog = "-"
 errorlog = "-"
-loglevel = "info"
\ No newline at end of file
+loglevel = "info"
+
+# Đặt trước khi app được import: số thread torch chia theo số worker, và phiên chat
+# dùng chung qua SQLite vì request của một user có thể tới worker bất kỳ
+os.environ.setdefault("GUNICORN_WORKERS", str(workers))
+if workers > 1:
+    os.environ.setdefault("SESSION_BACKEND", "sqlite")
+
+
+def when_ready(server):
+    # Chạy trong master sau khi preload app, trước khi tạo worker
+    from ai_service import preload_for_fork
+    preload_for_fork()
+
+
+def post_fork(server, worker):
+    # Tạo lại client Gemini, kho phiên... riêng cho worker; số worker thực tế (kể cả khi
+    # bị ghi đè bằng -w trên dòng lệnh) dùng để chia thread torch
+    from ai_service import reinit_after_fork
+    reinit_after_fork(server.cfg.workers)
+
+
+def post_worker_init(worker):
+    # Tải trước model trong nền sau khi worker đã sẵn sàng nhận request
+    from ai_service import start_model_warmup
+    start_model_warmup()
+
+
+def worker_exit(server, worker):
+    # Ghi nốt hàng đợi database trước khi worker thoát
+    from ai_service import database
+    database.close()
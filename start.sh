@@ -3,7 +3,9 @@
 # Start script for Render
 echo "Starting the application..."
 
-# Download required models (if not cached)
+# Model được tải lười khi dùng lần đầu (hoặc trong nền qua WARMUP_MODELS),
+# nên /health trả lời ngay. Đặt PREFETCH_MODELS=1 để tải sẵn vào cache trước khi khởi động.
+if [ "$PREFETCH_MODELS" = "1" ]; then
 python -c "
 from transformers import AutoTokenizer, AutoModel
 print('Downloading PhoBERT model...')
@@ -11,6 +13,7 @@ AutoTokenizer.from_pretrained('vinai/phobert-base')
 AutoModel.from_pretrained('vinai/phobert-base')
 print('Models downloaded successfully!')
 "
+fi
 
-# Start the application with gunicorn
-exec gunicorn --bind 0.0.0.0:$PORT --workers 1 --timeout 120 --keep-alive 2 ai_service:app
\ No newline at end of file
+# Start the application with gunicorn (số worker, timeout... lấy từ gunicorn.conf.py, đặt GUNICORN_WORKERS để đổi)
+exec gunicorn -c gunicorn.conf.py ai_service:app
\ No newline at end of file
@@ -10,6 +10,10 @@ class ModernChatInterface {
         this.apiUrl = 'http://localhost:5001/chat';
         this.resetUrl = 'http://localhost:5001/reset';
         
+        // Tin nhắn khủng hoảng: server trả số đường dây nóng ngay, phản hồi đầy đủ lấy sau bằng long-poll
+        this.replyPollWait = 20; // giây mỗi lần chờ
+        this.replyPollAttempts = 6;
+        
         // Typing effect settings
         this.typingSpeed = 10; // milliseconds per character
         this.currentTypingTimeout = null;
@@ -167,6 +171,12 @@ class ModernChatInterface {
                 this.lastBotMessage = botMessage;
                 await this.addMessageWithTypingEffect(botMessage, 'bot');
             }
+            if (data.emergency_resources) {
+                this.addMessage(this.formatEmergencyResources(data.emergency_resources), 'bot');
+            }
+            if (data.reply_pending && data.reply_url) {
+                await this.pollPendingReply(data.reply_url);
+            }
         } else if (data.error) {
             this.addMessage(`Lỗi từ AI: ${data.error}`, 'bot');
         } else {
@@ -174,6 +184,42 @@ class ModernChatInterface {
         }
     }
 
+    formatEmergencyResources(resources) {
+        const lines = ['**Đường dây nóng hỗ trợ:**'];
+        (resources.hotlines || []).forEach((hotline) => {
+            lines.push(`- ${hotline.name}: **${hotline.number}** (${hotline.availability})`);
+        });
+        if (resources.emergency_centers && resources.emergency_centers.length) {
+            lines.push('**Cơ sở hỗ trợ khẩn cấp:** ' + resources.emergency_centers.join(', '));
+        }
+        return lines.join('\n');
+    }
+
+    async pollPendingReply(replyUrl) {
+        // Chờ phản hồi đầy đủ của AI cho tin nhắn khủng hoảng (202 = vẫn đang tạo, hỏi lại)
+        const url = new URL(replyUrl, this.apiUrl);
+        url.searchParams.set('wait', this.replyPollWait);
+        this.showTypingIndicator();
+        try {
+            for (let attempt = 0; attempt < this.replyPollAttempts; attempt++) {
+                const response = await fetch(url);
+                if (response.status === 202) continue;
+                if (!response.ok) break;
+
+                const data = await response.json();
+                this.hideTypingIndicator();
+                if (data.reply) {
+                    this.lastBotMessage = data.reply;
+                    await this.addMessageWithTypingEffect(data.reply, 'bot');
+                }
+                return;
+            }
+        } catch (error) {
+            console.error('Error polling pending reply:', error);
+        }
+        this.hideTypingIndicator();
+    }
+
     async handleResetChat() {
         if (!confirm("Bạn có chắc chắn muốn bắt đầu lại cuộc trò chuyện không?")) {
             return;